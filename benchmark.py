@@ -0,0 +1,538 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import argparse
+import ctypes
+import json
+import platform
+import sqlite3
+import numpy as np
+from datetime import datetime
+
+import blosc
+from utils_geopackage import *
+
+# Codecs benchmarked by default as "data_type[:compression]".
+default_codecs = (
+    "xray",
+    "xray:raw",
+    "xray:lz4",
+    "xray:zlib",
+    "xray:blosc:zstd",
+    "xray:adaptive",
+    "image/TIFF:tiff_deflate",
+    "image/PNG"
+    )
+
+# Metrics of every case; lower values are better for all of them.
+metrics = (
+    "write_ms_per_tile",
+    "write_per_tile_ms_per_tile",
+    "read_ms_per_tile",
+    "random_read_ms_per_tile",
+    "window_read_ms",
+    "open_ms",
+    "bytes_per_tile"
+    )
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description="benchmark writing and reading EO Geopackage files"
+        )
+    parser.add_argument(
+        "--codecs",
+        nargs="+",
+        default=default_codecs,
+        help="data_type[:compression] pairs, e.g. xray:lz4 image/TIFF"
+        )
+    parser.add_argument(
+        "--dtypes",
+        nargs="+",
+        default=("uint8", "uint16", "float32")
+        )
+    parser.add_argument(
+        "--shapes",
+        nargs="+",
+        default=("256x256", "256x256x3"),
+        help="tile shapes, e.g. 256x256x4x10"
+        )
+    parser.add_argument(
+        "--tiles",
+        type=int,
+        default=8,
+        help="tiles per side of the benchmarked area"
+        )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="runs per measurement, the fastest one is reported"
+        )
+    parser.add_argument(
+        "--layouts",
+        nargs="+",
+        default=("insert", ),
+        help="tile layouts, e.g. insert hilbert"
+        )
+    parser.add_argument(
+        "--shuffle",
+        action="store_true",
+        help="write the tiles in random order"
+        )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument(
+        "--cold",
+        action="store_true",
+        help="drop the file from the page cache before reading (Linux)"
+        )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--file", type=str, default="benchmark.gpkgx")
+    parser.add_argument("--output", type=str, help="JSON report to write")
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        help="JSON report to compare the results with"
+        )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="relative slowdown or growth reported as regression"
+        )
+    parsed = parser.parse_args(args)
+
+    try:
+        report = run_benchmarks(
+            parsed.file,
+            codecs=parsed.codecs,
+            dtypes=parsed.dtypes,
+            shapes=[
+                tuple(int(size) for size in shape.split("x"))
+                for shape in parsed.shapes
+                ],
+            layouts=parsed.layouts,
+            tiles=parsed.tiles,
+            repeat=parsed.repeat,
+            shuffle=parsed.shuffle,
+            workers=parsed.workers,
+            cold=parsed.cold,
+            seed=parsed.seed
+            )
+    finally:
+        if os.path.isfile(parsed.file):
+            os.remove(parsed.file)
+    print_results(report["results"])
+    if parsed.output:
+        with open(parsed.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    if parsed.baseline:
+        with open(parsed.baseline) as baseline:
+            regressions = compare_reports(
+                json.load(baseline),
+                report,
+                parsed.tolerance
+                )
+        for case, metric, before, after in regressions:
+            print "regression: %s %s %s -> %s" %(
+                format_case(case),
+                metric,
+                before,
+                after
+                )
+        if regressions:
+            sys.exit(1)
+
+
+def run_benchmarks(
+    file_path,
+    codecs=default_codecs,
+    dtypes=("uint8", "uint16", "float32"),
+    shapes=((256, 256), (256, 256, 3)),
+    layouts=("insert", ),
+    tiles=8,
+    repeat=3,
+    shuffle=False,
+    workers=1,
+    cold=False,
+    seed=0
+    ):
+    """
+    Benchmarks every combination of codec, dtype, tile shape and layout on a
+    square of tiles x tiles synthetic tiles and returns the report as a
+    dictionary:
+    - environment: versions of Python, SQLite and the libraries
+    - parameters: the arguments
+    - results: one dictionary per case with the case (data_type,
+      compression, dtype, shape, layout) and the metrics, or the reason it
+      was skipped (codec not available or not supporting the dtype and
+      shape) or failed (tiles not read back); other errors are raised
+    Every measurement is repeated and the fastest run is reported.
+    """
+    results = []
+    for codec in codecs:
+        data_type, compression = (codec.split(":", 1) + [None])[:2]
+        for dtype in dtypes:
+            for shape in shapes:
+                for layout in layouts:
+                    result = dict(
+                        data_type=data_type,
+                        compression=compression,
+                        dtype=dtype,
+                        shape=list(shape),
+                        layout=layout
+                        )
+                    results.append(result)
+                    try:
+                        supported = codec_supports(
+                            data_type,
+                            compression,
+                            dtype,
+                            shape
+                            )
+                    except ImportError as e:
+                        # A package needed by the codec is missing.
+                        result["skipped"] = str(e)
+                        continue
+                    if not supported:
+                        result["skipped"] = "%s does not support %s %s" % (
+                            compression or data_type,
+                            dtype,
+                            "x".join(str(size) for size in shape)
+                            )
+                        continue
+                    try:
+                        result.update(benchmark_case(
+                            file_path,
+                            data_type,
+                            compression,
+                            dtype,
+                            shape,
+                            layout=layout,
+                            tiles=tiles,
+                            repeat=repeat,
+                            shuffle=shuffle,
+                            workers=workers,
+                            cold=cold,
+                            seed=seed
+                            ))
+                    except AssertionError:
+                        result["failed"] = "decoded tiles differ"
+    return dict(
+        environment=dict(
+            python=platform.python_version(),
+            platform=platform.platform(),
+            sqlite=sqlite3.sqlite_version,
+            numpy=np.__version__,
+            blosc=blosc.__version__
+            ),
+        parameters=dict(
+            codecs=list(codecs),
+            dtypes=list(dtypes),
+            shapes=[list(shape) for shape in shapes],
+            layouts=list(layouts),
+            tiles=tiles,
+            repeat=repeat,
+            shuffle=shuffle,
+            workers=workers,
+            cold=cold,
+            seed=seed
+            ),
+        results=results
+        )
+
+
+def benchmark_case(
+    file_path,
+    data_type,
+    compression,
+    dtype,
+    shape,
+    layout="insert",
+    tiles=8,
+    repeat=3,
+    shuffle=False,
+    workers=1,
+    cold=False,
+    seed=0
+    ):
+    """
+    Returns the metrics of one codec, dtype, tile shape and layout:
+    - write_ms_per_tile: insert_tiles() into a new file
+    - write_per_tile_ms_per_tile: insert_tile() of every tile into a new file
+    - read_ms_per_tile: get_tiledata() of all tiles row by row
+    - random_read_ms_per_tile: get_tiledata() of all tiles in random order
+    - window_read_ms: get_window() of a quarter of the area
+    - open_ms: opening the file and reading its first tile
+    - bytes_per_tile: file size per tile
+    """
+    zoom = 10
+    keys = [(zoom, row, col) for row in range(tiles) for col in range(tiles)]
+    test_tiles = [
+        (zoom, row, col, synthetic_tile(row, col, dtype, shape, seed))
+        for zoom, row, col in keys
+        ]
+    random_keys = list(keys)
+    np.random.RandomState(seed).shuffle(random_keys)
+    if shuffle:
+        write_keys = list(keys)
+        np.random.RandomState(seed + 1).shuffle(write_keys)
+        write_tiles = dict(
+            ((zoom, row, col), data) for zoom, row, col, data in test_tiles
+            )
+        test_tiles = [key + (write_tiles[key], ) for key in write_keys]
+    window_size = max(tiles // 2, 1)
+    window = (0, 0, window_size - 1, window_size - 1)
+
+    def write_tiles(batched):
+        geopackage = EOGeopackage(
+            file_path,
+            "w",
+            data_type,
+            4326,
+            overwrite=True,
+            compression=compression,
+            layout=layout
+            )
+        start = datetime.now()
+        if batched:
+            geopackage.insert_tiles(test_tiles, workers=workers)
+        else:
+            for zoom, row, col, data in test_tiles:
+                geopackage.insert_tile(zoom, row, col, data)
+        seconds = (datetime.now() - start).total_seconds()
+        geopackage.close()
+        return seconds
+
+    # The batched writes come last, so their file is the one read below.
+    write_per_tile_times = [write_tiles(False) for run in range(repeat)]
+    write_times = [write_tiles(True) for run in range(repeat)]
+
+    geopackage = EOGeopackage(file_path, "r")
+    try:
+        # Only benchmark what is read back correctly.
+        np.testing.assert_array_equal(
+            geopackage.get_tiledata(*test_tiles[0][:3]),
+            test_tiles[0][3]
+            )
+    finally:
+        geopackage.close()
+
+    def read_tiles(read_keys):
+        geopackage = EOGeopackage(file_path, "r")
+        start = datetime.now()
+        for zoom, row, col in read_keys:
+            geopackage.get_tiledata(zoom, row, col)
+        seconds = (datetime.now() - start).total_seconds()
+        geopackage.close()
+        return seconds
+
+    def read_window():
+        geopackage = EOGeopackage(file_path, "r")
+        start = datetime.now()
+        geopackage.get_window(zoom, window)
+        seconds = (datetime.now() - start).total_seconds()
+        geopackage.close()
+        return seconds
+
+    def open_file():
+        start = datetime.now()
+        geopackage = EOGeopackage(file_path, "r")
+        geopackage.get_tiledata(*keys[0])
+        seconds = (datetime.now() - start).total_seconds()
+        geopackage.close()
+        return seconds
+
+    def fastest(measure, *args):
+        times = []
+        for run in range(repeat):
+            if cold:
+                drop_file_cache(file_path)
+            times.append(measure(*args))
+        return min(times)
+
+    return dict(
+        write_ms_per_tile=_round(min(write_times) * 1000 / len(keys)),
+        write_per_tile_ms_per_tile=_round(
+            min(write_per_tile_times) * 1000 / len(keys)
+            ),
+        read_ms_per_tile=_round(fastest(read_tiles, keys) * 1000 / len(keys)),
+        random_read_ms_per_tile=_round(
+            fastest(read_tiles, random_keys) * 1000 / len(keys)
+            ),
+        window_read_ms=_round(fastest(read_window) * 1000),
+        open_ms=_round(fastest(open_file) * 1000),
+        bytes_per_tile=os.stat(file_path).st_size // len(keys),
+        raw_bytes_per_tile=test_tiles[0][3].nbytes
+        )
+
+
+def codec_supports(data_type, compression, dtype, shape):
+    """
+    Returns whether the codec encodes tiles of the dtype and shape, adaptive
+    if one of its default candidates does. Raises an ImportError if a
+    package needed by the codec is missing.
+    """
+    codec = get_codec(data_type, compression)
+    codecs = [codec]
+    if compression == "adaptive":
+        codecs = [
+            candidate for candidate, options in adaptive_codecs(
+                data_type,
+                codec.get_options()
+                )[1:]
+            ]
+    for codec in codecs:
+        try:
+            codec.check(np.zeros(shape, dtype=dtype))
+            return True
+        except TypeError:
+            pass
+    return False
+
+
+def synthetic_tile(row, col, dtype, shape, seed=0):
+    """
+    Returns a tile of a synthetic image which, unlike random values,
+    compresses like Earth observation data: smooth terrain of several
+    scales continuing across tile borders, some sensor noise, correlated
+    bands and time slices and nodata (0) areas.
+    - shape: (height, width[, bands[, time]])
+    """
+    height, width = shape[:2]
+    phases = np.random.RandomState(seed).uniform(0, 2 * np.pi, (4, 2))
+    y, x = np.mgrid[0:height, 0:width].astype("float64")
+    y += row * height
+    x += col * width
+    terrain = np.zeros((height, width))
+    for octave, (phase_x, phase_y) in enumerate(phases):
+        frequency = 2. ** octave / 300
+        terrain += (
+            np.sin(x * frequency + phase_x) *
+            np.cos(y * frequency * 0.8 + phase_y)
+            ) / 2 ** octave
+    # terrain is within -2 and 2
+    terrain = (terrain + 2) / 4
+    noise = np.random.RandomState(seed + row * 100003 + col).normal(
+        0,
+        0.005,
+        shape
+        )
+    bands = shape[2] if len(shape) > 2 else 1
+    times = shape[3] if len(shape) > 3 else 1
+    data = np.empty((height, width, bands, times))
+    for band in range(bands):
+        for time in range(times):
+            data[:, :, band, time] = terrain * (1 - 0.1 * band) + 0.01 * time
+    data = data.reshape(shape) + noise
+    nodata = np.sin(x / 700. + phases[0, 0]) + np.cos(y / 500.) < -1.5
+    if data.ndim > 2:
+        nodata = nodata.reshape(nodata.shape + (1, ) * (data.ndim - 2))
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        data *= 0.8 * min(np.iinfo(dtype).max, 10000)
+    data = np.where(nodata, 0, np.clip(data, 0, None))
+    return data.astype(dtype)
+
+
+def compare_reports(baseline, report, tolerance=0.2):
+    """
+    Returns the (case, metric, baseline value, value) of all metrics which
+    grew by more than the tolerance compared to the baseline report, of
+    cases measured in the baseline which are skipped or failed now and of
+    cases which failed only now. Cases missing in either report are ignored.
+    """
+    baseline_results = dict(
+        (_case_key(result), result) for result in baseline["results"]
+        )
+    regressions = []
+    for result in report["results"]:
+        before = baseline_results.get(_case_key(result))
+        if before is None:
+            continue
+        if _measured(before) and not _measured(result):
+            regressions.append((
+                _case_key(result),
+                "measured",
+                "ok",
+                result.get("failed", result.get("skipped"))
+                ))
+        elif "failed" in result and "failed" not in before:
+            regressions.append(
+                (_case_key(result), "roundtrip", "ok", result["failed"])
+                )
+        for metric in metrics:
+            if metric not in result or metric not in before:
+                continue
+            if result[metric] > before[metric] * (1 + tolerance):
+                regressions.append(
+                    (_case_key(result), metric, before[metric], result[metric])
+                    )
+    return regressions
+
+
+def print_results(results):
+    """
+    Prints the results as a markdown table.
+    """
+    columns = ("case", ) + metrics
+    print "| %s |" % " | ".join(columns)
+    print "|%s" % ("---|" * len(columns))
+    for result in results:
+        if "skipped" in result:
+            values = ["skipped"] * len(metrics)
+        elif "failed" in result:
+            values = ["failed"] * len(metrics)
+        else:
+            values = [result[metric] for metric in metrics]
+        print "| %s |" % " | ".join(
+            [format_case(_case_key(result))] + [str(value) for value in values]
+            )
+
+
+def format_case(case):
+    data_type, compression, dtype, shape, layout = case
+    return "%s %s %s %s %s" %(
+        data_type,
+        compression,
+        dtype,
+        "x".join(str(size) for size in shape),
+        layout
+        )
+
+
+def drop_file_cache(path):
+    """
+    Evicts a file from the operating system page cache, so the next reads
+    come from disk (Linux only).
+    """
+    with open(path, "rb") as cached_file:
+        os.fsync(cached_file.fileno())
+        ctypes.CDLL(None).posix_fadvise(
+            cached_file.fileno(),
+            ctypes.c_int64(0),
+            ctypes.c_int64(0),
+            4 # POSIX_FADV_DONTNEED
+            )
+
+
+def _case_key(result):
+    return (
+        result["data_type"],
+        result["compression"],
+        result["dtype"],
+        tuple(result["shape"]),
+        result.get("layout", "insert")
+        )
+
+
+def _measured(result):
+    return any(metric in result for metric in metrics)
+
+
+def _round(value):
+    return round(value, 3)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
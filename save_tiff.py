@@ -4,6 +4,11 @@ import sys
 import os
 import argparse
 import rasterio
+from rasterio.transform import array_bounds, from_origin
+import rasterio.warp
+from rasterio.windows import Window
+import numpy as np
+from datetime import datetime
 
 from utils_geopackage import *
 
@@ -17,24 +22,76 @@ sys.path.append(tilematrix_class_directory)
 from tilematrix import *
 from tilematrix_io import *
 
+# Source dataset opened once in every worker process.
+source = None
+
 def main(args):
     parser = argparse.ArgumentParser()
     parser.add_argument("input_file", type=str)
     parser.add_argument("output_gpkg", type=str)
+    parser.add_argument("--zoom", type=int, default=3)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="number of processes (default: one per CPU core)"
+        )
+    parser.add_argument(
+        "--pixelbuffer",
+        type=int,
+        default=0,
+        help=(
+            "pixels added on every tile side (default: 0, no pyramid is "
+            "built if set)"
+            )
+        )
     parsed = parser.parse_args(args)
     input_file = parsed.input_file
     output_gpkg = parsed.output_gpkg
 
     try:
-        save_tiff(input_file, output_gpkg)
+        tiles, ingest_seconds, pyramid_seconds = save_tiff(
+            input_file,
+            output_gpkg,
+            zoom=parsed.zoom,
+            workers=parsed.workers,
+            pixelbuffer=parsed.pixelbuffer
+            )
+        print "%s tiles in %ss (%s tiles/s)" %(
+            tiles,
+            ingest_seconds,
+            round(tiles / ingest_seconds, 1)
+            )
+        if pyramid_seconds is not None:
+            print "pyramid built in %ss" % pyramid_seconds
     except:
         if os.path.isfile(output_gpkg):
             os.remove(output_gpkg)
         raise
 
 
-def save_tiff(input_file, output_gpkg):
-    zoom = 3
+def save_tiff(
+    input_file,
+    output_gpkg,
+    zoom=3,
+    workers=None,
+    pixelbuffer=0
+    ):
+    """
+    Tiles a raster into a new EO Geopackage and builds the lower zoom levels.
+    Returns the number of tiles written at zoom and the seconds spent writing
+    them and building the pyramid.
+    - pixelbuffer: pixels of the neighbouring tiles added on every side;
+      buffered tiles overlap, so no pyramid is built from them and the
+      pyramid seconds are None
+    Tiles are grouped by the block of the source raster holding their upper
+    left corner. Every worker process keeps the source raster open, reads the
+    block aligned window covering a group at once, warps it onto the tile
+    grid and slices the tiles out of it. The calling process encodes the
+    tiles as uncompressed TIFF, which costs less than sending them to a
+    worker process again, and writes them.
+    """
+    workers = workers or cpu_count()
     tiff_gpkg = EOGeopackage(
         output_gpkg,
         "w",
@@ -43,26 +100,189 @@ def save_tiff(input_file, output_gpkg):
         overwrite=True,
         compression=None
         )
-    wgs84 = TileMatrix("4326")
-    wgs84.set_format("GTiff")
+    tile_matrix = TileMatrix("4326")
+    tile_matrix.set_format("GTiff")
+    tile_size = tile_matrix.px_per_tile
 
     with rasterio.open(input_file, "r") as src:
-        bounds = src.bounds
+        bounds = rasterio.warp.transform_bounds(
+            src.crs,
+            "EPSG:4326",
+            *src.bounds
+            )
         tl = [bounds[0], bounds[3]]
         tr = [bounds[2], bounds[3]]
         br = [bounds[2], bounds[1]]
         bl = [bounds[0], bounds[1]]
         bbox = Polygon([tl, tr, br, bl])
-        tiles = wgs84.tiles_from_bbox(bbox, zoom)
-        for tile in tiles:
-            metadata, rasterdata = read_raster_window(
-                input_file,
-                wgs84,
-                tile,
-                pixelbuffer=2
+        tiles = list(tile_matrix.tiles_from_bbox(bbox, zoom))
+        block_rows, block_cols = src.block_shapes[0]
+        tile_matrix_set = tile_matrix_sets[4326]
+        left, bottom, right, top = tile_matrix_set["bounds"]
+        tile_degrees = (right - left) / (
+            tile_matrix_set["matrix_width"] * 2**zoom
+            )
+        # Upper left tile corners within the raster, in the raster CRS.
+        xs, ys = rasterio.warp.transform(
+            "EPSG:4326",
+            src.crs,
+            [max(left + col * tile_degrees, bounds[0]) for _, _, col in tiles],
+            [min(top - row * tile_degrees, bounds[3]) for _, row, _ in tiles]
+            )
+        blocks = {}
+        for tile, x, y in zip(tiles, xs, ys):
+            src_row, src_col = src.index(x, y)
+            blocks.setdefault(
+                (
+                    min(max(src_row, 0), src.height - 1) // block_rows,
+                    min(max(src_col, 0), src.width - 1) // block_cols
+                    ),
+                []
+                ).append(tile)
+
+    start = datetime.now()
+    pool = encoding_pool(workers, _init_worker, (input_file, ))
+    try:
+        block_tiles = imap_bounded(
+            pool,
+            _read_tiles,
+            (
+                (block, pixelbuffer, tile_size)
+                for key, block in sorted(blocks.items())
+                ),
+            2 * workers
+            )
+        inserted = tiff_gpkg.insert_tiles(
+            tile for block in block_tiles for tile in block
+            )
+    except:
+        pool.terminate()
+        tiff_gpkg.close()
+        raise
+    pool.close()
+    pool.join()
+    ingested = datetime.now()
+    if pixelbuffer:
+        tiff_gpkg.close()
+        return inserted, (ingested - start).total_seconds(), None
+    try:
+        tiff_gpkg.build_pyramid(zoom, 0)
+        finish = datetime.now()
+    finally:
+        tiff_gpkg.close()
+    return (
+        inserted,
+        (ingested - start).total_seconds(),
+        (finish - ingested).total_seconds()
+        )
+
+
+def _init_worker(input_file):
+    """
+    Opens the source raster once per worker process.
+    """
+    global source
+    source = rasterio.open(input_file, "r")
+
+
+def _read_tiles(tiles, pixelbuffer, tile_size):
+    """
+    Reads the block aligned source window covering a group of tiles of one
+    zoom level and returns the tiles of tile_size pixels per side plus
+    pixelbuffer pixels on every side as (zoom, row, col, data) tuples.
+    """
+    zoom = tiles[0][0]
+    tile_matrix_set = tile_matrix_sets[4326]
+    left, bottom, right, top = tile_matrix_set["bounds"]
+    tile_degrees = (right - left) / (tile_matrix_set["matrix_width"] * 2**zoom)
+    pixel_size = tile_degrees / tile_size
+    min_row = min(row for _, row, col in tiles)
+    max_row = max(row for _, row, col in tiles)
+    min_col = min(col for _, row, col in tiles)
+    max_col = max(col for _, row, col in tiles)
+    mosaic_transform = from_origin(
+        left + min_col * tile_degrees - pixelbuffer * pixel_size,
+        top - min_row * tile_degrees + pixelbuffer * pixel_size,
+        pixel_size,
+        pixel_size
+        )
+    mosaic = np.zeros(
+        (
+            source.count,
+            (max_row - min_row + 1) * tile_size + 2 * pixelbuffer,
+            (max_col - min_col + 1) * tile_size + 2 * pixelbuffer
+            ),
+        dtype=source.dtypes[0]
+        )
+    window = _block_window(
+        rasterio.warp.transform_bounds(
+            "EPSG:4326",
+            source.crs,
+            *array_bounds(mosaic.shape[1], mosaic.shape[2], mosaic_transform)
+            )
+        )
+    if window is not None:
+        rasterio.warp.reproject(
+            source=source.read(window=window),
+            destination=mosaic,
+            src_transform=source.window_transform(window),
+            src_crs=source.crs,
+            src_nodata=source.nodata,
+            dst_transform=mosaic_transform,
+            dst_crs="EPSG:4326",
+            resampling=rasterio.warp.Resampling.nearest
             )
-            zoom, row, col = tile
-            tiff_gpkg.insert_tile(zoom, row, col, rasterdata)
+    tiles_data = []
+    for zoom, row, col in tiles:
+        top_pixel = (row - min_row) * tile_size
+        left_pixel = (col - min_col) * tile_size
+        data = mosaic[
+            :,
+            top_pixel:top_pixel+tile_size+2*pixelbuffer,
+            left_pixel:left_pixel+tile_size+2*pixelbuffer
+            ]
+        if source.count == 1:
+            data = data[0]
+        else:
+            data = np.moveaxis(data, 0, -1)
+        tiles_data.append((zoom, row, col, np.ascontiguousarray(data)))
+    return tiles_data
+
+
+def _block_window(bounds):
+    """
+    Returns the window of the source raster covering bounds given in its
+    CRS, extended to whole blocks and clipped to the raster, or None if the
+    bounds are outside of the raster.
+    """
+    block_rows, block_cols = source.block_shapes[0]
+    window = source.window(*bounds)
+    row_start = max(
+        int(np.floor(float(window.row_off) / block_rows)) * block_rows,
+        0
+        )
+    col_start = max(
+        int(np.floor(float(window.col_off) / block_cols)) * block_cols,
+        0
+        )
+    row_stop = min(
+        int(np.ceil(float(window.row_off + window.height) / block_rows)) *
+        block_rows,
+        source.height
+        )
+    col_stop = min(
+        int(np.ceil(float(window.col_off + window.width) / block_cols)) *
+        block_cols,
+        source.width
+        )
+    if row_start >= row_stop or col_start >= col_stop:
+        return None
+    return Window(
+        col_start,
+        row_start,
+        col_stop - col_start,
+        row_stop - row_start
+        )
 
 
 if __name__ == "__main__":
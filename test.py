@@ -7,6 +7,8 @@ import numpy as np
 from sqlite3 import Binary as sbinary
 from datetime import datetime
 import zlib
+import threading
+from multiprocessing.pool import ThreadPool
 
 from utils_geopackage import *
 import utils_geopackage
@@ -83,6 +85,157 @@ def run_tests(output_file):
     except:
         raise
 
+    # Files are updated with the settings they were written with.
+    test_geopackage = EOGeopackage(
+        output_file,
+        "w",
+        "xray",
+        4326,
+        overwrite=True,
+        compression="zlib",
+        predictor="horizontal"
+        )
+    test_geopackage.insert_tile(10, 0, 0, np.zeros((4, 4), "uint16"))
+    test_geopackage.close()
+    for settings in (
+        {"compression": "lz4", "predictor": "horizontal"},
+        {"compression": "zlib"},
+        {"compression": "zlib", "predictor": "horizontal", "dedup": True},
+        {"compression": "zlib", "predictor": "horizontal", "layout": "hilbert"},
+        {
+            "compression": "zlib",
+            "predictor": "horizontal",
+            "compression_options": {"shuffle": "bit"}
+            }
+        ):
+        try:
+            EOGeopackage(output_file, "w", "xray", 4326, **settings)
+            raise AssertionError("file updated with settings %s" % settings)
+        except AttributeError:
+            pass
+    test_geopackage = EOGeopackage(
+        output_file,
+        "w",
+        "xray",
+        4326,
+        compression="zlib",
+        predictor="horizontal"
+        )
+    test_data = np.arange(16, dtype="uint16").reshape((4, 4))
+    test_geopackage.insert_tile(10, 0, 1, test_data)
+    test_geopackage.close()
+    test_geopackage = EOGeopackage(output_file, "r")
+    np.testing.assert_array_equal(
+        test_geopackage.get_tiledata(10, 0, 1),
+        test_data
+        )
+    test_geopackage.close()
+    # nthreads is neither stored nor compared, it is taken from the
+    # arguments.
+    for mode, nthreads in (("w", 2), ("w", 4), ("r", 3)):
+        test_geopackage = EOGeopackage(
+            output_file,
+            mode,
+            "xray",
+            4326,
+            compression="zlib",
+            compression_options={"nthreads": nthreads},
+            predictor="horizontal"
+            )
+        try:
+            assert test_geopackage.compression_options["nthreads"] == nthreads
+            assert "nthreads" not in test_geopackage.metadata["codec_options"]
+            np.testing.assert_array_equal(
+                test_geopackage.get_tiledata(10, 0, 1),
+                test_data
+                )
+        except:
+            raise
+        test_geopackage.close()
+    # The tile_codec tags of adaptive files index the stored candidates.
+    test_geopackage = EOGeopackage(
+        output_file,
+        "w",
+        "xray",
+        4326,
+        overwrite=True,
+        compression="adaptive",
+        compression_options={"candidates": ["lz4", "raw"]}
+        )
+    test_geopackage.insert_tile(10, 0, 0, test_data)
+    test_geopackage.close()
+    try:
+        EOGeopackage(
+            output_file,
+            "w",
+            "xray",
+            4326,
+            compression="adaptive",
+            compression_options={"candidates": ["raw", "lz4"]}
+            )
+        raise AssertionError("file updated with other adaptive candidates")
+    except AttributeError:
+        pass
+    test_geopackage = EOGeopackage(
+        output_file,
+        "w",
+        "xray",
+        4326,
+        compression="adaptive",
+        compression_options={"candidates": ["lz4", "raw"]}
+        )
+    test_geopackage.insert_tile(10, 0, 1, test_data + 1)
+    test_geopackage.close()
+    test_geopackage = EOGeopackage(output_file, "r")
+    np.testing.assert_array_equal(
+        test_geopackage.get_tiledata(10, 0, 1),
+        test_data + 1
+        )
+    test_geopackage.close()
+    # Dictionaries are taken from the file.
+    if utils_geopackage.zstandard:
+        test_geopackage = EOGeopackage(
+            output_file,
+            "w",
+            "xray",
+            4326,
+            overwrite=True,
+            compression="zstandard"
+            )
+        dictionary = test_geopackage.train_dictionary(
+            [np.random.randint(64, size=(32, 32)).astype("uint16")
+            for i in range(0, 200)],
+            dict_size=1024
+            )
+        test_geopackage.insert_tile(10, 0, 0, test_data)
+        test_geopackage.close()
+        try:
+            EOGeopackage(
+                output_file,
+                "w",
+                "xray",
+                4326,
+                compression="zstandard",
+                compression_options={"dictionary": b"other" * 100}
+                )
+            raise AssertionError("file updated with another dictionary")
+        except AttributeError:
+            pass
+        test_geopackage = EOGeopackage(
+            output_file,
+            "w",
+            "xray",
+            4326,
+            compression="zstandard"
+            )
+        try:
+            assert test_geopackage.compression_options["dictionary"] == (
+                dictionary
+                )
+        except:
+            raise
+        test_geopackage.close()
+
     # Performance test variables.
     zoom = 10
     tilesize = 10
@@ -124,7 +277,6 @@ def run_tests(output_file):
         zoom = 10
 
         # Write data
-        start = datetime.now()
         for row in range(0, tilesize):
             for col in range(0, tilesize):
                 test_data = np.uint8(np.random.randint(
@@ -132,25 +284,11 @@ def run_tests(output_file):
                     size=testarray_size
                     ))
                 test_geopackage.insert_tile(zoom, row, col, test_data)
-        finish = datetime.now()
-        write_time = (finish - start).total_seconds()
 
         # Read data.
         for row in range(0, tilesize):
             for col in range(0, tilesize):
                 test_data = test_geopackage.get_tiledata(zoom, row, col)
-        finish = datetime.now()
-        read_time = (finish - start).total_seconds()
-
-        # Get file size.
-        filestat = os.stat(output_file)
-        filesize = filestat.st_size
-        filesize_mb = filesize/1024
-        print "'%s', %s, %s, %s" %(
-            compression,
-            filesize_mb,
-            write_time,
-            read_time)
 
         # Test read data.
         try:
@@ -170,6 +308,1713 @@ def run_tests(output_file):
             raise
 
 
+    # TIFF dtypes and bands #
+    #########################
+
+    print "TIFF dtypes"
+    y, x = np.mgrid[0:255, 0:255]
+    smooth = 3000 * (np.sin(x / 40.) * np.cos(y / 30.) + 1)
+    test_compressions = ["tiff_deflate", "tiff_lzw"]
+    if utils_geopackage.zstandard:
+        test_compressions.append("tiff_zstd")
+    for dtype, bands, predictor in (
+        ("uint8", 3, "horizontal"),
+        ("uint16", None, "horizontal"),
+        ("int16", 4, "horizontal"),
+        ("float32", None, "floating_point"),
+        ("float32", 6, "floating_point")
+        ):
+        test_data = smooth / 30 if dtype == "uint8" else smooth - 1000
+        if bands:
+            test_data = np.dstack([test_data + band for band in range(bands)])
+        test_data = test_data.astype(dtype)
+        for compression in test_compressions:
+            try:
+                for test_predictor in (None, predictor):
+                    encode_tiff(test_data, compression, test_predictor)
+            except TypeError:
+                # LZW of other than uint8 tiles needs imagecodecs.
+                assert compression == "tiff_lzw"
+                continue
+            test_geopackage = EOGeopackage(
+                output_file,
+                "w",
+                "image/TIFF",
+                4326,
+                overwrite=True,
+                compression=compression,
+                predictor=predictor
+                )
+            test_geopackage.insert_tile(zoom, 0, 0, test_data)
+            test_geopackage.close()
+            test_geopackage = EOGeopackage(output_file, "r")
+            try:
+                assert test_geopackage.predictor == predictor
+                test_read = test_geopackage.get_tiledata(zoom, 0, 0)
+                assert test_read.dtype == test_data.dtype
+                np.testing.assert_array_equal(test_read, test_data)
+            except:
+                raise
+            test_geopackage.close()
+    # TIFF encoding keeps no global state and can run in threads.
+    tiff_tiles = [
+        (smooth + col).astype("uint16") for col in range(0, 16)
+        ]
+    thread_pool = ThreadPool(4)
+    try:
+        assert thread_pool.map(
+            lambda test_data: encode_tiff(test_data, "tiff_deflate"),
+            tiff_tiles
+            ) == [
+                encode_tiff(test_data, "tiff_deflate")
+                for test_data in tiff_tiles
+                ]
+    except:
+        raise
+    thread_pool.close()
+    test_data = smooth.astype("int64")
+    try:
+        encode_tiff(test_data)
+        raise AssertionError("int64 TIFF tile accepted")
+    except TypeError:
+        pass
+
+
+    # lossless image formats #
+    ##########################
+
+    print "image formats"
+    image_tiles = {
+        ("uint8", None): (smooth / 30).astype("uint8"),
+        ("uint8", 3): np.dstack(
+            [smooth / 30 + band for band in range(3)]
+            ).astype("uint8"),
+        ("uint8", 4): np.dstack(
+            [smooth / 30 + band for band in range(4)]
+            ).astype("uint8"),
+        ("uint16", None): smooth.astype("uint16")
+        }
+    for data_type, keys, compression_options in (
+        ("image/PNG", image_tiles.keys(), {"compress_level": 9}),
+        ("image/WebP", [("uint8", None), ("uint8", 3)], None),
+        ("image/JPEG2000", image_tiles.keys(), None)
+        ):
+        for key in sorted(keys):
+            test_data = image_tiles[key]
+            test_geopackage = EOGeopackage(
+                output_file,
+                "w",
+                data_type,
+                4326,
+                overwrite=True,
+                compression_options=compression_options
+                )
+            test_geopackage.insert_tiles(
+                [(zoom, 0, col, test_data) for col in range(0, 4)],
+                workers=2
+                )
+            test_geopackage.close()
+            test_geopackage = EOGeopackage(output_file, "r")
+            try:
+                assert test_geopackage.data_type == data_type
+                for col in range(0, 4):
+                    test_read = test_geopackage.get_tiledata(zoom, 0, col)
+                    assert test_read.dtype == test_data.dtype
+                    np.testing.assert_array_equal(test_read, test_data)
+            except:
+                raise
+            test_geopackage.close()
+        # Unsupported arrays are rejected before anything is written.
+        test_geopackage = EOGeopackage(
+            output_file,
+            "w",
+            data_type,
+            4326,
+            overwrite=True
+            )
+        try:
+            test_geopackage.insert_tile(zoom, 0, 0, smooth.astype("float32"))
+            raise AssertionError("float32 %s tile accepted" % data_type)
+        except TypeError:
+            pass
+        assert "dtype" not in test_geopackage.metadata
+        test_geopackage.close()
+    try:
+        EOGeopackage(output_file, "w", "image/GIF", 4326, overwrite=True)
+        raise AssertionError("unknown data_type accepted")
+    except AttributeError:
+        pass
+
+
+    ###############
+    # bulk insert #
+    ###############
+
+    zoom = 10
+    testarray_size = (255, 255)
+    print "bulk insert"
+    for data_type, compression in (
+        ("image/TIFF", None),
+        ("xray", None),
+        ("xray", "lz4")
+        ):
+        test_tiles = [
+            (zoom, row, col, np.uint8(np.random.randint(
+                255,
+                size=testarray_size
+                )))
+            for row in range(0, tilesize)
+            for col in range(0, tilesize)
+            ]
+
+        # Per tile.
+        test_geopackage = EOGeopackage(
+            output_file,
+            "w",
+            data_type,
+            4326,
+            overwrite=True,
+            compression=compression
+            )
+        for zoom, row, col, test_data in test_tiles:
+            test_geopackage.insert_tile(zoom, row, col, test_data)
+
+        # Batched.
+        test_geopackage = EOGeopackage(
+            output_file,
+            "w",
+            data_type,
+            4326,
+            overwrite=True,
+            compression=compression
+            )
+        inserted = test_geopackage.insert_tiles(test_tiles, batch_size=32)
+        try:
+            assert inserted == len(test_tiles)
+            for zoom, row, col, test_data in test_tiles:
+                test_read = test_geopackage.get_tiledata(zoom, row, col)
+                np.testing.assert_allclose(test_read, test_data)
+        except:
+            raise
+
+        # A failing batch is rolled back, previous batches stay.
+        test_geopackage = EOGeopackage(
+            output_file,
+            "w",
+            data_type,
+            4326,
+            overwrite=True,
+            compression=compression
+            )
+        try:
+            test_geopackage.insert_tiles(
+                test_tiles[:10] + test_tiles[:1],
+                batch_size=5
+                )
+            raise AssertionError("duplicate tile not detected")
+        except sqlite3.IntegrityError:
+            pass
+        cursor = test_geopackage.db_connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM tiles;")
+        try:
+            assert cursor.fetchone()[0] == 10
+        except:
+            raise
+
+    # Parallel encoding must write the same bytes as serial encoding.
+    print "parallel insert"
+    for data_type, compression in (
+        ("image/TIFF", None),
+        ("image/TIFF", "tiff_deflate"),
+        ("xray", None),
+        ("xray", "lz4")
+        ):
+        blobs = []
+        # A pool passed in is used and left running.
+        shared_pool = encoding_pool(2)
+        for workers, pool in ((1, None), (2, None), (2, shared_pool)):
+            test_geopackage = EOGeopackage(
+                output_file,
+                "w",
+                data_type,
+                4326,
+                overwrite=True,
+                compression=compression
+                )
+            test_geopackage.insert_tiles(
+                test_tiles,
+                batch_size=32,
+                workers=workers,
+                queue_size=8,
+                pool=pool
+                )
+            test_geopackage.db_connection.text_factory = str
+            cursor = test_geopackage.db_connection.cursor()
+            cursor.execute("""
+                SELECT zoom_level, tile_row, tile_column, CAST(tile_data AS BLOB)
+                FROM tiles ORDER BY zoom_level, tile_row, tile_column;
+                """)
+            blobs.append([
+                (zoom, row, col, str(tile_data))
+                for zoom, row, col, tile_data in cursor.fetchall()
+                ])
+        shared_pool.close()
+        shared_pool.join()
+        try:
+            assert len(blobs[0]) == len(test_tiles)
+            assert blobs[0] == blobs[1] == blobs[2]
+        except:
+            raise
+
+
+    #############
+    # bulk read #
+    #############
+
+    print "bulk read"
+    for data_type, compression in (
+        ("image/TIFF", None),
+        ("xray", None),
+        ("xray", "lz4")
+        ):
+        test_geopackage = EOGeopackage(
+            output_file,
+            "w",
+            data_type,
+            4326,
+            overwrite=True,
+            compression=compression
+            )
+        # Leave out one tile to test missing tiles.
+        test_geopackage.insert_tiles(test_tiles[:-1])
+        test_arrays = dict(
+            ((row, col), test_data)
+            for zoom, row, col, test_data in test_tiles[:-1]
+            )
+
+        # Per tile.
+        for row in range(2, 10):
+            for col in range(2, 10):
+                if (row, col) in test_arrays:
+                    test_data = test_geopackage.get_tiledata(zoom, row, col)
+
+        # One query.
+        test_read = test_geopackage.get_tiles(zoom, range(2, 10), range(2, 10))
+
+        test_window = test_geopackage.get_window(zoom, (2, 2, 9, 9))
+        try:
+            assert len(test_read) == 63
+            for (row, col), test_data in test_read.items():
+                np.testing.assert_allclose(test_data, test_arrays[(row, col)])
+            assert test_window.shape == (8 * 255, 8 * 255)
+            for row in range(2, 10):
+                for col in range(2, 10):
+                    top = (row - 2) * 255
+                    left = (col - 2) * 255
+                    test_data = test_arrays.get(
+                        (row, col),
+                        np.zeros(testarray_size)
+                        )
+                    np.testing.assert_allclose(
+                        test_window[top:top+255, left:left+255],
+                        test_data
+                        )
+            assert test_geopackage.get_window(zoom, (20, 20, 21, 21)) is None
+        except:
+            raise
+
+        # Tiles have to be decoded after reopening the file.
+        test_geopackage = EOGeopackage(output_file, "r")
+        try:
+            assert test_geopackage.data_type == data_type
+            assert test_geopackage.compression == compression
+            assert test_geopackage.metadata["dtype"] == "uint8"
+            assert test_geopackage.metadata["bands"] == 1
+            test_read = test_geopackage.get_tiles(
+                zoom,
+                range(2, 10),
+                range(2, 10)
+                )
+            for (row, col), test_data in test_read.items():
+                np.testing.assert_allclose(test_data, test_arrays[(row, col)])
+        except:
+            raise
+
+    ##############
+    # tile cache #
+    ##############
+
+    print "tile cache"
+    tile_bytes = np.zeros(testarray_size, dtype="uint8").nbytes
+    test_geopackage = EOGeopackage(
+        output_file,
+        "w",
+        "xray",
+        4326,
+        overwrite=True,
+        compression="lz4",
+        cache_size=3 * tile_bytes
+        )
+    test_geopackage.insert_tiles(test_tiles)
+    test_arrays = dict(
+        ((row, col), test_data)
+        for zoom, row, col, test_data in test_tiles
+        )
+    for cache in (None, test_geopackage.cache):
+        test_geopackage.cache = cache
+        for i in range(0, 100):
+            test_data = test_geopackage.get_tiledata(zoom, 0, i % 2)
+    try:
+        assert test_geopackage.cache.stats()["hits"] == 98
+        assert test_geopackage.cache.stats()["misses"] == 2
+        for col in range(2, 6):
+            test_read = test_geopackage.get_tiledata(zoom, 0, col)
+            np.testing.assert_allclose(test_read, test_arrays[(0, col)])
+        stats = test_geopackage.cache.stats()
+        assert stats["evictions"] == 3
+        assert stats["tiles"] == 3
+        assert stats["bytes"] == 3 * tile_bytes
+        # Writes invalidate cached tiles.
+        cursor = test_geopackage.db_connection.cursor()
+        cursor.execute("""
+            DELETE FROM tiles WHERE zoom_level=? AND tile_row=? AND
+            tile_column=?;
+            """, (zoom, 0, 5))
+        test_geopackage.db_connection.commit()
+        test_data = np.zeros(testarray_size, dtype="uint8")
+        test_geopackage.insert_tile(zoom, 0, 5, test_data)
+        test_read = test_geopackage.get_tiledata(zoom, 0, 5)
+        np.testing.assert_allclose(test_read, test_data)
+    except:
+        raise
+
+
+    ###########
+    # pyramid #
+    ###########
+
+    print "pyramid"
+    for resampling in ("mean", "nearest", "mode"):
+        test_geopackage = EOGeopackage(
+            output_file,
+            "w",
+            "xray",
+            4326,
+            overwrite=True,
+            compression="lz4"
+            )
+        # Leave out one tile to test missing children.
+        test_geopackage.insert_tiles(test_tiles[1:])
+        test_geopackage.build_pyramid(zoom, zoom - 2, resampling=resampling)
+        test_read = test_geopackage.get_tiles(zoom - 1, range(0, 5), range(0, 5))
+        try:
+            assert len(test_read) == 25
+            assert len(test_geopackage.get_tiles(
+                zoom - 2,
+                range(0, 3),
+                range(0, 3)
+                )) == 9
+            mosaic = np.vstack([
+                np.hstack([test_arrays[(row, col)] for col in (2, 3)])
+                for row in (2, 3)
+                ])
+            if resampling == "mean":
+                test_data = np.uint8(np.round((
+                    np.float64(mosaic[0::2, 0::2]) + mosaic[1::2, 0::2] +
+                    mosaic[0::2, 1::2] + mosaic[1::2, 1::2]
+                    ) / 4))
+            elif resampling == "nearest":
+                test_data = mosaic[0::2, 0::2]
+            elif resampling == "mode":
+                test_data = test_read[(1, 1)]
+                blocks = [
+                    mosaic[0::2, 0::2],
+                    mosaic[1::2, 0::2],
+                    mosaic[0::2, 1::2],
+                    mosaic[1::2, 1::2]
+                    ]
+                # The chosen value has to be the most frequent one.
+                count = sum([block == test_data for block in blocks])
+                assert (count >= 1).all()
+                for block in blocks:
+                    assert (sum([
+                        other == block for other in blocks
+                        ]) <= count).all()
+            np.testing.assert_allclose(test_read[(1, 1)], test_data)
+            # Upper left parent only has three children.
+            assert test_read[(0, 0)][0, 0] == 0
+            if resampling == "nearest":
+                assert test_read[(0, 0)][0, 127] == test_arrays[(0, 1)][0, 0]
+            cursor = test_geopackage.db_connection.cursor()
+            cursor.execute("""
+                SELECT zoom_level, matrix_width, matrix_height, tile_width,
+                pixel_x_size FROM gpkg_tile_matrix ORDER BY zoom_level;
+                """)
+            tile_matrix = cursor.fetchall()
+            assert [level[0] for level in tile_matrix] == [8, 9, 10]
+            assert tile_matrix[2][1:4] == (2048, 1024, 255)
+            assert tile_matrix[2][4] == 360. / (2048 * 255)
+        except:
+            raise
+
+
+    ###################
+    # sqlite profiles #
+    ###################
+
+    print "sqlite profiles"
+    for profile in (None, "ingest"):
+        test_geopackage = EOGeopackage(
+            output_file,
+            "w",
+            "xray",
+            4326,
+            overwrite=True,
+            compression="lz4",
+            profile=profile
+            )
+        test_geopackage.insert_tiles(test_tiles, batch_size=10)
+    cursor = test_geopackage.db_connection.cursor()
+    try:
+        cursor.execute("PRAGMA journal_mode;")
+        assert cursor.fetchone()[0] == "wal"
+        cursor.execute("PRAGMA page_size;")
+        assert cursor.fetchone()[0] == 65536
+        test_geopackage.optimize()
+        cursor.execute("PRAGMA journal_mode;")
+        assert cursor.fetchone()[0] == "delete"
+        assert not os.path.isfile(output_file + "-wal")
+    except:
+        raise
+    test_geopackage = EOGeopackage(output_file, "r", profile="serve")
+    try:
+        test_read = test_geopackage.get_tiledata(zoom, 0, 1)
+        np.testing.assert_allclose(test_read, test_arrays[(0, 1)])
+        test_geopackage.insert_tile(zoom, 20, 20, test_read)
+        raise AssertionError("serve profile is not read only")
+    except sqlite3.OperationalError:
+        pass
+    try:
+        EOGeopackage(output_file, "w", "xray", 4326, profile="serve")
+        raise AssertionError("serve profile must not be used for writing")
+    except AttributeError:
+        pass
+    # Immutable readers would miss the tiles written through the object.
+    try:
+        EOGeopackage(output_file, "w", "xray", 4326, readers="immutable")
+        raise AssertionError("immutable readers used for writing")
+    except AttributeError:
+        pass
+
+
+    ###############
+    # reader pool #
+    ###############
+
+    print "threaded reads"
+    test_geopackage = EOGeopackage(
+        output_file,
+        "w",
+        "xray",
+        4326,
+        overwrite=True,
+        compression="lz4"
+        )
+    test_geopackage.insert_tiles(test_tiles)
+    test_geopackage.close()
+    for test_col, readers in enumerate(("pool", "immutable")):
+        test_geopackage = EOGeopackage(output_file, "r", readers=readers)
+        errors = []
+        def read_tiles():
+            try:
+                for zoom, row, col, test_data in test_tiles:
+                    np.testing.assert_allclose(
+                        test_geopackage.get_tiledata(zoom, row, col),
+                        test_data
+                        )
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=read_tiles) for i in range(0, 4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        try:
+            assert not errors
+            # Writes still go through the main connection.
+            test_geopackage.insert_tile(zoom, 20, test_col, test_tiles[0][3])
+            test_geopackage.close()
+        except:
+            raise
+
+
+    ################
+    # tile fetcher #
+    ################
+
+    print "tile fetcher"
+    test_fetcher = TileFetcher(output_file, workers=2)
+    # Concurrent requests for one tile share a fetch.
+    fetched = []
+    release = threading.Event()
+    get_tiledata = test_fetcher.geopackage.get_tiledata
+    def blocked_get_tiledata(*key):
+        fetched.append(key)
+        release.wait()
+        return get_tiledata(*key)
+    test_fetcher.geopackage.get_tiledata = blocked_get_tiledata
+    try:
+        test_results = [
+            test_fetcher.fetch_tile(zoom, 0, 1) for i in range(0, 10)
+            ]
+        other_result = test_fetcher.fetch_tile(zoom, 0, 2)
+        release.set()
+        for test_result in test_results:
+            np.testing.assert_allclose(test_result.get(), test_arrays[(0, 1)])
+        np.testing.assert_allclose(other_result.get(), test_arrays[(0, 2)])
+        assert sorted(fetched) == [(zoom, 0, 1), (zoom, 0, 2)]
+        assert test_fetcher.fetch_tile(zoom, 50, 50).get() is None
+        assert len(test_fetcher.fetch_tiles(
+            zoom,
+            range(0, 2),
+            range(0, 3)
+            ).get()) == 6
+        streamed = list(test_fetcher.stream_tiles(
+            zoom,
+            range(0, 3),
+            range(0, tilesize)
+            ))
+        assert [(row, col) for row, col, test_data in streamed] == [
+            (row, col) for row in range(0, 3) for col in range(0, tilesize)
+            ]
+        for row, col, test_data in streamed:
+            np.testing.assert_allclose(test_data, test_arrays[(row, col)])
+    except:
+        raise
+    finally:
+        test_fetcher.close()
+    # The threads need their own connections.
+    try:
+        TileFetcher(output_file, readers=None)
+        raise AssertionError("TileFetcher without reader connections")
+    except AttributeError:
+        pass
+
+
+    ###############
+    # raw storage #
+    ###############
+
+    print "raw storage"
+    for testarray_size in ((255, 255), (255, 255, 3), (255, 255, 3, 10)):
+        raw_tiles = [
+            (zoom, 0, col, np.random.randint(255, size=testarray_size))
+            for col in range(0, 20)
+            ]
+        for compression in (None, "raw"):
+            test_geopackage = EOGeopackage(
+                output_file,
+                "w",
+                "xray",
+                4326,
+                overwrite=True,
+                compression=compression
+                )
+            test_geopackage.insert_tiles(raw_tiles)
+            test_geopackage.close()
+            test_geopackage = EOGeopackage(output_file, "r")
+            for zoom, row, col, test_data in raw_tiles:
+                test_read = test_geopackage.get_tiledata(zoom, row, col)
+        try:
+            assert test_geopackage.compression == "raw"
+            for zoom, row, col, test_data in raw_tiles:
+                test_read = test_geopackage.get_tiledata(zoom, row, col)
+                assert test_read.dtype == test_data.dtype
+                np.testing.assert_array_equal(test_read, test_data)
+            test_geopackage.insert_tile(zoom, 1, 0, np.uint8(test_data))
+            raise AssertionError("raw tile with wrong dtype accepted")
+        except TypeError:
+            pass
+    zoom = 10
+    testarray_size = (255, 255)
+
+
+    ###############
+    # codec layer #
+    ###############
+
+    print "codec options"
+    y, x = np.mgrid[0:255, 0:255]
+    codec_tiles = [
+        (
+            zoom,
+            1,
+            col,
+            (1000 + 3 * x + 2 * y + np.random.randint(8, size=(255, 255))
+                ).astype("uint16")
+            )
+        for col in range(0, 20)
+        ]
+    codecs = [
+        ("lz4", None),
+        ("lz4", {"clevel": 5, "shuffle": "bit", "nthreads": 2}),
+        ("blosc:zstd", {"shuffle": "bit"}),
+        ("blosc:lz4", {"shuffle": "byte", "typesize": 1})
+        ]
+    if utils_geopackage.zstandard:
+        codecs.append(("zstandard", {"shuffle": "byte"}))
+        codecs.append(("zstandard", {"dictionary": True}))
+    for compression, options in codecs:
+        dictionary = options and options.pop("dictionary", None)
+        test_geopackage = EOGeopackage(
+            output_file,
+            "w",
+            "xray",
+            4326,
+            overwrite=True,
+            compression=compression,
+            compression_options=options
+            )
+        if dictionary:
+            test_geopackage.train_dictionary(
+                [test_data for zoom, row, col, test_data in codec_tiles],
+                dict_size=4096
+                )
+        test_geopackage.insert_tiles(codec_tiles)
+        test_geopackage.close()
+        test_geopackage = EOGeopackage(output_file, "r")
+        for zoom, row, col, test_data in codec_tiles:
+            test_read = test_geopackage.get_tiledata(zoom, row, col)
+            np.testing.assert_array_equal(test_read, test_data)
+        try:
+            assert test_geopackage.compression == compression
+            for key, value in (options or {}).items():
+                if key not in runtime_codec_options:
+                    assert test_geopackage.compression_options[key] == value
+            assert bool(dictionary) == (
+                "codec_dictionary" in test_geopackage.metadata
+                )
+        except:
+            raise
+        test_geopackage.close()
+    # Invalid options.
+    for compression, options in (
+        ("lz4", {"level": 5}),
+        ("lz4", {"shuffle": "nibble"}),
+        ("raw", {"clevel": 5})
+        ):
+        try:
+            EOGeopackage(
+                output_file,
+                "w",
+                "xray",
+                4326,
+                overwrite=True,
+                compression=compression,
+                compression_options=options
+                )
+            raise AssertionError("invalid options %s accepted" % options)
+        except AttributeError:
+            pass
+    # snappy of some blosc versions corrupts smooth, noisy tiles; these have
+    # to be read back exactly all the same.
+    y, x = np.mgrid[0:256, 0:256]
+    snappy_tiles = []
+    for col in range(0, 6):
+        terrain = (np.sin((x + 256 * col) / 300.) * np.cos(y / 240.) + 2) / 4
+        test_data = np.dstack([
+            terrain * (1 - 0.1 * band) +
+            np.random.RandomState(col).normal(0, 0.005, (256, 256))
+            for band in range(3)
+            ])
+        snappy_tiles.append((zoom, 1, col, (8000 * test_data).astype("uint16")))
+    for compression in ("snappy", "blosc:snappy"):
+        for shuffle in ("none", "byte", "bit"):
+            test_geopackage = EOGeopackage(
+                output_file,
+                "w",
+                "xray",
+                4326,
+                overwrite=True,
+                compression=compression,
+                compression_options={"shuffle": shuffle}
+                )
+            test_geopackage.insert_tiles(snappy_tiles)
+            test_geopackage.close()
+            test_geopackage = EOGeopackage(output_file, "r")
+            for zoom, row, col, test_data in snappy_tiles:
+                np.testing.assert_array_equal(
+                    test_geopackage.get_tiledata(zoom, row, col),
+                    test_data
+                    )
+            test_geopackage.close()
+
+
+    #############
+    # predictor #
+    #############
+
+    print "predictor"
+    y, x = np.mgrid[0:255, 0:255]
+    smooth = np.sin(x / 40.) * np.cos(y / 30.) + 1
+    for data_type, compression, dtype, predictor in (
+        ("xray", "lz4", "uint16", "horizontal"),
+        ("xray", "zlib", "int32", "horizontal"),
+        ("xray", "raw", "int16", "horizontal"),
+        ("xray", "lz4", "float32", "floating_point"),
+        ("xray", None, "float64", "floating_point"),
+        ("image/TIFF", "tiff_deflate", "uint8", "horizontal")
+        ):
+        amplitude = 100 if dtype == "uint8" else 3000
+        predictor_tiles = [
+            (
+                zoom,
+                1,
+                col,
+                (amplitude * smooth + 4 * np.random.rand(255, 255) + col
+                    ).astype(dtype)
+                )
+            for col in range(0, 20)
+            ]
+        for test_predictor in (None, predictor):
+            test_geopackage = EOGeopackage(
+                output_file,
+                "w",
+                data_type,
+                4326,
+                overwrite=True,
+                compression=compression,
+                predictor=test_predictor
+                )
+            test_geopackage.insert_tiles(predictor_tiles, workers=2)
+            test_geopackage.close()
+        test_geopackage = EOGeopackage(output_file, "r")
+        try:
+            assert test_geopackage.predictor == predictor
+            for zoom, row, col, test_data in predictor_tiles:
+                test_read = test_geopackage.get_tiledata(zoom, row, col)
+                assert test_read.dtype == test_data.dtype
+                np.testing.assert_array_equal(test_read, test_data)
+        except:
+            raise
+        test_geopackage.close()
+    # Predictors only support matching dtypes.
+    test_geopackage = EOGeopackage(
+        output_file,
+        "w",
+        "xray",
+        4326,
+        overwrite=True,
+        compression="lz4",
+        predictor="horizontal"
+        )
+    try:
+        test_geopackage.insert_tile(zoom, 0, 0, smooth)
+        raise AssertionError("float tile accepted by horizontal predictor")
+    except TypeError:
+        pass
+    test_geopackage.close()
+    # A rejected first tile leaves no metadata behind, so the file stays
+    # writable.
+    test_geopackage = EOGeopackage(
+        output_file,
+        "w",
+        "xray",
+        4326,
+        overwrite=True,
+        compression="raw",
+        predictor="horizontal"
+        )
+    try:
+        test_geopackage.insert_tile(zoom, 0, 0, smooth.astype("float32"))
+        raise AssertionError("float tile accepted by horizontal predictor")
+    except TypeError:
+        pass
+    test_data = (3000 * smooth).astype("uint16")
+    test_geopackage.insert_tile(zoom, 0, 0, test_data)
+    try:
+        assert test_geopackage.metadata["dtype"] == "uint16"
+        np.testing.assert_array_equal(
+            test_geopackage.get_tiledata(zoom, 0, 0),
+            test_data
+            )
+    except:
+        raise
+    test_geopackage.close()
+
+
+    ###################
+    # adaptive codecs #
+    ###################
+
+    print "adaptive"
+    y, x = np.mgrid[0:255, 0:255]
+    adaptive_tiles = []
+    for col in range(0, 30):
+        if col % 3 == 0:
+            # nodata
+            test_data = np.zeros((255, 255), dtype="uint16")
+        elif col % 3 == 1:
+            test_data = 3000 * (np.sin(x / 40.) * np.cos(y / 30.) + 1) + col
+        else:
+            test_data = np.random.randint(65535, size=(255, 255))
+        adaptive_tiles.append((zoom, 2, col, test_data.astype("uint16")))
+    for data_type, compression in (
+        ("xray", "lz4"),
+        ("xray", "adaptive"),
+        ("image/TIFF", "tiff_deflate"),
+        ("image/TIFF", "adaptive")
+        ):
+        test_geopackage = EOGeopackage(
+            output_file,
+            "w",
+            data_type,
+            4326,
+            overwrite=True,
+            compression=compression,
+            predictor="horizontal"
+            )
+        test_geopackage.insert_tiles(adaptive_tiles)
+        test_geopackage.close()
+        test_geopackage = EOGeopackage(output_file, "r")
+        for zoom, row, col, test_data in adaptive_tiles:
+            test_read = test_geopackage.get_tiledata(zoom, row, col)
+            np.testing.assert_array_equal(test_read, test_data)
+        codec_usage = None
+        if compression == "adaptive":
+            codec_usage = test_geopackage.codec_usage()
+        try:
+            np.testing.assert_array_equal(
+                test_geopackage.get_window(zoom, (0, 2, 29, 2)),
+                np.hstack([test_data for zoom, row, col, test_data in adaptive_tiles])
+                )
+            if codec_usage:
+                assert codec_usage["constant"] == 10
+                assert sum(codec_usage.values()) == len(adaptive_tiles)
+        except:
+            raise
+        test_geopackage.close()
+    # Candidates must store their tiles in tile_data themselves.
+    try:
+        EOGeopackage(
+            output_file,
+            "w",
+            "xray",
+            4326,
+            overwrite=True,
+            compression="adaptive",
+            compression_options={"candidates": [None, "lz4"]}
+            )
+        raise AssertionError("ARRAY candidate accepted")
+    except AttributeError:
+        pass
+    # Other options are passed to the candidates taking them.
+    test_geopackage = EOGeopackage(
+        output_file,
+        "w",
+        "xray",
+        4326,
+        overwrite=True,
+        compression="adaptive",
+        compression_options={"candidates": ["blosc:zstd", "raw"], "clevel": 1}
+        )
+    test_geopackage.insert_tiles(adaptive_tiles)
+    test_geopackage.close()
+    test_geopackage = EOGeopackage(output_file, "r")
+    try:
+        assert test_geopackage.tag_codecs[1][1]["clevel"] == 1
+        for zoom, row, col, test_data in adaptive_tiles:
+            np.testing.assert_array_equal(
+                test_geopackage.get_tiledata(zoom, row, col),
+                test_data
+                )
+    except:
+        raise
+    test_geopackage.close()
+    try:
+        EOGeopackage(
+            output_file,
+            "w",
+            "xray",
+            4326,
+            overwrite=True,
+            compression="adaptive",
+            compression_options={"candidates": ["raw"], "clevel": 1}
+            )
+        raise AssertionError("option of no candidate accepted")
+    except AttributeError:
+        pass
+    # The sample share of the rows has to be above 0 and at most 1.
+    for sample in (0, -0.5, 1.5):
+        try:
+            EOGeopackage(
+                output_file,
+                "w",
+                "xray",
+                4326,
+                overwrite=True,
+                compression="adaptive",
+                compression_options={"sample": sample}
+                )
+            raise AssertionError("sample %s accepted" % sample)
+        except AttributeError:
+            pass
+    # Arrays no candidate supports are rejected before anything is written.
+    test_geopackage = EOGeopackage(
+        output_file,
+        "w",
+        "image/TIFF",
+        4326,
+        overwrite=True,
+        compression="adaptive"
+        )
+    try:
+        test_geopackage.insert_tile(zoom, 2, 0, np.zeros((255, 255), "int64"))
+        raise AssertionError("int64 tile accepted by image/TIFF adaptive")
+    except TypeError:
+        pass
+    test_geopackage.insert_tiles(adaptive_tiles)
+    try:
+        assert test_geopackage.metadata["dtype"] == "uint16"
+        for zoom, row, col, test_data in adaptive_tiles:
+            np.testing.assert_array_equal(
+                test_geopackage.get_tiledata(zoom, row, col),
+                test_data
+                )
+    except:
+        raise
+    test_geopackage.close()
+    # The candidates are looked up once per file, not per tile.
+    lookups = []
+    original_adaptive_codecs = utils_geopackage.adaptive_codecs
+    def counting_adaptive_codecs(*args):
+        lookups.append(args)
+        return original_adaptive_codecs(*args)
+    utils_geopackage.adaptive_codecs = counting_adaptive_codecs
+    try:
+        test_geopackage = EOGeopackage(
+            output_file,
+            "w",
+            "xray",
+            4326,
+            overwrite=True,
+            compression="adaptive"
+            )
+        test_geopackage.insert_tiles(adaptive_tiles)
+        test_geopackage.close()
+        assert len(lookups) == 1
+    except:
+        raise
+    finally:
+        utils_geopackage.adaptive_codecs = original_adaptive_codecs
+
+
+    #################
+    # deduplication #
+    #################
+
+    print "deduplication"
+    dedup_tiles = []
+    for col in range(0, 40):
+        if col % 4 == 0:
+            # nodata
+            test_data = np.zeros((255, 255), dtype="uint16")
+        elif col % 4 == 1:
+            test_data = np.full((255, 255), 7, dtype="uint16")
+        elif col % 4 == 2:
+            test_data = 3000 * (np.sin(x / 40.) * np.cos(y / 30.) + 1)
+        else:
+            test_data = 3000 * (np.sin(x / 40.) * np.cos(y / 30.) + 1) + col
+        dedup_tiles.append((zoom, 3, col, test_data.astype("uint16")))
+    for data_type, compression, dedup, workers in (
+        ("xray", "lz4", False, 1),
+        ("xray", "lz4", True, 1),
+        ("xray", None, True, 2),
+        ("xray", "adaptive", True, 2),
+        ("image/TIFF", "tiff_deflate", True, 2)
+        ):
+        test_geopackage = EOGeopackage(
+            output_file,
+            "w",
+            data_type,
+            4326,
+            overwrite=True,
+            compression=compression,
+            dedup=dedup
+            )
+        test_geopackage.insert_tiles(dedup_tiles[:20], workers=workers)
+        test_geopackage.insert_tile(*dedup_tiles[20])
+        test_geopackage.insert_tiles(dedup_tiles[21:], workers=workers)
+        test_geopackage.close()
+        test_geopackage = EOGeopackage(output_file, "r")
+        for zoom, row, col, test_data in dedup_tiles:
+            test_read = test_geopackage.get_tiledata(zoom, row, col)
+            np.testing.assert_array_equal(test_read, test_data)
+        np.testing.assert_array_equal(
+            test_geopackage.get_window(zoom, (0, 3, 39, 3)),
+            np.hstack([test_data for zoom, row, col, test_data in dedup_tiles])
+            )
+        if dedup:
+            cursor = test_geopackage.db_connection.cursor()
+            cursor.execute("SELECT COUNT(*) FROM tile_blobs;")
+            blobs = cursor.fetchone()[0]
+            blob_cache = test_geopackage.blob_cache.stats()
+            try:
+                # One blob for the repeated tile, ten for the shifted ones,
+                # none for the constant tiles.
+                assert blobs == 11
+                # Every blob and fill value was decoded once.
+                assert blob_cache["misses"] == 13
+            except:
+                raise
+        test_geopackage.close()
+    # Blobs of a rolled back batch are written again.
+    test_geopackage = EOGeopackage(
+        output_file,
+        "w",
+        "xray",
+        4326,
+        overwrite=True,
+        compression="lz4",
+        dedup=True
+        )
+    test_geopackage.insert_tiles(dedup_tiles[:2])
+    try:
+        test_geopackage.insert_tiles([dedup_tiles[2], dedup_tiles[0]])
+        raise AssertionError("existing tile inserted")
+    except sqlite3.IntegrityError:
+        pass
+    test_geopackage.insert_tiles(dedup_tiles[2:4])
+    for zoom, row, col, test_data in dedup_tiles[:4]:
+        test_read = test_geopackage.get_tiledata(zoom, row, col)
+        np.testing.assert_array_equal(test_read, test_data)
+    # Tiles of deduplicated files need the same dtype and shape.
+    try:
+        test_geopackage.insert_tile(zoom, 4, 0, np.zeros((2, 2), "uint16"))
+        raise AssertionError("tile of different shape inserted")
+    except TypeError:
+        pass
+    test_geopackage.close()
+
+
+    ###########
+    # chunked #
+    ###########
+
+    print "chunked time series"
+    time_series_tiles = [
+        (
+            zoom,
+            4,
+            col,
+            np.random.randint(3000, size=(255, 255, 3, 10)).astype("uint16")
+            )
+        for col in range(0, 10)
+        ]
+    for chunked in (False, True):
+        test_geopackage = EOGeopackage(
+            output_file,
+            "w",
+            "xray",
+            4326,
+            overwrite=True,
+            compression="lz4",
+            chunked=chunked
+            )
+        test_geopackage.insert_tiles(time_series_tiles, workers=2)
+        test_geopackage.close()
+        test_geopackage = EOGeopackage(output_file, "r")
+        assert test_geopackage.chunked == chunked
+        for zoom, row, col, test_data in time_series_tiles:
+            test_read = test_geopackage.get_tiledata(zoom, row, col)
+            np.testing.assert_array_equal(test_read, test_data)
+        for zoom, row, col, test_data in time_series_tiles:
+            test_read = test_geopackage.get_tiledata(
+                zoom,
+                row,
+                col,
+                time=3,
+                bands=[2]
+                )
+            np.testing.assert_array_equal(test_read, test_data[:, :, [2], 3])
+        for time, bands in (
+            (slice(2, 5), None),
+            (-1, 1),
+            ([4, 0, 4], slice(1, None))
+            ):
+            np.testing.assert_array_equal(
+                test_geopackage.get_tiledata(
+                    zoom,
+                    row,
+                    col,
+                    time=time,
+                    bands=bands
+                    ),
+                test_data[:, :, :, time][:, :, bands or slice(None)]
+                )
+        # Empty selections return empty arrays.
+        for time, bands, shape in (
+            ([], None, (255, 255, 3, 0)),
+            (None, [], (255, 255, 0, 10)),
+            (2, [], (255, 255, 0))
+            ):
+            test_read = test_geopackage.get_tiledata(
+                zoom,
+                row,
+                col,
+                time=time,
+                bands=bands
+                )
+            try:
+                assert test_read.shape == shape
+                assert test_read.dtype == test_data.dtype
+            except:
+                raise
+        np.testing.assert_array_equal(
+            test_geopackage.get_window(zoom, (0, 4, 9, 4)),
+            np.hstack([test_data for zoom, row, col, test_data in time_series_tiles])
+            )
+        test_geopackage.close()
+    # Tiles missing chunks raise an IOError.
+    test_geopackage = EOGeopackage(output_file, "r")
+    with test_geopackage.db_connection as db_connection:
+        db_connection.execute("""
+            DELETE FROM tiles WHERE zoom_level=? AND tile_row=4 AND
+            tile_column=0 AND tile_time=2 AND tile_band=1;
+            """, (zoom, ))
+    for time in (None, 2, slice(1, 3)):
+        try:
+            test_geopackage.get_tiledata(zoom, 4, 0, time=time)
+            raise AssertionError("tile missing a chunk returned")
+        except IOError:
+            pass
+    np.testing.assert_array_equal(
+        test_geopackage.get_tiledata(zoom, 4, 0, time=3),
+        time_series_tiles[0][3][:, :, :, 3]
+        )
+    test_geopackage.close()
+    # Chunked tiles with bands but without time axis.
+    test_geopackage = EOGeopackage(
+        output_file,
+        "w",
+        "image/TIFF",
+        4326,
+        overwrite=True,
+        compression="tiff_deflate",
+        chunked=True
+        )
+    test_data = np.random.randint(255, size=(255, 255, 4)).astype("uint8")
+    test_geopackage.insert_tile(zoom, 0, 0, test_data)
+    np.testing.assert_array_equal(
+        test_geopackage.get_tiledata(zoom, 0, 0, bands=3),
+        test_data[:, :, 3]
+        )
+    try:
+        test_geopackage.get_tiledata(zoom, 0, 0, time=0)
+        raise AssertionError("time slice of 3D tile returned")
+    except IndexError:
+        pass
+    try:
+        test_geopackage.insert_tile(zoom, 0, 1, test_data[:, :, :3])
+        raise AssertionError("tile with different bands inserted")
+    except TypeError:
+        pass
+    test_geopackage.close()
+
+
+    ######################
+    # append time slices #
+    ######################
+
+    print "append time slices"
+    test_geopackage = EOGeopackage(
+        output_file,
+        "w",
+        "xray",
+        4326,
+        overwrite=True,
+        compression="lz4",
+        chunked=True,
+        cache_size=64*1024*1024
+        )
+    test_data = time_series_tiles[0][3]
+    test_geopackage.insert_tile(zoom, 0, 0, test_data)
+    test_geopackage.get_tiledata(zoom, 0, 0)
+    for day in range(1, 21):
+        time_slice = np.random.randint(3000, size=(255, 255, 3)).astype("uint16")
+        time = test_geopackage.append_time_slice(
+            zoom,
+            0,
+            0,
+            time_slice,
+            datetime(2016, 1, day)
+            )
+        assert time == 9 + day
+    # Cached tile is replaced.
+    test_read = test_geopackage.get_tiledata(zoom, 0, 0)
+    assert test_read.shape == (255, 255, 3, 30)
+    np.testing.assert_array_equal(test_read[:, :, :, :10], test_data)
+    np.testing.assert_array_equal(test_read[:, :, :, -1], time_slice)
+    timestamps = test_geopackage.get_timestamps(zoom, 0, 0)
+    assert timestamps[:10] == [None] * 10
+    assert timestamps[10] == "2016-01-01T00:00:00"
+    assert timestamps[-1] == "2016-01-20T00:00:00"
+    # New tiles are created from their first time slice.
+    assert test_geopackage.append_time_slice(
+        zoom, 0, 1, time_slice, "2016-01-20"
+        ) == 0
+    np.testing.assert_array_equal(
+        test_geopackage.get_tiledata(zoom, 0, 1, time=0),
+        time_slice
+        )
+    try:
+        test_geopackage.append_time_slice(
+            zoom, 0, 1, time_slice[:, :, :2], "2016-01-21"
+            )
+        raise AssertionError("time slice with different bands appended")
+    except TypeError:
+        pass
+    test_geopackage.close()
+    # Tiles without time axis cannot get time slices.
+    test_geopackage = EOGeopackage(
+        output_file,
+        "w",
+        "xray",
+        4326,
+        overwrite=True,
+        compression="lz4",
+        chunked=True
+        )
+    test_geopackage.insert_tile(zoom, 0, 0, time_slice)
+    try:
+        test_geopackage.append_time_slice(zoom, 0, 0, time_slice, "2016-01-21")
+        raise AssertionError("time slice appended to tiles without time axis")
+    except TypeError as e:
+        assert "no time axis" in str(e)
+    test_geopackage.close()
+
+
+    ############################
+    # conflicts and change log #
+    ############################
+
+    print "conflicts and change log"
+    for options in (
+        {"compression": "lz4"},
+        {"compression": "lz4", "dedup": True},
+        {"compression": "lz4", "chunked": True}
+        ):
+        test_geopackage = EOGeopackage(
+            output_file,
+            "w",
+            "xray",
+            4326,
+            overwrite=True,
+            change_log=True,
+            cache_size=64*1024*1024,
+            **options
+            )
+        base_tiles = [
+            (zoom, row, col, np.random.randint(3000, size=(64, 64)))
+            for row in range(0, 4)
+            for col in range(0, 4)
+            ]
+        test_geopackage.insert_tiles(base_tiles)
+        test_geopackage.build_pyramid(zoom, zoom - 2)
+        since = test_geopackage.get_changes()[-1][0]
+        updated_tiles = [
+            (zoom, 0, col, np.random.randint(3000, size=(64, 64)))
+            for col in range(0, 2)
+            ]
+        test_geopackage.get_tiledata(zoom, 0, 0)
+        try:
+            test_geopackage.insert_tiles(updated_tiles)
+            raise AssertionError("existing tiles inserted")
+        except sqlite3.IntegrityError:
+            pass
+        test_geopackage.insert_tiles(updated_tiles, on_conflict="skip")
+        np.testing.assert_array_equal(
+            test_geopackage.get_tiledata(zoom, 0, 0),
+            base_tiles[0][3]
+            )
+        assert test_geopackage.get_changes(since) == []
+        test_geopackage.insert_tiles(updated_tiles, on_conflict="replace")
+        np.testing.assert_array_equal(
+            test_geopackage.get_tiledata(zoom, 0, 0),
+            updated_tiles[0][3]
+            )
+        assert [
+            change[1:] for change in test_geopackage.get_changes(since)
+            ] == [(zoom, 0, 0), (zoom, 0, 1)]
+        # Only the parents of the replaced tiles are computed again.
+        since = test_geopackage.update_pyramid(zoom, zoom - 2, since=since)
+        assert [
+            change[1:] for change in test_geopackage.get_changes(since)
+            ] == [(zoom - 1, 0, 0), (zoom - 2, 0, 0)]
+        children = dict(
+            ((row, col), data)
+            for zoom, row, col, data in updated_tiles + base_tiles[4:6]
+            )
+        np.testing.assert_array_equal(
+            test_geopackage.get_tiledata(zoom - 1, 0, 0),
+            downsample_tiles(children)
+            )
+        test_geopackage.clear_changes(since)
+        assert len(test_geopackage.get_changes()) == 2
+        test_geopackage.optimize()
+        if test_geopackage.dedup:
+            cursor = test_geopackage.db_connection.cursor()
+            cursor.execute("SELECT COUNT(*) FROM tile_blobs;")
+            assert cursor.fetchone()[0] == 16 + 4 + 1
+        test_geopackage.close()
+        test_geopackage = EOGeopackage(output_file, "r")
+        assert test_geopackage.change_log
+        assert len(test_geopackage.get_changes()) == 2
+        test_geopackage.close()
+    try:
+        EOGeopackage(
+            output_file,
+            "w",
+            "xray",
+            4326,
+            overwrite=True,
+            on_conflict="update"
+            )
+        raise AssertionError("unknown on_conflict accepted")
+    except AttributeError:
+        pass
+
+
+    #################
+    # opening files #
+    #################
+
+    print "opening files"
+    test_geopackage = EOGeopackage(
+        output_file,
+        "w",
+        "xray",
+        4326,
+        overwrite=True,
+        compression="lz4"
+        )
+    test_data = np.random.randint(3000, size=(255, 255)).astype("uint16")
+    test_geopackage.insert_tile(zoom, 0, 0, test_data)
+    test_geopackage.close()
+    # Read mode opens a single connection.
+    connections = []
+    def counting_connect(*args, **kwargs):
+        connections.append(args)
+        return connect(*args, **kwargs)
+    utils_geopackage.connect = counting_connect
+    try:
+        test_geopackage = EOGeopackage(output_file, "r")
+        np.testing.assert_array_equal(
+            test_geopackage.get_tiledata(zoom, 0, 0),
+            test_data
+            )
+        test_geopackage.close()
+    finally:
+        utils_geopackage.connect = connect
+    assert len(connections) == 1
+    test_geopackage = EOGeopackage(output_file, "r", profile="serve")
+    np.testing.assert_array_equal(
+        test_geopackage.get_tiledata(zoom, 0, 0),
+        test_data
+        )
+    test_geopackage.close()
+    # Files missing GeoPackage tables are rejected.
+    test_connection = connect(output_file)
+    test_connection.execute("DROP TABLE gpkg_geometry_columns;")
+    test_connection.commit()
+    test_connection.close()
+    assert utils_geopackage.schema_is_ok(output_file) == "gpkg_geometry_columns"
+    try:
+        EOGeopackage(output_file, "r")
+        raise AssertionError("invalid file opened")
+    except IOError:
+        pass
+    # Files failing validation are closed again.
+    test_geopackage = EOGeopackage(
+        output_file,
+        "w",
+        "xray",
+        4326,
+        overwrite=True,
+        compression="lz4"
+        )
+    test_geopackage.insert_tile(zoom, 0, 0, test_data)
+    test_geopackage.close()
+    test_connection = connect(output_file)
+    test_connection.execute("""
+        UPDATE gpkgx_tile_metadata SET value='"unknown"' WHERE key='predictor';
+        """)
+    test_connection.commit()
+    test_connection.close()
+    connections = []
+    def recording_connect(*args, **kwargs):
+        connections.append(connect(*args, **kwargs))
+        return connections[-1]
+    utils_geopackage.connect = recording_connect
+    try:
+        EOGeopackage(output_file, "r")
+        raise AssertionError("file with unknown predictor opened")
+    except AttributeError:
+        pass
+    finally:
+        utils_geopackage.connect = connect
+    for test_connection in connections:
+        try:
+            test_connection.cursor()
+            raise AssertionError("connection left open")
+        except sqlite3.ProgrammingError:
+            pass
+
+
+
+    ############
+    # coverage #
+    ############
+
+    print "coverage"
+    test_geopackage = EOGeopackage(
+        output_file,
+        "w",
+        "xray",
+        4326,
+        overwrite=True,
+        compression="lz4"
+        )
+    test_data = np.random.randint(3000, size=(64, 64)).astype("uint16")
+    keys = [(2, 3), (2, 5), (4, 4), (7, 1)]
+    test_geopackage.insert_tiles(
+        (zoom, row, col, test_data) for row, col in keys
+        )
+    assert test_geopackage.get_tiledata(zoom, 0, 0) is None
+    assert test_geopackage.has_tile(zoom, 2, 3)
+    assert not test_geopackage.has_tile(zoom, 2, 4)
+    assert not test_geopackage.has_tile(zoom + 1, 2, 3)
+    assert list(test_geopackage.iter_tile_keys(zoom)) == keys
+    assert list(test_geopackage.iter_tile_keys(zoom, (3, 0, 5, 4))) == [
+        (2, 3), (2, 5), (4, 4)
+        ]
+    assert list(test_geopackage.iter_tile_keys(zoom + 1)) == []
+    # Tiles written after the coverage was loaded extend it.
+    test_geopackage.insert_tile(zoom, 9, 0, test_data)
+    assert test_geopackage.has_tile(zoom, 9, 0)
+    assert test_geopackage.get_tiledata(zoom, 9, 1) is None
+    test_geopackage.close()
+    test_geopackage = EOGeopackage(output_file, "r")
+    assert list(test_geopackage.iter_tile_keys(zoom)) == keys + [(9, 0)]
+    test_geopackage.close()
+    # Coverage stored before tiles were written is built again.
+    test_geopackage = EOGeopackage(
+        output_file,
+        "w",
+        "xray",
+        4326,
+        compression="lz4"
+        )
+    test_geopackage.insert_tile(zoom, 0, 0, test_data)
+    test_geopackage.close()
+    test_geopackage = EOGeopackage(output_file, "r")
+    assert test_geopackage.has_tile(zoom, 0, 0)
+    np.testing.assert_array_equal(
+        test_geopackage.get_tiledata(zoom, 0, 0),
+        test_data
+        )
+    assert len(list(test_geopackage.iter_tile_keys(zoom))) == 6
+    test_geopackage.close()
+    test_geopackage = EOGeopackage(
+        output_file,
+        "w",
+        "xray",
+        4326,
+        overwrite=True,
+        chunked=True
+        )
+    test_geopackage.insert_tile(zoom, 1, 1, np.zeros((8, 8, 2), "uint16"))
+    assert test_geopackage.get_tiledata(zoom, 1, 2) is None
+    assert test_geopackage.get_tiledata(zoom, 1, 2, bands=[0]) is None
+    test_geopackage.close()
+    # Far apart tiles only allocate their blocks.
+    test_coverage = TileCoverage()
+    far_keys = [(0, 0), (0, 2 ** 15 - 1), (2 ** 14 - 1, 300)]
+    for row, col in far_keys:
+        test_coverage.add(row, col)
+    assert len(test_coverage.blocks) == 3
+    assert sum(block.nbytes for block in test_coverage.blocks.values()) == (
+        3 * 256 * 256 // 8
+        )
+    assert len(test_coverage) == 3
+    assert (2 ** 14 - 1, 300) in test_coverage
+    assert (2 ** 14 - 1, 301) not in test_coverage
+    assert list(test_coverage.keys()) == far_keys
+    assert list(test_coverage.keys((1, 0, 2 ** 15, 2 ** 14))) == far_keys[1:]
+    test_coverage = TileCoverage.from_bitmaps(test_coverage.bitmaps())
+    assert list(test_coverage.keys()) == far_keys
+    test_coverage = TileCoverage.from_keys(
+        np.array([row for row, col in far_keys]),
+        np.array([col for row, col in far_keys])
+        )
+    assert list(test_coverage.keys()) == far_keys
+
+
+
+    #################
+    # tile iterator #
+    #################
+
+    print "tile iterator"
+    assert [
+        hilbert_index(1, row, col) for row, col in ((0, 0), (1, 0), (1, 1), (0, 1))
+        ] == [0, 1, 2, 3]
+    assert sorted(
+        hilbert_index(3, row, col) for row in range(8) for col in range(8)
+        ) == range(64)
+    for options in ({}, {"dedup": True}, {"chunked": True}):
+        test_geopackage = EOGeopackage(
+            output_file,
+            "w",
+            "xray",
+            4326,
+            overwrite=True,
+            compression="lz4",
+            **options
+            )
+        tiles = dict(
+            ((zoom, row, col), np.random.randint(3000, size=(16, 16, 2)))
+            for zoom in (1, 2)
+            for row in range(0, 2 ** zoom)
+            for col in range(0, 2 ** (zoom + 1))
+            )
+        tiles[(2, 0, 0)] = np.zeros((16, 16, 2), "int64")
+        test_geopackage.insert_tiles(
+            zoom_row_col + (data, ) for zoom_row_col, data in tiles.items()
+            )
+        rowmajor = list(test_geopackage.iter_tiles(order="rowmajor"))
+        assert [tile[:3] for tile in rowmajor] == sorted(tiles)
+        for zoom, row, col, data in rowmajor:
+            np.testing.assert_array_equal(data, tiles[(zoom, row, col)])
+        hilbert = list(
+            test_geopackage.iter_tiles(2, workers=3, batch_size=5)
+            )
+        assert [tile[:3] for tile in hilbert] == sorted(
+            (key for key in tiles if key[0] == 2),
+            key=lambda key: hilbert_index(3, key[1], key[2])
+            )
+        for zoom, row, col, data in hilbert:
+            np.testing.assert_array_equal(data, tiles[(zoom, row, col)])
+        encoded = list(test_geopackage.iter_tiles(1, decode=False))
+        assert len(encoded) == 8
+        if test_geopackage.chunked:
+            assert [key for key, value in encoded[0][3]] == [(0, 0), (0, 1)]
+        else:
+            assert isinstance(encoded[0][3], str)
+        assert list(test_geopackage.iter_tiles(5)) == []
+        test_geopackage.close()
+    try:
+        list(test_geopackage.iter_tiles(order="zorder"))
+        raise AssertionError("unknown order accepted")
+    except AttributeError:
+        pass
+
+
+
+    ###################
+    # clustered tiles #
+    ###################
+
+    print "clustered tiles"
+    assert [
+        morton_index(1, row, col) for row, col in ((0, 0), (0, 1), (1, 0), (1, 1))
+        ] == [0, 1, 2, 3]
+    assert tile_key("hilbert", 3, 5, 2) == (3 << 56) + hilbert_index(4, 5, 2)
+    assert tile_key("morton", 3, 5, 2) == (3 << 56) + 0b100110
+    for layout, options in (
+        ("hilbert", {}),
+        ("morton", {"compression": "adaptive"}),
+        ("hilbert", {"dedup": True})
+        ):
+        test_geopackage = EOGeopackage(
+            output_file,
+            "w",
+            "xray",
+            4326,
+            overwrite=True,
+            layout=layout,
+            **options
+            )
+        tiles = dict(
+            ((zoom, row, col), np.random.randint(3000, size=(16, 16)))
+            for zoom in (1, 2)
+            for row in range(0, 2 ** zoom)
+            for col in range(0, 2 ** (zoom + 1))
+            )
+        test_geopackage.insert_tiles(
+            zoom_row_col + (data, ) for zoom_row_col, data in tiles.items()
+            )
+        test_geopackage.insert_tiles(
+            [(2, 0, 0, tiles[(2, 0, 0)])],
+            on_conflict="replace"
+            )
+        cursor = test_geopackage.db_connection.cursor()
+        cursor.execute("SELECT id, zoom_level, tile_row, tile_column FROM tiles;")
+        for tile_id, zoom, row, col in cursor.fetchall():
+            assert tile_id == tile_key(layout, zoom, row, col)
+        assert test_geopackage.has_tile(2, 3, 7)
+        test_geopackage.close()
+        test_geopackage = EOGeopackage(output_file, "r")
+        assert test_geopackage.layout == layout
+        window = test_geopackage.get_window(2, (0, 0, 7, 3))
+        for zoom, row, col in tiles:
+            if zoom == 2:
+                np.testing.assert_array_equal(
+                    window[row*16:(row+1)*16, col*16:(col+1)*16],
+                    tiles[(zoom, row, col)]
+                    )
+        assert [
+            tile[:3] for tile in test_geopackage.iter_tiles(order="hilbert")
+            ] == sorted(
+                tiles,
+                key=lambda key: (key[0], hilbert_index(key[0] + 1, *key[1:]))
+                )
+        test_geopackage.close()
+    try:
+        EOGeopackage(
+            output_file,
+            "w",
+            "xray",
+            4326,
+            overwrite=True,
+            chunked=True,
+            layout="hilbert"
+            )
+        raise AssertionError("chunked file with clustered layout created")
+    except AttributeError:
+        pass
+    # Curve positions above zoom 27 would overflow into the zoom level.
+    try:
+        tile_key("morton", 28, 0, 1 << 28)
+        raise AssertionError("tile key above zoom 27 accepted")
+    except AttributeError:
+        pass
+    test_geopackage = EOGeopackage(
+        output_file,
+        "w",
+        "xray",
+        4326,
+        overwrite=True,
+        layout="morton"
+        )
+    try:
+        test_geopackage.insert_tile(28, 0, 0, np.zeros((16, 16)))
+        raise AssertionError("tile above zoom 27 written")
+    except AttributeError:
+        pass
+    test_geopackage.close()
+
+
     ########
     # XRAY #
     ########
@@ -205,31 +2050,15 @@ def run_tests(output_file):
         zoom = 10
 
         # Write data.
-        start = datetime.now()
         for row in range(0, tilesize):
             for col in range(0, tilesize):
                 test_data = np.random.randint(255, size=testarray_size)
                 test_geopackage.insert_tile(zoom, row, col, test_data)
-        finish = datetime.now()
-        write_time = (finish - start).total_seconds()
 
         # Read data.
-        start = datetime.now()
         for row in range(0, tilesize):
             for col in range(0, tilesize):
                 test_data = test_geopackage.get_tiledata(zoom, row, col)
-        finish = datetime.now()
-        read_time = (finish - start).total_seconds()
-
-        # Get file size.
-        filestat = os.stat(output_file)
-        filesize = filestat.st_size
-        filesize_mb = filesize/1024
-        print "'%s', %s, %s, %s" %(
-            compression,
-            filesize_mb,
-            write_time,
-            read_time)
 
         # Test read data.
         test_data = np.random.randint(255, size=testarray_size)
@@ -254,8 +2083,11 @@ def run_tests(output_file):
     test_geopackage = EOGeopackage(output_file, 'r')
     assert test_geopackage.srs == 4326
     assert test_geopackage.data_type == "xray"
-    # TODO: test failing!
-    # assert isinstance(test_geopackage.get_tiledata(zoom, row, col), np.ndarray)
+    assert test_geopackage.compression == "zlib"
+    assert test_geopackage.metadata["tile_shape"] == list(testarray_size)
+    test_read = test_geopackage.get_tiledata(zoom, row, col)
+    assert isinstance(test_read, np.ndarray)
+    np.testing.assert_allclose(test_read, test_data)
 
 
     # RGB #
@@ -289,31 +2121,15 @@ def run_tests(output_file):
         zoom = 10
 
         # Write data.
-        start = datetime.now()
         for row in range(0, tilesize):
             for col in range(0, tilesize):
                 test_data = np.random.randint(255, size=testarray_size)
                 test_geopackage.insert_tile(zoom, row, col, test_data)
-        finish = datetime.now()
-        write_time = (finish - start).total_seconds()
 
         # Read data.
-        start = datetime.now()
         for row in range(0, tilesize):
             for col in range(0, tilesize):
                 test_data = test_geopackage.get_tiledata(zoom, row, col)
-        finish = datetime.now()
-        read_time = (finish - start).total_seconds()
-
-        # Get file size.
-        filestat = os.stat(output_file)
-        filesize = filestat.st_size
-        filesize_mb = filesize/1024
-        print "'%s', %s, %s, %s" %(
-            compression,
-            filesize_mb,
-            write_time,
-            read_time)
 
         # Test read data.
         test_data = np.random.randint(255, size=testarray_size)
@@ -338,8 +2154,11 @@ def run_tests(output_file):
     test_geopackage = EOGeopackage(output_file, 'r')
     assert test_geopackage.srs == 4326
     assert test_geopackage.data_type == "xray"
-    # TODO: test failing!
-    # assert isinstance(test_geopackage.get_tiledata(zoom, row, col), np.ndarray)
+    assert test_geopackage.compression == "zlib"
+    assert test_geopackage.metadata["tile_shape"] == list(testarray_size)
+    test_read = test_geopackage.get_tiledata(zoom, row, col)
+    assert isinstance(test_read, np.ndarray)
+    np.testing.assert_allclose(test_read, test_data)
 
 
     # RGB 3D #
@@ -373,16 +2192,12 @@ def run_tests(output_file):
         zoom = 10
 
         # Write data.
-        start = datetime.now()
         for row in range(0, tilesize):
             for col in range(0, tilesize):
                 test_data = np.random.randint(255, size=testarray_size)
                 test_geopackage.insert_tile(zoom, row, col, test_data)
-        finish = datetime.now()
-        write_time = (finish - start).total_seconds()
 
         # Read data.
-        start = datetime.now()
         for row in range(0, tilesize):
             for col in range(0, tilesize):
                 test_data = test_geopackage.get_tiledata(zoom, row, col)
@@ -390,18 +2205,6 @@ def run_tests(output_file):
                     i
                     for i in test_data
                     ]
-        finish = datetime.now()
-        read_time = (finish - start).total_seconds()
-
-        # Get file size.
-        filestat = os.stat(output_file)
-        filesize = filestat.st_size
-        filesize_mb = filesize/1024
-        print "'%s', %s, %s, %s" %(
-            compression,
-            filesize_mb,
-            write_time,
-            read_time)
 
         # Test read data.
         test_data = np.random.randint(255, size=testarray_size)
@@ -426,8 +2229,11 @@ def run_tests(output_file):
     test_geopackage = EOGeopackage(output_file, 'r')
     assert test_geopackage.srs == 4326
     assert test_geopackage.data_type == "xray"
-    # TODO: test failing!
-    # assert isinstance(test_geopackage.get_tiledata(zoom, row, col), np.ndarray)
+    assert test_geopackage.compression == "zlib"
+    assert test_geopackage.metadata["tile_shape"] == list(testarray_size)
+    test_read = test_geopackage.get_tiledata(zoom, row, col)
+    assert isinstance(test_read, np.ndarray)
+    np.testing.assert_allclose(test_read, test_data)
 
 
 def schema_is_ok(geopackage):
@@ -2,33 +2,66 @@
 
 # Parts of this tool were taken from https://github.com/GitHubRGI/geopackage-python
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from functools import partial
+from itertools import groupby
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
 from sqlite3 import connect
 import sqlite3
+import copy
+import json
+import threading
 import numpy as np
 import os
 import io
+import base64
+import hashlib
+import numbers
+import struct
+import zlib
 import blosc
 from sqlite3 import Binary
-from PIL import Image, TiffImagePlugin
+from PIL import Image
 try:
     from cStringIO import StringIO as ioBuffer
 except ImportError:
     from io import BytesIO as ioBuffer
+try:
+    from urllib import pathname2url
+except ImportError:
+    from urllib.request import pathname2url
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import imagecodecs
+except ImportError:
+    imagecodecs = None
 
 class EOGeopackage():
     """
     The EOGeopackage class helps to create and modify a EO Geopackage file.
     Parameters:
     - file_path: path to .gpkgx file to be created or modified
-    - data_type: either "image/TIFF" for standard 2D images or "xray" for
-      multidimensional arrays
+    - data_type: "image/TIFF" for 2D images with any number of bands, "xray"
+      for multidimensional arrays or one of the lossless image formats
+      "image/PNG" (uint8 with 1, 3 or 4 bands, uint16 with 1 band),
+      "image/WebP" (uint8 with 1 or 3 bands) and "image/JPEG2000"
+      (reversible; uint8 with 1, 3 or 4 bands, uint16 with 1 band)
     - srs: please use 4326 (WGS84 Geographic Projection), support for 3857
       (Google Spherical Mercator) will be added.
     - overwrite: either False (just insert tiles which don't yet exist) or True
-      (delete source file first).
-    - compression: compression used.
-      - image/TIFF supported compressions:
+      (delete source file first). Existing files have to be opened with the
+      settings they were written with (data_type, srs, compression,
+      compression_options, predictor, dedup, chunked, change_log, layout),
+      otherwise an AttributeError is raised. A stored zstandard dictionary
+      is used unless another one is given, which raises an AttributeError.
+    - compression: compression used, the codecs for each data_type and
+      compression are registered in tile_codecs (see TileCodec).
+      - image/TIFF supported compressions (tiles of the dtypes in
+        tiff_sample_formats with any number of bands, see encode_tiff()):
         # - tiff_ccitt
         # - group3
         # - group4
@@ -39,13 +72,95 @@ class EOGeopackage():
         # - tiff_sgilog
         # - tiff_sgilog24
         # - tiff_raw_16
-        - tiff_lzw
+        - tiff_lzw (needs imagecodecs, otherwise only uint8 tiles with 1, 3
+          or 4 bands)
+        - tiff_zstd (needs the zstandard package)
       - xray supported compressions (default=lz4):
         - blosclz
         - lz4
         - lz4hc
-        - snappy
+        - snappy (also blosc:snappy; tiles which are not decoded exactly are
+          stored with lz4, see blosc_verified)
         - zlib
+        - raw (uncompressed, stores only the array bytes while dtype and shape
+          are stored once in the metadata; all tiles need the same dtype and
+          shape)
+        - blosc:<cname> for every compressor of blosc.cnames (e.g. blosc:zstd;
+          stores the compressed array bytes only, like raw)
+        - zstandard (zstd frames of the array bytes, like raw; optionally using
+          a dictionary, see train_dictionary(); needs the zstandard package)
+      - xray and image/TIFF:
+        - adaptive: every tile is stored with the smallest of the candidate
+          compressions; its index is kept in the tile_codec column of the
+          tiles table (see codec_usage())
+        - constant: tiles with a single value, stored as that value only
+    - compression_options: codec settings, missing ones are taken from the
+      codec defaults; for blosc and zstandard compressions:
+      - clevel: compression level (default: 9, zstandard: 3)
+      - shuffle: "none", "byte" or "bit" (bit only for blosc codecs; default:
+        byte, zstandard: none)
+      - typesize: bytes per element used for shuffling (default: itemsize of
+        the tile dtype; blosc: codecs and zstandard only)
+      - nthreads: number of threads compressing and decompressing a tile;
+        not stored in the file and also taken in mode r
+      image/PNG takes compress_level (0-9, default: 6), image/WebP takes
+      method (0-6, default: 4).
+      adaptive takes candidates (compressions tried on every tile, default:
+      lz4, blosc:zstd and raw for xray, tiff_deflate and None for image/TIFF),
+      constant (store single value tiles as constant, default: True) and
+      sample (share of the tile rows compressed to pick the codec, above 0
+      and at most 1, default: 0.25); the other options are passed to the
+      candidates taking them (e.g. clevel) and must be taken by at least one
+      candidate.
+      The settings except nthreads are stored in the file and used again
+      when it is read.
+    - predictor: filter applied to the tiles before they are compressed (see
+      apply_predictor()) and reversed when they are read:
+      - None
+      - horizontal: differences between neighbouring values (TIFF predictor
+        2, integer dtypes)
+      - floating_point: differences between the reordered bytes of the values
+        (TIFF predictor 3, float dtypes)
+      TIFF tiles store the predictor in the Predictor tag.
+    - cache_size: if given, decoded tiles read by get_tiledata() are kept in an
+      LRU cache holding up to cache_size bytes of arrays (see TileCache).
+    - profile: SQLite settings applied to the connection, either the name of
+      a profile in sqlite_profiles or a dictionary of PRAGMAs:
+      - ingest: write-ahead log, relaxed syncing, large page size (only for
+        new files) and a large page cache. Call optimize() when the ingest
+        is done.
+      - serve: read only connection (mode "r" only) using memory mapped I/O
+        and a large page cache.
+    - readers: how tiles are read:
+      - None: reads share the connection used for writing
+      - pool: every thread reads through its own read only connection, so
+        that an EOGeopackage object can be shared between threads
+      - immutable: like pool, but connections are opened as immutable which
+        skips all locking; the file must not be changed while it is open
+        (mode "r" only). Needs sqlite3 URI support (Python 3), otherwise it
+        is the same as pool.
+    - dedup: if True, every distinct tile is encoded and stored only once in
+      the tile_blobs table and referenced by its content hash, constant tiles
+      are stored as their fill value without a blob. All tiles need the same
+      dtype and shape. Decoded blobs are kept in blob_cache (cache_size or
+      dedup_cache_size bytes) and shared as read-only arrays.
+    - chunked: if True, every band and time slice of a tile of shape (height,
+      width[, bands[, time]]) is compressed and stored as separate 2D chunk
+      (tile_time and tile_band columns), so get_tiledata() can decode single
+      bands and time slices and append_time_slice() can add time slices. All
+      tiles need the same dtype, width, height and number of bands.
+    - on_conflict: what inserting an existing tile does, unless given when
+      inserting (see conflict_clauses):
+      - error: raises sqlite3.IntegrityError and rolls back the batch
+      - skip: keeps the existing tile
+      - replace: replaces the existing tile
+    - change_log: if True, every written tile is recorded in the tile_changes
+      table (see get_changes() and update_pyramid()).
+    - layout: order of the tiles in the file (see tile_layouts):
+      - insert: tiles are stored in insert order (default)
+      - hilbert, morton: the id of a tile is its position on a space-filling
+        curve (see tile_key()), so neighbouring tiles are stored together;
+        not for chunked files
     """
 
 
@@ -60,109 +175,248 @@ class EOGeopackage():
         data_type=None,
         srs=None,
         overwrite=False,
-        compression=None
+        compression=None,
+        compression_options=None,
+        predictor=None,
+        cache_size=None,
+        profile=None,
+        readers=None,
+        dedup=False,
+        chunked=False,
+        on_conflict="error",
+        change_log=False,
+        layout="insert"
         ):
         """
         Initializes geopackage file and creates EOGeopackage object.
         """
         self.file_path = file_path
+        self.mode = mode
         try:
-            assert mode
+            assert readers in (None, "pool", "immutable")
         except:
-            raise AttributeError("please provide mode (r or w)")
-        if mode == 'w':
-            try:
-                assert data_type
-            except:
-                raise AttributeError("data_type not provided")
-            try:
-                assert srs
-            except:
-                assert AttributeError("srs not provided")
-            self.data_type = data_type
-            self.srs = srs
-        elif mode == 'r':
-            # Assert that file exists.
-            try:
-                assert os.path.isfile(self.file_path)
-            except:
-                raise IOError("file '%s' not found" % self.file_path)
-            # Assert that file has the correct schema.
-            try:
-                self.db_connection = connect(self.file_path)
-                assert schema_is_ok(self.file_path)
-            except:
-                raise IOError("not a valid EO Geopackage file")
-            # Read metadata.
-            self.data_type = self.__get_data_type()
-            self.srs = self.__get_srs()
-        else:
-            raise AttributeError("unknown mode %s" % mode)
-        # Assert that data_type is given.
+            raise AttributeError("unknown readers %s" % readers)
         try:
-            assert self.data_type
+            assert not (readers == "immutable" and mode != "r")
         except:
-            raise AttributeError("no data_type provided")
-        # Assert that data_type is valid.
+            raise AttributeError("immutable readers used in mode %s" % mode)
+        self.readers = readers
+        self.__thread_local = threading.local()
+        self.__reader_connections = []
+        self.__readers_lock = threading.Lock()
+        if isinstance(profile, dict):
+            self.profile = profile
+        else:
+            try:
+                self.profile = sqlite_profiles[profile]
+            except KeyError:
+                raise AttributeError("unknown profile %s" % profile)
         try:
-            assert self.data_type in ("image/TIFF", "xray")
+            assert not (self.profile.get("query_only") and mode != "r")
         except:
-            raise AttributeError("unknown data_type %s" % self.data_type)
-        # Assert that SRS is given.
+            raise AttributeError("read only profile used in mode %s" % mode)
+        # Coverage bitmaps by zoom level, each loaded when first needed.
+        self.__coverage = {}
+        # Zoom levels whose bitmaps were built or changed since stored.
+        self.__coverage_changed = set()
+        # Zoom levels written while their bitmap was not loaded, so their
+        # stored bitmap is outdated.
+        self.__coverage_outdated = set()
+        # Whether the stored bitmaps match the tiles table, checked once.
+        self.__stored_coverage = None
+        self.__coverage_lock = threading.Lock()
+        self.cache = None
+        if cache_size:
+            self.cache = TileCache(cache_size)
         try:
-            assert self.srs
+            assert mode
         except:
-            raise AttributeError("no SRS provided")
-        # Assert that SRS is valid.
+            raise AttributeError("please provide mode (r or w)")
+        self.db_connection = None
         try:
-            assert self.srs in ([4326])
-        except:
-            raise AttributeError("unknown SRS %s" % str(self.srs))
-        self.compression = compression
-        if self.data_type == "xray":
-            if compression:
+            if mode == 'w':
                 try:
-                    assert compression in (
-                        "blosclz",
-                        "lz4",
-                        "lz4hc",
-                        "snappy",
-                        "zlib"
-                        )
+                    assert data_type
                 except:
-                    raise AttributeError("Unknown compression %s" % compression)
-            else:
-                compression="lz4"
-        if self.data_type == "image/TIFF":
-            if compression:
+                    raise AttributeError("data_type not provided")
                 try:
-                    assert compression in (
-                        # "tiff_ccitt",
-                        # "group3",
-                        # "group4",
-                        # "tiff_jpeg",
-                        "tiff_adobe_deflate",
-                        # "tiff_thunderscan",
-                        "tiff_deflate",
-                        # "tiff_sgilog",
-                        # "tiff_sgilog24",
-                        # "tiff_raw_16",
-                        "tiff_lzw"
-                        )
+                    assert srs
+                except:
+                    assert AttributeError("srs not provided")
+                self.data_type = data_type
+                self.srs = srs
+            elif mode == 'r':
+                # Assert that file exists.
+                try:
+                    assert os.path.isfile(self.file_path)
                 except:
-                    raise AttributeError("Unknown compression %s" % compression)
+                    raise IOError("file '%s' not found" % self.file_path)
+                # Assert that file has the correct schema. The connection opened
+                # here is used for reading the metadata and the tiles.
+                self.db_connection = self.__connect()
+                try:
+                    tables = table_names(self.db_connection)
+                    assert all(table in tables for table in sql_create_tables)
+                except:
+                    self.db_connection.close()
+                    raise IOError("not a valid EO Geopackage file")
+                # Read metadata.
+                self.metadata = self.__get_metadata(tables)
+                self.data_type = self.__get_data_type()
+                self.srs = self.__get_srs()
+                compression = self.metadata.get("codec")
+                if compression:
+                    compression = str(compression)
+                # Runtime settings are taken from the arguments, not the file.
+                runtime_options = dict(
+                    (option, value)
+                    for option, value in (compression_options or {}).items()
+                    if option in runtime_codec_options
+                    )
+                compression_options = _stored_codec_options(
+                    self.metadata.get("codec_options")
+                    )
+                if runtime_options:
+                    compression_options = dict(
+                        compression_options or {},
+                        **runtime_options
+                        )
+                predictor = self.metadata.get("predictor")
+                if predictor:
+                    predictor = str(predictor)
+                dedup = bool(self.metadata.get("dedup"))
+                chunked = bool(self.metadata.get("chunked"))
+                change_log = bool(self.metadata.get("change_log"))
+                layout = str(self.metadata.get("layout", "insert"))
+                if "codec_dictionary" in self.metadata:
+                    compression_options = dict(
+                        compression_options or {},
+                        dictionary=base64.b64decode(
+                            self.metadata["codec_dictionary"]
+                            )
+                        )
             else:
-                compression=None
-        self.overwrite = overwrite
-        self.db_connection = connect(self.file_path)
-        if mode != "r":
-            self.__create_file(overwrite=overwrite)
-
+                raise AttributeError("unknown mode %s" % mode)
+            # Assert that data_type is given.
+            try:
+                assert self.data_type
+            except:
+                raise AttributeError("no data_type provided")
+            # Assert that data_type is valid.
+            try:
+                assert self.data_type in set(
+                    data_type for data_type, compression in tile_codecs
+                    )
+            except:
+                raise AttributeError("unknown data_type %s" % self.data_type)
+            # Assert that SRS is given.
+            try:
+                assert self.srs
+            except:
+                raise AttributeError("no SRS provided")
+            # Assert that SRS is valid.
+            try:
+                assert self.srs in ([4326])
+            except:
+                raise AttributeError("unknown SRS %s" % str(self.srs))
+            self.compression = compression
+            # All tiles are encoded and decoded by the codec looked up once
+            # here.
+            self.codec = get_codec(self.data_type, compression)
+            self.compression_options = self.codec.get_options(
+                compression_options
+                )
+            try:
+                assert predictor in predictors
+            except:
+                raise AttributeError("unknown predictor %s" % predictor)
+            self.predictor = predictor
+            # Codecs and their settings by tile_codec tag of adaptive files.
+            self.tag_codecs = None
+            tag_column = "NULL"
+            if compression == "adaptive":
+                self.tag_codecs = adaptive_codecs(
+                    self.data_type,
+                    self.compression_options
+                    )
+                # The candidates are looked up once, not for every tile.
+                self.codec = self.codec.bind(codecs=self.tag_codecs)
+                # Arrays no candidate supports are rejected by check(), before
+                # their metadata is recorded.
+                self.codec.dtypes = _adaptive_dtypes(self.tag_codecs)
+                tag_column = "tile_codec"
+            # Tiles of deduplicated files reference their encoded blob by
+            # content hash, constant tiles store their fill value instead.
+            self.dedup = dedup
+            self.blob_cache = None
+            # Hashes of the stored blobs, read when the first tile is written.
+            self.__blob_hashes = None
+            self.__tiles_source = "tiles"
+            self.__tile_columns = "tile_data, %s, NULL, NULL" % tag_column
+            # Tiles of chunked files are stored as one row per band and time
+            # slice.
+            try:
+                assert not (chunked and dedup)
+            except:
+                raise AttributeError("chunked files cannot be deduplicated")
+            self.chunked = chunked
+            if chunked:
+                self.__tile_columns = (
+                    "tile_time, tile_band, " + self.__tile_columns
+                    )
+            if dedup:
+                self.blob_cache = TileCache(cache_size or dedup_cache_size)
+                self.__tiles_source = (
+                    "tiles LEFT JOIN tile_blobs USING (tile_hash)"
+                    )
+                self.__tile_columns = "tile_data, %s, tile_hash, tile_fill" % (
+                    tag_column
+                    )
+            try:
+                assert on_conflict in conflict_clauses
+            except:
+                raise AttributeError("unknown on_conflict %s" % on_conflict)
+            self.on_conflict = on_conflict
+            self.change_log = change_log
+            try:
+                assert layout in tile_layouts
+            except:
+                raise AttributeError("unknown layout %s" % layout)
+            try:
+                assert not (chunked and layout != "insert")
+            except:
+                raise AttributeError(
+                    "chunked files cannot use layout %s" % layout
+                    )
+            self.layout = layout
+            # Value of the id column of new tiles (see tile_key()).
+            self.__tile_id = "NULL"
+            if layout != "insert":
+                self.__tile_id = "tile_key('%s', ?1, ?2, ?3)" % layout
+            self.overwrite = overwrite
+            if mode == "r":
+                self.__apply_profile()
+            else:
+                self.db_connection = self.__connect()
+                self.__create_file(overwrite=overwrite)
+                self.metadata = self.__get_metadata()
+                if self.compression_options and (
+                    self.compression_options.get("dictionary")
+                    ):
+                    self.__set_dictionary(
+                        self.compression_options["dictionary"]
+                        )
+        except:
+            # Validation errors must not leave the file open.
+            if self.db_connection is not None:
+                self.db_connection.close()
+            raise
 
 
     def __get_data_type(self):
-        db_connection = connect(self.file_path)
-        cursor = db_connection.cursor()
+        if "data_type" in self.metadata:
+            return str(self.metadata["data_type"])
+        cursor = self.db_connection.cursor()
         cursor.execute("""
             SELECT identifier from gpkg_contents;
             """)
@@ -170,8 +424,9 @@ class EOGeopackage():
         return data_type
 
     def __get_srs(self):
-        db_connection = connect(self.file_path)
-        cursor = db_connection.cursor()
+        if "srs" in self.metadata:
+            return self.metadata["srs"]
+        cursor = self.db_connection.cursor()
         cursor.execute("""
             SELECT srs_id from gpkg_contents;
             """)
@@ -179,6 +434,94 @@ class EOGeopackage():
         return srs_id
 
 
+    def __get_metadata(self, tables=None):
+        """
+        Reads the tile metadata extension into a dictionary. Files written
+        without the extension return an empty dictionary.
+        - tables: names of the tables of the file, if already known
+        """
+        if tables is None:
+            tables = table_names(self.db_connection)
+        if "gpkgx_tile_metadata" not in tables:
+            return {}
+        cursor = self.db_connection.cursor()
+        cursor.execute("""
+            SELECT key, value FROM gpkgx_tile_metadata WHERE table_name=?;
+            """, ("tiles", ))
+        return dict(
+            (str(key), json.loads(value))
+            for key, value in cursor.fetchall()
+            )
+
+
+    def __set_metadata(self, **metadata):
+        """
+        Stores metadata values which have not been set yet.
+        """
+        with self.db_connection as db_connection:
+            cursor = db_connection.cursor()
+            cursor.executemany("""
+                INSERT OR IGNORE INTO gpkgx_tile_metadata (
+                    table_name,
+                    key,
+                    value)
+                VALUES (?, ?, ?);
+                """,
+                [
+                    ("tiles", key, json.dumps(value))
+                    for key, value in metadata.items()
+                    ]
+            )
+        self.metadata = self.__get_metadata()
+
+
+    def train_dictionary(self, samples, dict_size=16384):
+        """
+        Trains a zstd dictionary on sample tiles and uses it for all tiles of
+        the file. Dictionaries mostly help with small tiles.
+        - samples: iterable of arrays similar to the tiles to be written
+        - dict_size: maximum size of the dictionary in bytes
+        Only possible for zstandard compressed files without tiles. The
+        dictionary is stored in the file metadata.
+        """
+        try:
+            assert self.compression == "zstandard"
+        except:
+            raise AttributeError(
+                "dictionaries need zstandard compression, not %s" % (
+                    self.compression
+                    )
+                )
+        try:
+            assert "dtype" not in self.metadata
+        except:
+            raise IOError("dictionary has to be trained before writing tiles")
+        dictionary = zstandard.train_dictionary(
+            dict_size,
+            [
+                _shuffle_bytes(
+                    np.ascontiguousarray(sample),
+                    self.compression_options
+                    ).tobytes()
+                for sample in samples
+                ]
+            ).as_bytes()
+        self.__set_dictionary(dictionary)
+        return dictionary
+
+
+    def __set_dictionary(self, dictionary):
+        """
+        Stores a zstd dictionary in the metadata and uses it for encoding.
+        """
+        self.__set_metadata(
+            codec_dictionary=base64.b64encode(dictionary).decode("ascii")
+            )
+        self.compression_options["dictionary"] = base64.b64decode(
+            self.metadata["codec_dictionary"]
+            )
+
+
     def __create_file(self, overwrite=False):
         """
         Creates a new geopackage file (i.e. including schema).
@@ -188,12 +531,166 @@ class EOGeopackage():
         except:
             raise IOError
         if overwrite:
+            self.db_connection.close()
             os.remove(self.file_path)
-        self.db_connection = connect(
+        self.db_connection = self.__connect()
+        if not overwrite:
+            self.__check_settings()
+        # Has to happen before the schema is created as the page size cannot
+        # be changed afterwards.
+        self.__apply_profile()
+        self.__create_schema()
+
+
+    def __check_settings(self):
+        """
+        Asserts that an existing file opened for writing was written with the
+        same settings, as its tiles are decoded using the stored ones.
+        """
+        metadata = self.__get_metadata()
+        if not metadata:
+            return
+        # Files may have been written storing runtime settings.
+        stored = dict(
+            metadata,
+            codec_options=_stored_codec_options(metadata.get("codec_options"))
+            )
+        codec_options = _stored_codec_options(self.compression_options)
+        for key, value, default in (
+            ("data_type", self.data_type, None),
+            ("srs", self.srs, None),
+            ("codec", self.compression, None),
+            ("codec_options", codec_options, None),
+            ("predictor", self.predictor, None),
+            ("dedup", self.dedup, False),
+            ("chunked", self.chunked, False),
+            ("change_log", self.change_log, False),
+            ("layout", self.layout, "insert")
+            ):
+            try:
+                assert stored.get(key, default) == value
+            except:
+                self.db_connection.close()
+                raise AttributeError(
+                    "file was written with %s %s, not %s" % (
+                        key,
+                        stored.get(key, default),
+                        value
+                        )
+                    )
+        # A dictionary not given is taken from the file, like in mode r.
+        dictionary = None
+        if self.compression_options:
+            dictionary = self.compression_options.get("dictionary")
+        if "codec_dictionary" in metadata:
+            stored_dictionary = base64.b64decode(metadata["codec_dictionary"])
+            if dictionary is None:
+                self.compression_options["dictionary"] = stored_dictionary
+                return
+            try:
+                assert dictionary == stored_dictionary
+            except:
+                self.db_connection.close()
+                raise AttributeError(
+                    "file was written with another codec_dictionary"
+                    )
+        elif dictionary is not None and "dtype" in metadata:
+            self.db_connection.close()
+            raise AttributeError("file was written without codec_dictionary")
+
+
+    def __connect(self):
+        """
+        Opens a connection to the file converting ARRAY columns and returning
+        TEXT columns as byte strings (compressed xray tiles).
+        """
+        db_connection = connect(
             self.file_path,
             detect_types=sqlite3.PARSE_DECLTYPES
             )
-        self.__create_schema()
+        db_connection.text_factory = str
+        db_connection.create_function("tile_key", 4, tile_key)
+        return db_connection
+
+
+    def __read_connection(self):
+        """
+        Returns the connection used for reading in the current thread.
+        """
+        if not self.readers:
+            return self.db_connection
+        db_connection = getattr(self.__thread_local, "db_connection", None)
+        if db_connection is None:
+            db_connection = connect_read_only(
+                self.file_path,
+                immutable=(self.readers == "immutable")
+                )
+            cursor = db_connection.cursor()
+            for pragma in ("mmap_size", "cache_size", "temp_store"):
+                if pragma in self.profile:
+                    cursor.execute(
+                        "PRAGMA %s=%s;" % (pragma, self.profile[pragma])
+                        )
+            self.__thread_local.db_connection = db_connection
+            with self.__readers_lock:
+                self.__reader_connections.append(db_connection)
+        return db_connection
+
+
+    def __apply_profile(self):
+        """
+        Sets the PRAGMAs of the SQLite profile on the connection.
+        """
+        cursor = self.db_connection.cursor()
+        for pragma, value in self.profile.items():
+            cursor.execute("PRAGMA %s=%s;" % (pragma, value))
+
+
+    def optimize(self, vacuum=True, journal_mode="DELETE"):
+        """
+        Finishes an ingest: updates the query planner statistics (ANALYZE),
+        rebuilds the file without free pages (VACUUM) and switches the
+        journal mode, by default back to a single file without write-ahead
+        log. Deduplicated files also drop blobs no tile references anymore.
+        """
+        self.__store_coverage()
+        self.db_connection.commit()
+        cursor = self.db_connection.cursor()
+        if self.dedup:
+            # Blobs of replaced and skipped tiles.
+            with self.db_connection:
+                cursor.execute("""
+                    DELETE FROM tile_blobs WHERE tile_hash NOT IN (
+                        SELECT tile_hash FROM tiles WHERE tile_hash IS NOT NULL
+                        );
+                    """)
+            self.__blob_hashes = None
+        if journal_mode:
+            cursor.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+            cursor.execute("PRAGMA journal_mode=%s;" % journal_mode)
+        cursor.execute("ANALYZE;")
+        if vacuum:
+            cursor.execute("VACUUM;")
+
+
+    def codec_usage(self):
+        """
+        Returns the number of tiles per codec of an adaptive file as a
+        dictionary {compression: tiles}.
+        """
+        try:
+            assert self.tag_codecs is not None
+        except:
+            raise AttributeError("codec usage is only stored in adaptive files")
+        cursor = self.__read_connection().cursor()
+        # Constant tiles of deduplicated files have no blob and no tag.
+        cursor.execute("""
+            SELECT COALESCE(tile_codec, 0), COUNT(*) FROM %s GROUP BY 1;
+            """ % self.__tiles_source)
+        return dict(
+            (self.tag_codecs[tag][0].compression, count)
+            for tag, count in cursor.fetchall()
+            )
 
 
     def __create_schema(self):
@@ -252,12 +749,35 @@ class EOGeopackage():
 
             # Tiles table.
 
-            if self.data_type == "xray":
-                tiles_data_type = "ARRAY"
-                if self.compression:
-                    tiles_data_type = "TEXT"
-            elif self.data_type in ("image/TIFF", "image/JPEG2000"):
-                tiles_data_type = "BLOB"
+            tiles_data_type = self.codec.column_type
+            tile_columns = "tile_data %s NOT NULL," % tiles_data_type
+            tile_key = "zoom_level, tile_column, tile_row"
+            # Chunked files store every band and time slice in its own row.
+            if self.chunked:
+                tile_columns = """
+                      tile_time INTEGER NOT NULL,
+                      tile_band INTEGER NOT NULL,
+                      %s""" % tile_columns
+                tile_key += ", tile_time, tile_band"
+            # Adaptive files store the codec of every tile.
+            if self.tag_codecs is not None:
+                tile_columns += "\n tile_codec INTEGER NOT NULL,"
+            # Deduplicated files store the tile data in tile_blobs.
+            if self.dedup:
+                try:
+                    cursor.execute("""
+                        CREATE TABLE IF NOT EXISTS tile_blobs (
+                          tile_hash TEXT NOT NULL PRIMARY KEY,
+                          %s
+                        );
+                        """ %(tile_columns.rstrip(","))
+                    )
+                except:
+                    raise
+                tile_columns = """
+                      tile_hash TEXT REFERENCES tile_blobs (tile_hash),
+                      tile_fill BLOB,
+                    """
             try:
                 cursor.execute("""
                     CREATE TABLE IF NOT EXISTS tiles (
@@ -265,128 +785,3314 @@ class EOGeopackage():
                       zoom_level INTEGER NOT NULL,
                       tile_column INTEGER NOT NULL,
                       tile_row INTEGER NOT NULL,
-                      tile_data %s NOT NULL,
-                      UNIQUE (zoom_level, tile_column, tile_row)
+                      %s
+                      UNIQUE (%s)
                     );
-                    """ %(tiles_data_type)
+                    """ %(tile_columns, tile_key)
                 )
             except:
                 raise
-
-
-    def insert_tile(self, zoom, row, col, data):
-        with self.db_connection as db_connection:
-            cursor = db_connection.cursor()
-            compression = self.compression
-            data_type = self.data_type
-            if compression and (data_type == "xray"):
-                db_connection.text_factory = str
-                data_compressed = blosc.pack_array(data, cname=compression)
-                data = data_compressed
-            if data_type == "image/TIFF":
+            # Change log filled by a trigger on the tiles table.
+            if self.change_log:
                 try:
-                    assert data.dtype == "uint8"
+                    for table, statement in sql_create_change_log.iteritems():
+                        cursor.execute(statement)
                 except:
-                    raise TypeError("dtype %s not supported" % data.dtype)
-                image = Image.fromarray(np.uint8(data))
-                buf = ioBuffer()
-                if compression == "tiff_lzw":
-                    TiffImagePlugin.WRITE_LIBTIFF = True
-                    image.save(buf, "TIFF", compression=compression)
-                    TiffImagePlugin.WRITE_LIBTIFF = False
-                else:
-                    image.save(buf, "TIFF", compression=compression)
-                buf.seek(0)
-                data = Binary(buf.read())
-            if data_type == "image/JPEG2000":
+                    raise
+            # Acquisition times of the time slices of chunked files.
+            if self.chunked:
                 try:
-                    assert data.dtype == "uint8"
+                    cursor.execute("""
+                        CREATE TABLE IF NOT EXISTS tile_times (
+                          zoom_level INTEGER NOT NULL,
+                          tile_column INTEGER NOT NULL,
+                          tile_row INTEGER NOT NULL,
+                          tile_time INTEGER NOT NULL,
+                          timestamp TEXT NOT NULL,
+                          UNIQUE (zoom_level, tile_column, tile_row, tile_time)
+                        );
+                        """
+                    )
                 except:
-                    raise TypeError("dtype %s not supported" % data.dtype)
-                image = Image.fromarray(np.uint8(data))
-                buf = ioBuffer()
-                image.save(buf, "j2k")
-                buf.seek(0)
-                data = Binary(buf.read())
+                    raise
+
+            # Tile matrix set.
             try:
                 cursor.execute("""
-                    INSERT INTO tiles
-                        (zoom_level, tile_row, tile_column, tile_data)
-                        VALUES (?,?,?,?)
-                """, (zoom, row, col, data))
+                    INSERT OR IGNORE INTO gpkg_tile_matrix_set (
+                        table_name,
+                        srs_id,
+                        min_x,
+                        min_y,
+                        max_x,
+                        max_y)
+                    VALUES (?, ?, ?, ?, ?, ?);
+                    """,
+                    ("tiles", self.srs) + tile_matrix_sets[self.srs]["bounds"]
+                )
+            except:
+                raise
+
+            # Tile metadata extension.
+            try:
+                for table, statement in sql_create_extension_tables.iteritems():
+                    cursor.execute(statement)
+                cursor.executemany("""
+                    INSERT OR IGNORE INTO gpkg_extensions (
+                        table_name,
+                        column_name,
+                        extension_name,
+                        definition,
+                        scope)
+                    VALUES (?, ?, ?, ?, ?);
+                    """,
+                    [
+                        (
+                        "tiles",
+                        "tile_data",
+                        "eox_tile_metadata",
+                        tile_metadata_definition,
+                        "read-write"
+                        ),
+                        (
+                        "tiles",
+                        "tile_data",
+                        "eox_tile_coverage",
+                        tile_coverage_definition,
+                        "read-write"
+                        )
+                        ]
+                )
+                codec_level = None
+                if self.compression_options:
+                    codec_level = self.compression_options.get("clevel")
+                codec_options = _stored_codec_options(self.compression_options)
+                cursor.executemany("""
+                    INSERT OR IGNORE INTO gpkgx_tile_metadata (
+                        table_name,
+                        key,
+                        value)
+                    VALUES (?, ?, ?);
+                    """,
+                    [
+                        ("tiles", key, json.dumps(value))
+                        for key, value in (
+                            ("data_type", self.data_type),
+                            ("srs", self.srs),
+                            ("codec", self.compression),
+                            ("codec_level", codec_level),
+                            ("codec_options", codec_options),
+                            ("predictor", self.predictor),
+                            ("dedup", self.dedup),
+                            ("chunked", self.chunked),
+                            ("change_log", self.change_log),
+                            ("layout", self.layout),
+                            ("order", "C")
+                            )
+                        ]
+                )
             except:
                 raise
 
 
-    def get_tiledata(self, zoom, row, col):
+    def insert_tile(self, zoom, row, col, data, on_conflict=None):
+        """
+        Encodes and inserts a single tile.
+        - on_conflict: error, skip or replace an existing tile (default: the
+          on_conflict policy of the file)
+        """
+        on_conflict = self.__conflict_policy(on_conflict)
+        self.__check_tile(data)
+        tiles = [(zoom, row, col, data)]
+        if self.dedup:
+            tiles = self.__dedup_tiles(tiles)
+        self.__write_tiles(
+            [
+                (zoom, row, col, self.__encode_tile(data))
+                for zoom, row, col, data in tiles
+                ],
+            on_conflict
+            )
+
+
+    def insert_tiles(
+        self,
+        tiles,
+        batch_size=1000,
+        workers=1,
+        queue_size=None,
+        on_conflict=None,
+        pool=None
+        ):
+        """
+        Encodes and inserts many tiles at once.
+        - tiles: iterable of (zoom, row, col, data) tuples
+        - batch_size: number of tiles written per transaction
+        - workers: number of processes encoding tiles; 1 encodes in the calling
+          process, None uses one process per CPU core
+        - queue_size: maximum number of tiles being encoded at the same time
+          (default: 4 per worker); the tiles iterable is only consumed as fast
+          as the encoded tiles get written
+        - on_conflict: error, skip or replace existing tiles (default: the
+          on_conflict policy of the file)
+        - pool: process pool from encoding_pool() encoding the tiles instead
+          of a pool started for workers, e.g. one also reading the tiles; it
+          is not closed
+        Every batch is committed in its own transaction. If writing a batch
+        fails, this batch is rolled back completely while all previous batches
+        stay committed, and the error is raised.
+        The calling process stays the only one writing into the file, encoded
+        tiles are identical to the ones written by insert_tile().
+        Returns the number of inserted tiles, including skipped ones.
+        """
+        on_conflict = self.__conflict_policy(on_conflict)
+        try:
+            assert batch_size > 0
+        except:
+            raise AttributeError("invalid batch_size %s" % batch_size)
+        if workers is None:
+            workers = cpu_count()
+        try:
+            assert workers > 0
+        except:
+            raise AttributeError("invalid number of workers %s" % workers)
+        tiles = self.__check_tiles(tiles)
+        if self.dedup:
+            tiles = self.__dedup_tiles(tiles)
+        own_pool = None
+        if pool is None and workers > 1:
+            pool = own_pool = encoding_pool(workers)
+        if pool is None:
+            encoded_tiles = (
+                (zoom, row, col, self.__encode_tile(data))
+                for zoom, row, col, data in tiles
+                )
+        else:
+            encoded_tiles = _encode_tiles_parallel(
+                pool,
+                tiles,
+                self.codec,
+                self.compression_options,
+                self.predictor,
+                queue_size or 4 * workers,
+                self.dedup,
+                self.chunked
+                )
+        inserted = 0
+        batch = []
+        try:
+            for tile in encoded_tiles:
+                batch.append(tile)
+                if len(batch) == batch_size:
+                    self.__write_tiles(batch, on_conflict)
+                    inserted += len(batch)
+                    batch = []
+            if batch:
+                self.__write_tiles(batch, on_conflict)
+                inserted += len(batch)
+        except:
+            if own_pool:
+                own_pool.terminate()
+            raise
+        if own_pool:
+            own_pool.close()
+            own_pool.join()
+        return inserted
+
+
+    def __conflict_policy(self, on_conflict):
+        """
+        Returns the conflict policy of an insert, by default the one of the
+        file.
+        """
+        on_conflict = on_conflict or self.on_conflict
+        try:
+            assert on_conflict in conflict_clauses
+        except:
+            raise AttributeError("unknown on_conflict %s" % on_conflict)
+        return on_conflict
+
+
+    def append_time_slice(self, zoom, row, col, data, timestamp):
+        """
+        Adds a time slice to a tile of a chunked file without reading or
+        rewriting its existing time slices.
+        - data: array of shape (height, width, bands) or (height, width)
+        - timestamp: acquisition time, a datetime or an ISO 8601 string
+        The slice is stored as new chunks with the next time index of the
+        tile and the timestamp is recorded in the tile_times table. Tiles not
+        existing yet are created with one time slice. Files whose tiles were
+        written without time axis (2D or 3D arrays) raise a TypeError.
+        Returns the time index of the slice.
+        """
+        try:
+            assert self.chunked
+        except:
+            raise AttributeError(
+                "time slices can only be appended to chunked files"
+                )
+        try:
+            assert timestamp
+        except:
+            raise AttributeError("no timestamp provided")
+        if hasattr(timestamp, "isoformat"):
+            timestamp = timestamp.isoformat()
+        try:
+            assert len(self.metadata.get("tile_shape", [None] * 4)) == 4
+        except:
+            raise TypeError(
+                "tiles of this file have no time axis, time slices cannot be "
+                "appended"
+                )
+        data = np.asarray(data)
+        if data.ndim == 2:
+            data = data[:, :, np.newaxis]
+        data = data[:, :, :, np.newaxis]
+        self.__check_tile(data)
+        chunks = self.__encode_tile(data)
         with self.db_connection as db_connection:
             cursor = db_connection.cursor()
-            data_type = self.data_type
-            if self.compression and (data_type == "xray"):
-                db_connection.text_factory = str
             try:
                 cursor.execute("""
-                    SELECT tile_data from tiles WHERE
+                    SELECT COALESCE(MAX(tile_time) + 1, 0) from tiles WHERE
                     zoom_level=? AND tile_row=? AND tile_column=?;
-                """, (str(zoom), str(row), str(col)))
+                """, (zoom, row, col))
+                time = cursor.fetchone()[0]
+                self.__write_chunks(cursor, [(
+                    zoom,
+                    row,
+                    col,
+                    [
+                        ((time, band), value)
+                        for (slice_time, band), value in chunks
+                        ]
+                    )])
+                cursor.execute("""
+                    INSERT INTO tile_times
+                        (zoom_level, tile_row, tile_column, tile_time,
+                        timestamp)
+                        VALUES (?,?,?,?,?)
+                """, (zoom, row, col, time, timestamp))
             except:
                 raise
-            if data_type == "xray":
-                if self.compression:
-                    data = blosc.unpack_array(cursor.fetchone()[0])
-                else:
-                    data = cursor.fetchone()[0]
-            if data_type == "image/TIFF":
-                data = cursor.fetchone()[0]
-                # img = Image.frombuffer("L", (255, 255), data)
-                img = Image.open(ioBuffer(data))
-                data = np.array(img)
-            return data
+        if self.cache is not None:
+            self.cache.invalidate((zoom, row, col))
+        self.__add_coverage([(zoom, row, col)])
+        return time
 
 
-    def __exit__(self):
-        """Resource cleanup on destruction."""
-        self.db_connection.close()
+    def __check_tile(self, data):
+        """
+        Records dtype, band count and shape of the first tile written. Tiles
+        stored without dtype and shape (e.g. raw) and tiles of deduplicated
+        files have to match these. Tiles of chunked files need the same
+        dtype, width, height and bands and may have any number of time
+        slices.
+        """
+        if self.chunked:
+            self.__check_chunked_tile(data)
+            return
+        self.codec.check(data)
+        if "dtype" in self.metadata:
+            if self.codec.array or self.dedup:
+                try:
+                    assert data.dtype == self.metadata["dtype"]
+                    assert list(data.shape) == self.metadata["tile_shape"]
+                except:
+                    raise TypeError(
+                        "%s tiles must be %s %s arrays" % (
+                            ("deduplicated" if self.dedup else self.compression),
+                            self.metadata["dtype"],
+                            tuple(self.metadata["tile_shape"])
+                            )
+                        )
+            return
+        self.__set_tile_metadata(data)
 
 
-# From http://stackoverflow.com/questions/18621513/python-insert-numpy-array-into-sqlite3-database
-def adapt_array(arr):
-    """
-    http://stackoverflow.com/a/31312102/190597 (SoulNibbler)
-    """
-    out = io.BytesIO()
-    np.save(out, arr)
-    out.seek(0)
-    return sqlite3.Binary(out.read())
-def convert_array(text):
-    out = io.BytesIO(text)
-    out.seek(0)
-    return np.load(out)
-# Converts np.array to TEXT when inserting
-sqlite3.register_adapter(np.ndarray, adapt_array)
-# Converts TEXT to np.array when selecting
-sqlite3.register_converter("array", convert_array)
+    def __check_chunked_tile(self, data):
+        """
+        Checks a tile of a chunked file and records dtype and shape of the
+        first one.
+        """
+        try:
+            assert 2 <= data.ndim <= 4
+        except:
+            raise TypeError("chunked tiles must have 2 to 4 dimensions")
+        # The codec only sees the 2D chunks.
+        self.codec.check(data.reshape(data.shape[:2] + (-1, ))[:, :, 0])
+        if "dtype" in self.metadata:
+            try:
+                assert data.dtype == self.metadata["dtype"]
+                assert list(data.shape[:3]) == self.metadata["tile_shape"][:3]
+                assert data.ndim == len(self.metadata["tile_shape"])
+            except:
+                raise TypeError(
+                    "chunked tiles must be %s arrays of shape %s" % (
+                        self.metadata["dtype"],
+                        tuple(self.metadata["tile_shape"][:3]) + (
+                            ("time", ) if data.ndim == 4 else ()
+                            )
+                        )
+                    )
+            return
+        self.__set_tile_metadata(data)
 
-content_description = """
-Experimental EO GPKG raster tiles by EOX IT Services (ju@eox.at)
-"""
 
-ref_sys_wkt = {
-    4326: """
-    GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,
-    298.257223563,AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG",
-    "6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],UNIT
-    ["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],
-    AUTHORITY["EPSG","4326"]]
-    """
-    }
+    def __set_tile_metadata(self, data):
+        """
+        Records dtype, band count and shape of the first tile. The predictor
+        is checked before, as a tile failing to encode must not leave its
+        dtype and shape behind.
+        """
+        if self.predictor:
+            _check_predictor_dtype(data.dtype, self.predictor)
+        self.__set_metadata(
+            dtype=str(data.dtype),
+            bands=(data.shape[2] if data.ndim > 2 else 1),
+            tile_shape=list(data.shape)
+            )
 
 
-sql_create_tables = OrderedDict([
-    ("gpkg_spatial_ref_sys",
-    """
-    CREATE TABLE IF NOT EXISTS gpkg_spatial_ref_sys (
-      srs_name TEXT NOT NULL,
+    def __check_tiles(self, tiles):
+        """
+        Yields (zoom, row, col, data) tuples after checking each tile.
+        """
+        for zoom, row, col, data in tiles:
+            self.__check_tile(data)
+            yield zoom, row, col, data
+
+
+    def __dedup_tiles(self, tiles):
+        """
+        Yields (zoom, row, col, (tile_hash, fill, data)) tuples of a
+        deduplicated file. Constant tiles only keep their fill value, tiles
+        whose blob is already stored or about to be written keep no data, so
+        only new blobs get encoded.
+        """
+        if self.__blob_hashes is None:
+            cursor = self.db_connection.cursor()
+            cursor.execute("SELECT tile_hash FROM tile_blobs;")
+            self.__blob_hashes = set(
+                tile_hash for tile_hash, in cursor.fetchall()
+                )
+        for zoom, row, col, data in tiles:
+            data = np.asarray(data)
+            if (data == data.flat[0]).all():
+                yield zoom, row, col, (None, data.flat[:1].tobytes(), None)
+                continue
+            tile_hash = _tile_hash(data)
+            if tile_hash in self.__blob_hashes:
+                yield zoom, row, col, (tile_hash, None, None)
+            else:
+                self.__blob_hashes.add(tile_hash)
+                yield zoom, row, col, (tile_hash, None, data)
+
+
+    def __encode_tile(self, data):
+        """
+        Encodes a tile, of deduplicated files only new blobs, of chunked files
+        every chunk (see tile_chunks()).
+        """
+        if self.chunked:
+            return [
+                (key, self.codec.encode(
+                    chunk,
+                    self.compression_options,
+                    self.predictor
+                    ))
+                for key, chunk in tile_chunks(data)
+                ]
+        if not self.dedup:
+            return self.codec.encode(
+                data,
+                self.compression_options,
+                self.predictor
+                )
+        tile_hash, fill, data = data
+        if data is not None:
+            data = self.codec.encode(
+                data,
+                self.compression_options,
+                self.predictor
+                )
+        return tile_hash, fill, data
+
+
+    def __write_tiles(self, tiles, on_conflict="error"):
+        """
+        Writes encoded (zoom, row, col, data) tuples in one transaction. Data
+        of adaptive files is a (tag, value) tuple, data of deduplicated files
+        a (tile_hash, fill, value) tuple (see __dedup_tiles()), data of
+        chunked files a list of ((time, band), value) tuples.
+        Existing tiles are handled by the conflict clause of on_conflict.
+        """
+        insert = conflict_clauses[on_conflict]
+        if self.layout != "insert" and tiles:
+            # Checked here, errors of tile_key() in SQL would surface as
+            # sqlite3.OperationalError.
+            tile_key(
+                self.layout,
+                max(zoom for zoom, row, col, data in tiles),
+                0,
+                0
+                )
+        with self.db_connection as db_connection:
+            cursor = db_connection.cursor()
+            try:
+                if self.dedup:
+                    self.__write_deduplicated(cursor, tiles, insert)
+                elif self.chunked:
+                    self.__write_chunks(
+                        cursor,
+                        self.__resolve_chunk_conflicts(
+                            cursor,
+                            tiles,
+                            on_conflict
+                            )
+                        )
+                elif self.tag_codecs is None:
+                    cursor.executemany("""
+                        %s INTO tiles
+                            (id, zoom_level, tile_row, tile_column, tile_data)
+                            VALUES (%s, ?1, ?2, ?3, ?4)
+                    """ % (insert, self.__tile_id), tiles)
+                else:
+                    cursor.executemany("""
+                        %s INTO tiles
+                            (id, zoom_level, tile_row, tile_column, tile_data,
+                            tile_codec)
+                            VALUES (%s, ?1, ?2, ?3, ?4, ?5)
+                    """ % (insert, self.__tile_id), [
+                        (zoom, row, col, value, tag)
+                        for zoom, row, col, (tag, value) in tiles
+                        ])
+            except:
+                if self.dedup:
+                    # Forget the blobs of the rolled back transaction.
+                    self.__blob_hashes = None
+                raise
+        if self.cache is not None:
+            for zoom, row, col, data in tiles:
+                self.cache.invalidate((zoom, row, col))
+        self.__add_coverage((zoom, row, col) for zoom, row, col, data in tiles)
+
+
+    def __write_deduplicated(self, cursor, tiles, insert="INSERT"):
+        """
+        Writes the new blobs and the tiles of a deduplicated file.
+        """
+        blobs = [
+            (tile_hash, value)
+            for zoom, row, col, (tile_hash, fill, value) in tiles
+            if value is not None
+            ]
+        if self.tag_codecs is None:
+            cursor.executemany("""
+                INSERT OR IGNORE INTO tile_blobs (tile_hash, tile_data)
+                    VALUES (?,?)
+            """, blobs)
+        else:
+            cursor.executemany("""
+                INSERT OR IGNORE INTO tile_blobs
+                    (tile_hash, tile_data, tile_codec)
+                    VALUES (?,?,?)
+            """, [
+                (tile_hash, value, tag)
+                for tile_hash, (tag, value) in blobs
+                ])
+        cursor.executemany("""
+            %s INTO tiles
+                (id, zoom_level, tile_row, tile_column, tile_hash, tile_fill)
+                VALUES (%s, ?1, ?2, ?3, ?4, ?5)
+        """ % (insert, self.__tile_id), [
+            (zoom, row, col, tile_hash, (fill and Binary(fill)))
+            for zoom, row, col, (tile_hash, fill, value) in tiles
+            ])
+
+
+    def __resolve_chunk_conflicts(self, cursor, tiles, on_conflict):
+        """
+        Returns the tiles of a chunked file to be written. As a tile consists
+        of several rows, existing tiles are skipped or deleted as a whole
+        instead of using a conflict clause.
+        """
+        if on_conflict == "error":
+            return tiles
+        if on_conflict == "replace":
+            keys = set((zoom, row, col) for zoom, row, col, data in tiles)
+            for table in ("tiles", "tile_times"):
+                cursor.executemany("""
+                    DELETE FROM %s WHERE
+                    zoom_level=? AND tile_row=? AND tile_column=?;
+                """ % table, keys)
+            return tiles
+        if not tiles:
+            return tiles
+        # Existing tiles of the whole batch are looked up in one query.
+        cursor.execute("""
+            WITH batch(zoom_level, tile_row, tile_column) AS (VALUES %s)
+            SELECT DISTINCT zoom_level, tile_row, tile_column
+            FROM batch JOIN tiles USING (zoom_level, tile_row, tile_column);
+        """ % ", ".join(
+            "(%d, %d, %d)" % (zoom, row, col)
+            for zoom, row, col, data in tiles
+            ))
+        written = set(cursor.fetchall())
+        new_tiles = []
+        for zoom, row, col, data in tiles:
+            if (zoom, row, col) in written:
+                continue
+            written.add((zoom, row, col))
+            new_tiles.append((zoom, row, col, data))
+        return new_tiles
+
+
+    def __write_chunks(self, cursor, tiles):
+        """
+        Writes the chunks of tiles of a chunked file.
+        """
+        chunks = [
+            (zoom, row, col, time, band, value)
+            for zoom, row, col, tile_chunks in tiles
+            for (time, band), value in tile_chunks
+            ]
+        if self.tag_codecs is None:
+            cursor.executemany("""
+                INSERT INTO tiles
+                    (zoom_level, tile_row, tile_column, tile_time, tile_band,
+                    tile_data)
+                    VALUES (?,?,?,?,?,?)
+            """, chunks)
+        else:
+            cursor.executemany("""
+                INSERT INTO tiles
+                    (zoom_level, tile_row, tile_column, tile_time, tile_band,
+                    tile_data, tile_codec)
+                    VALUES (?,?,?,?,?,?,?)
+            """, [
+                (zoom, row, col, time, band, value, tag)
+                for zoom, row, col, time, band, (tag, value) in chunks
+                ])
+
+
+    def get_tiledata(self, zoom, row, col, time=None, bands=None):
+        """
+        Returns a decoded tile.
+        - time, bands: time slices and bands to be returned, as index, slice
+          or list of indices, like indexing the tile with [:, :, bands, time]
+        Chunked files decode only the chunks of the requested bands and time
+        slices, other files decode the whole tile first. Empty selections
+        return empty arrays, chunked tiles missing chunks raise an IOError.
+        Returns None if the tile does not exist. Once the coverage of the zoom
+        level is loaded (see has_tile()), missing tiles are not looked up in
+        the file.
+        """
+        coverage = self.__coverage.get(zoom)
+        if coverage is not None and (row, col) not in coverage:
+            return None
+        if time is not None or bands is not None:
+            if self.chunked:
+                return self.__read_chunks(zoom, row, col, time, bands)
+            data = self.get_tiledata(zoom, row, col)
+            if data is None:
+                return None
+            return _select_chunks(data, time, bands)
+        if self.cache is not None:
+            data = self.cache.get((zoom, row, col))
+            if data is not None:
+                return data
+        if self.chunked:
+            data = self.__read_chunks(zoom, row, col)
+        else:
+            cursor = self.__read_connection().cursor()
+            try:
+                cursor.execute("""
+                    SELECT %s from %s WHERE
+                    zoom_level=? AND tile_row=? AND tile_column=?;
+                """ % (self.__tile_columns, self.__tiles_source), (zoom, row, col))
+            except:
+                raise
+            tile = cursor.fetchone()
+            data = None
+            if tile:
+                data = self.__decode_tile(*tile)
+        if data is not None and self.cache is not None:
+            self.cache.put((zoom, row, col), data)
+        return data
+
+
+    def has_tile(self, zoom, row, col):
+        """
+        Returns whether a tile exists, using the coverage bitmap of its zoom
+        level without querying the file.
+        """
+        return (row, col) in self.__get_coverage(zoom)
+
+
+    def iter_tile_keys(self, zoom, bbox=None):
+        """
+        Yields (row, col) of all existing tiles of a zoom level, row by row,
+        from the coverage bitmap.
+        - bbox: tile indices (min_col, min_row, max_col, max_row), including
+          the maximum column and row, like get_window()
+        """
+        return self.__get_coverage(zoom).keys(bbox)
+
+
+    def update_coverage(self):
+        """
+        Builds the coverage bitmaps of all zoom levels from the tiles table
+        and stores them in the gpkgx_tile_coverage table (not in mode r).
+        """
+        cursor = self.__read_connection().cursor()
+        cursor.execute("SELECT DISTINCT zoom_level FROM tiles;")
+        coverage = dict(
+            (zoom, self.__scan_coverage(zoom))
+            for zoom, in cursor.fetchall()
+            )
+        with self.__coverage_lock:
+            self.__coverage = coverage
+            self.__coverage_changed = set(coverage)
+            self.__coverage_outdated = set()
+            # Stored bitmaps of zoom levels without tiles are dropped.
+            self.__stored_coverage = False
+        if self.mode != "r":
+            self.__store_coverage()
+        return coverage
+
+
+    def __get_coverage(self, zoom):
+        """
+        Returns the coverage bitmap of a zoom level. It is read from the
+        gpkgx_tile_coverage table if no tiles were written since it was
+        stored, otherwise built from the tiles of the zoom level.
+        """
+        coverage = self.__coverage.get(zoom)
+        if coverage is not None:
+            return coverage
+        cursor = self.__read_connection().cursor()
+        changed = False
+        if self.__stored_coverage is None:
+            self.__stored_coverage = self.__check_stored_coverage(cursor)
+        if self.__stored_coverage and zoom not in self.__coverage_outdated:
+            cursor.execute("""
+                SELECT min_row, min_col, matrix_rows, matrix_cols, bitmap
+                FROM gpkgx_tile_coverage WHERE table_name=? AND zoom_level=?;
+                """, ("tiles", zoom))
+            bitmaps = cursor.fetchall()
+        else:
+            bitmaps = None
+        if bitmaps:
+            coverage = TileCoverage.from_bitmaps(bitmaps)
+        else:
+            coverage = self.__scan_coverage(zoom)
+            changed = True
+        with self.__coverage_lock:
+            if zoom not in self.__coverage:
+                self.__coverage[zoom] = coverage
+                if changed:
+                    self.__coverage_changed.add(zoom)
+            return self.__coverage[zoom]
+
+
+    def __check_stored_coverage(self, cursor):
+        """
+        Returns whether stored coverage bitmaps exist and were stored at the
+        current sequence number of the tiles table.
+        """
+        if "gpkgx_tile_coverage" not in table_names(self.__read_connection()):
+            return False
+        cursor.execute("""
+            SELECT MIN(tiles_sequence), MAX(tiles_sequence)
+            FROM gpkgx_tile_coverage WHERE table_name=?;
+            """, ("tiles", ))
+        min_sequence, max_sequence = cursor.fetchone()
+        return (
+            min_sequence is not None and
+            min_sequence == max_sequence == self.__tiles_sequence(cursor)
+            )
+
+
+    def __scan_coverage(self, zoom):
+        """
+        Builds the coverage bitmap of a zoom level from its tiles, adding
+        coverage_scan_size tiles at a time.
+        """
+        coverage = TileCoverage()
+        cursor = self.__read_connection().cursor()
+        cursor.arraysize = coverage_scan_size
+        cursor.execute("""
+            SELECT DISTINCT tile_row, tile_column FROM tiles
+            WHERE zoom_level=?;
+            """, (zoom, ))
+        while True:
+            keys = cursor.fetchmany()
+            if not keys:
+                return coverage
+            keys = np.array(keys, dtype="int64")
+            coverage.add_keys(keys[:, 0], keys[:, 1])
+
+
+    def __add_coverage(self, keys):
+        """
+        Adds written (zoom, row, col) tiles to loaded coverage bitmaps. The
+        stored bitmaps of the other zoom levels become outdated.
+        """
+        with self.__coverage_lock:
+            for zoom, row, col in keys:
+                coverage = self.__coverage.get(zoom)
+                if coverage is None:
+                    self.__coverage_outdated.add(zoom)
+                    continue
+                coverage.add(row, col)
+                self.__coverage_changed.add(zoom)
+
+
+    def __store_coverage(self):
+        """
+        Writes the changed coverage bitmaps, one row per block, together with
+        the sequence number of the tiles table, which tells whether tiles
+        were written since. Stored bitmaps of zoom levels not loaded are kept
+        if they are still up to date, otherwise removed.
+        """
+        with self.__coverage_lock:
+            if not self.__coverage_changed:
+                return
+            changed = dict(
+                (zoom, self.__coverage[zoom])
+                for zoom in self.__coverage_changed
+                )
+            outdated = set(self.__coverage_outdated)
+            stored_coverage = self.__stored_coverage
+            self.__coverage_changed = set()
+            self.__coverage_outdated = set()
+            self.__stored_coverage = True
+        with self.db_connection as db_connection:
+            cursor = db_connection.cursor()
+            sequence = self.__tiles_sequence(cursor)
+            if stored_coverage:
+                cursor.executemany("""
+                    DELETE FROM gpkgx_tile_coverage
+                    WHERE table_name=? AND zoom_level=?;
+                    """,
+                    [("tiles", zoom) for zoom in set(changed) | outdated]
+                )
+                cursor.execute("""
+                    UPDATE gpkgx_tile_coverage SET tiles_sequence=?
+                    WHERE table_name=?;
+                    """, (sequence, "tiles"))
+            else:
+                cursor.execute(
+                    "DELETE FROM gpkgx_tile_coverage WHERE table_name=?;",
+                    ("tiles", )
+                    )
+            cursor.executemany("""
+                INSERT INTO gpkgx_tile_coverage (
+                    table_name,
+                    zoom_level,
+                    min_row,
+                    min_col,
+                    matrix_rows,
+                    matrix_cols,
+                    bitmap,
+                    tiles_sequence)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+                """,
+                [
+                    ("tiles", zoom, min_row, min_col, rows, cols,
+                    Binary(bitmap), sequence)
+                    for zoom, tile_coverage in changed.items()
+                    for min_row, min_col, rows, cols, bitmap in (
+                        tile_coverage.bitmaps()
+                        )
+                    ]
+            )
+
+
+    def __tiles_sequence(self, cursor):
+        """
+        Returns the AUTOINCREMENT sequence number of the tiles table, which
+        changes with every tile written. The ids of clustered layouts are not
+        increasing, so their tiles are counted instead.
+        """
+        if self.layout != "insert":
+            cursor.execute("SELECT COUNT(*) FROM tiles;")
+            return cursor.fetchone()[0]
+        cursor.execute("""
+            SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name=?;
+            """, ("tiles", ))
+        return cursor.fetchone()[0]
+
+
+    def get_timestamps(self, zoom, row, col):
+        """
+        Returns the timestamps of the time slices of a tile of a chunked file
+        as a list indexed by time; slices without timestamp are None.
+        """
+        try:
+            assert self.chunked
+        except:
+            raise AttributeError("timestamps are only stored in chunked files")
+        cursor = self.__read_connection().cursor()
+        try:
+            cursor.execute("""
+                SELECT DISTINCT tiles.tile_time, timestamp from tiles
+                LEFT JOIN tile_times USING
+                    (zoom_level, tile_column, tile_row, tile_time)
+                WHERE zoom_level=? AND tile_row=? AND tile_column=?
+                ORDER BY tiles.tile_time;
+            """, (zoom, row, col))
+        except:
+            raise
+        return [timestamp for time, timestamp in cursor.fetchall()]
+
+
+    def __read_chunks(self, zoom, row, col, time=None, bands=None):
+        """
+        Reads and decodes the chunks of the requested bands and time slices
+        of a tile from a chunked file.
+        """
+        tile_shape = self.metadata["tile_shape"]
+        try:
+            assert time is None or len(tile_shape) == 4
+            assert bands is None or len(tile_shape) >= 3
+        except:
+            raise IndexError("too many indices for %sD tiles" % len(tile_shape))
+        cursor = self.__read_connection().cursor()
+        try:
+            cursor.execute("""
+                SELECT MAX(tile_time) + 1, MAX(tile_band) + 1 from tiles WHERE
+                zoom_level=? AND tile_row=? AND tile_column=?;
+            """, (zoom, row, col))
+        except:
+            raise
+        time_count, band_count = cursor.fetchone()
+        if time_count is None:
+            return None
+        times = _chunk_indexes(time, time_count)
+        band_indexes = _chunk_indexes(bands, band_count)
+        try:
+            cursor.execute("""
+                SELECT %s from tiles WHERE
+                zoom_level=? AND tile_row=? AND tile_column=? AND
+                tile_time IN (%s) AND tile_band IN (%s);
+            """ % (
+                self.__tile_columns,
+                ", ".join(str(index) for index in set(times)),
+                ", ".join(str(index) for index in set(band_indexes))
+                ),
+                (zoom, row, col)
+                )
+        except:
+            raise
+        data = self.__stack_chunks(cursor.fetchall(), times, band_indexes)
+        if isinstance(time, numbers.Integral) or len(tile_shape) < 4:
+            data = data[:, :, :, 0]
+        if isinstance(bands, numbers.Integral) or len(tile_shape) < 3:
+            data = data[:, :, 0]
+        return data
+
+
+    def __stack_chunks(self, rows, times, bands):
+        """
+        Decodes (time, band, data, tag, ...) chunk rows into an array of shape
+        (height, width, bands, times) holding the given band and time indices.
+        Empty selections return an empty array, missing chunks raise an
+        IOError.
+        """
+        if not times or not bands:
+            return np.empty(
+                tuple(self.metadata["tile_shape"][:2]) + (
+                    len(bands),
+                    len(times)
+                    ),
+                dtype=self.metadata["dtype"]
+                )
+        chunks = dict(
+            ((time, band), self.__decode_value(
+                data,
+                tag,
+                self.metadata["tile_shape"][:2]
+                ))
+            for time, band, data, tag, tile_hash, fill in rows
+            )
+        for time in times:
+            for band in bands:
+                try:
+                    assert (time, band) in chunks
+                except:
+                    raise IOError(
+                        "incomplete tile, chunk of time slice %s and band %s "
+                        "is missing" % (time, band)
+                        )
+        sample = next(iter(chunks.values()))
+        stacked = np.empty(
+            sample.shape + (len(bands), len(times)),
+            dtype=sample.dtype
+            )
+        for time_position, time in enumerate(times):
+            for band_position, band in enumerate(bands):
+                stacked[:, :, band_position, time_position] = chunks[(time, band)]
+        return stacked
+
+
+    def get_tiles(self, zoom, row_range, col_range):
+        """
+        Returns all existing tiles of a zoom level within the given rows and
+        columns as a dictionary {(row, col): data}.
+        - row_range, col_range: row and column indices, e.g. range(4, 8); all
+          tiles between the lowest and the highest index are returned
+        All tiles are fetched with one query using the tiles table index.
+        """
+        return dict(
+            ((row, col), data)
+            for row, col, data in self.__select_tiles(
+                zoom,
+                min(row_range),
+                max(row_range),
+                min(col_range),
+                max(col_range)
+                )
+            )
+
+
+    def get_window(self, zoom, bbox, fill_value=0):
+        """
+        Returns the tiles within a bounding box mosaicked into one array.
+        - bbox: tile indices (min_col, min_row, max_col, max_row), including the
+          maximum column and row
+        - fill_value: value used where tiles are missing
+        The output array is allocated once when the first tile is read and
+        every decoded tile is copied directly into its place. Returns None if
+        there are no tiles within the bounding box.
+        """
+        min_col, min_row, max_col, max_row = bbox
+        window = None
+        for row, col, data in self.__select_tiles(
+            zoom,
+            min_row,
+            max_row,
+            min_col,
+            max_col
+            ):
+            height, width = data.shape[:2]
+            if window is None:
+                window = np.full(
+                    (
+                        (max_row - min_row + 1) * height,
+                        (max_col - min_col + 1) * width
+                        ) + data.shape[2:],
+                    fill_value,
+                    dtype=data.dtype
+                    )
+            top = (row - min_row) * height
+            left = (col - min_col) * width
+            window[top:top+height, left:left+width] = data
+        return window
+
+
+    def __select_tiles(self, zoom, min_row, max_row, min_col, max_col):
+        """
+        Yields decoded (row, col, data) tuples of a tile range from one query.
+        """
+        cursor = self.__read_connection().cursor()
+        try:
+            cursor.execute("""
+                SELECT tile_row, tile_column, %s from %s WHERE
+                zoom_level=? AND
+                tile_column BETWEEN ? AND ? AND
+                tile_row BETWEEN ? AND ?;
+            """ % (self.__tile_columns, self.__tiles_source),
+                (zoom, min_col, max_col, min_row, max_row)
+                )
+        except:
+            raise
+        rows = cursor.fetchall()
+        if self.chunked:
+            for row, col, tile in self.__stack_tiles(rows):
+                yield row, col, tile
+            return
+        for row, col, data, tag, tile_hash, fill in rows:
+            yield row, col, self.__decode_tile(data, tag, tile_hash, fill)
+
+
+    def __stack_tiles(self, rows):
+        """
+        Yields (row, col, data) tuples of whole tiles from the (row, col,
+        time, band, ...) chunk rows of a chunked file.
+        """
+        tiles = OrderedDict()
+        for chunk in rows:
+            tiles.setdefault(chunk[:2], []).append(chunk[2:])
+        for (row, col), chunks in tiles.items():
+            yield row, col, self.__stack_tile(chunks)
+
+
+    def __stack_tile(self, chunks):
+        """
+        Decodes the (time, band, ...) chunk rows of one whole tile of a
+        chunked file.
+        """
+        ndim = len(self.metadata["tile_shape"])
+        data = self.__stack_chunks(
+            chunks,
+            range(max(chunk[0] for chunk in chunks) + 1),
+            range(max(chunk[1] for chunk in chunks) + 1)
+            )
+        if ndim < 4:
+            data = data[:, :, :, 0]
+        if ndim < 3:
+            data = data[:, :, 0]
+        return data
+
+
+    def iter_tiles(
+        self,
+        zoom=None,
+        order="hilbert",
+        decode=True,
+        workers=1,
+        batch_size=256
+        ):
+        """
+        Yields (zoom, row, col, data) of all tiles of a zoom level, or of all
+        zoom levels from the lowest, streamed from one query.
+        - order: "hilbert" yields the tiles of a zoom level along a Hilbert
+          curve (see hilbert_index()), "rowmajor" row by row
+        - decode: if False, data is the stored tile_data value (for chunked
+          files a list of ((time, band), tile_data), for constant tiles of
+          deduplicated files None)
+        - workers: number of threads decoding tiles, which are still yielded
+          in order
+        - batch_size: number of rows fetched from SQLite at once
+        Only batch_size rows and 2 * workers tiles are held in memory at a
+        time. SQLite sorts only the ids of the tiles, whose data is then read
+        by id; files of the layout of the order are read without sorting.
+        Tiles must not be written while iterating.
+        """
+        try:
+            assert order in tile_orders
+        except:
+            raise AttributeError("unknown order %s" % order)
+        db_connection = self.__read_connection()
+        db_connection.create_function("hilbert_index", 3, hilbert_index)
+        order_by = "zoom_level, " + tile_orders[order]
+        if self.chunked:
+            order_by += ", tile_time, tile_band"
+        where, parameters = "", ()
+        if zoom is not None:
+            where, parameters = "WHERE zoom_level=?", (zoom, )
+        cursor = db_connection.cursor()
+        cursor.arraysize = batch_size
+        if order == self.layout:
+            # The tiles are stored in this order already, a zoom level is an
+            # id range (see tile_key()).
+            if zoom is not None:
+                where, parameters = "WHERE id BETWEEN ? AND ?", (
+                    zoom << 56,
+                    ((zoom + 1) << 56) - 1
+                    )
+            try:
+                cursor.execute("""
+                    SELECT zoom_level, tile_row, tile_column, %s from %s
+                    %s ORDER BY id;
+                """ % (self.__tile_columns, self.__tiles_source, where),
+                    parameters
+                    )
+            except:
+                raise
+            rows = _fetch_rows(cursor)
+        else:
+            try:
+                cursor.execute("""
+                    SELECT id from tiles %s ORDER BY %s;
+                """ % (where, order_by), parameters)
+            except:
+                raise
+            rows = self.__rows_by_id(cursor, batch_size)
+        if self.chunked:
+            tiles = (
+                key + ([chunk[3:] for chunk in chunks], )
+                for key, chunks in groupby(rows, lambda chunk: chunk[:3])
+                )
+        else:
+            tiles = ((row[:3] + (row[3:], )) for row in rows)
+        if not decode:
+            for zoom, row, col, columns in tiles:
+                if self.chunked:
+                    columns = [(chunk[:2], chunk[2]) for chunk in columns]
+                else:
+                    columns = columns[0]
+                yield zoom, row, col, columns
+            return
+        if workers == 1:
+            for tile in tiles:
+                yield self.__decode_row(*tile)
+            return
+        pool = ThreadPool(workers)
+        try:
+            for tile in imap_bounded(
+                pool,
+                self.__decode_row,
+                tiles,
+                2 * workers
+                ):
+                yield tile
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+    def __rows_by_id(self, id_cursor, batch_size):
+        """
+        Yields the (zoom, row, col, tile columns...) rows of the tile ids
+        returned by a query in their order, reading batch_size rows at once.
+        """
+        cursor = self.__read_connection().cursor()
+        while True:
+            ids = [tile_id for tile_id, in id_cursor.fetchmany(batch_size)]
+            if not ids:
+                return
+            try:
+                cursor.execute("""
+                    SELECT id, zoom_level, tile_row, tile_column, %s from %s
+                    WHERE id IN (%s);
+                """ % (
+                    self.__tile_columns,
+                    self.__tiles_source,
+                    ", ".join(str(tile_id) for tile_id in ids)
+                    ))
+            except:
+                raise
+            rows = dict((row[0], row[1:]) for row in cursor.fetchall())
+            for tile_id in ids:
+                yield rows[tile_id]
+
+
+    def __decode_row(self, zoom, row, col, columns):
+        """
+        Decodes the tile columns (or chunk rows) read by iter_tiles().
+        """
+        if self.chunked:
+            return zoom, row, col, self.__stack_tile(columns)
+        return zoom, row, col, self.__decode_tile(*columns)
+
+
+    def __decode_tile(self, data, tag=None, tile_hash=None, fill=None):
+        """
+        Decodes a tile_data value using the file metadata and, in adaptive
+        files, the codec of the tile_codec tag. Blobs and fill values of
+        deduplicated files are decoded once and shared as read-only arrays
+        by all their tiles (see blob_cache).
+        """
+        if self.blob_cache is not None:
+            key = tile_hash or ("fill", bytes(fill))
+            decoded = self.blob_cache.get(key)
+            if decoded is None:
+                if tile_hash is None:
+                    decoded = _decode_constant(
+                        fill,
+                        self.metadata.get("dtype"),
+                        self.metadata.get("tile_shape"),
+                        None
+                        )
+                else:
+                    decoded = self.__decode_value(data, tag)
+                self.blob_cache.put(key, decoded)
+            return decoded
+        return self.__decode_value(data, tag)
+
+
+    def __decode_value(self, data, tag=None, shape=None):
+        """
+        Decodes a tile_data value with the codec of the file or of its tag.
+        """
+        codec, options = self.codec, self.compression_options
+        if tag is not None:
+            codec, options = self.tag_codecs[tag]
+        return codec.decode(
+            data,
+            self.metadata.get("dtype"),
+            shape or self.metadata.get("tile_shape"),
+            options,
+            self.predictor
+            )
+
+
+    def build_pyramid(
+        self,
+        base_zoom,
+        min_zoom=0,
+        resampling="mean",
+        batch_size=1000
+        ):
+        """
+        Creates the lower zoom levels from base_zoom down to min_zoom.
+        - base_zoom: existing zoom level the pyramid is built from
+        - min_zoom: lowest zoom level to be created
+        - resampling: "mean", "nearest" or "mode" (see downsample_tiles())
+        - batch_size: number of tiles written per transaction
+        Every level is computed from the level above. Parent tiles are built
+        and written one by one, so only four child tiles are held in memory.
+        The gpkg_tile_matrix rows of all levels are written as well.
+        """
+        try:
+            assert resampling in resampling_methods
+        except:
+            raise AttributeError("unknown resampling %s" % resampling)
+        try:
+            assert 0 <= min_zoom <= base_zoom
+        except:
+            raise AttributeError(
+                "invalid zoom levels %s, %s" % (base_zoom, min_zoom)
+                )
+        self.set_tile_matrix(base_zoom)
+        for zoom in range(base_zoom - 1, min_zoom - 1, -1):
+            self.insert_tiles(
+                self.__downsampled_tiles(zoom, resampling),
+                batch_size=batch_size
+                )
+            self.set_tile_matrix(zoom)
+
+
+    def set_tile_matrix(self, zoom):
+        """
+        Writes the gpkg_tile_matrix row of a zoom level.
+        """
+        try:
+            tile_height, tile_width = self.metadata["tile_shape"][:2]
+        except KeyError:
+            raise IOError("no tiles written yet")
+        tile_matrix_set = tile_matrix_sets[self.srs]
+        min_x, min_y, max_x, max_y = tile_matrix_set["bounds"]
+        matrix_width = tile_matrix_set["matrix_width"] * 2**zoom
+        matrix_height = tile_matrix_set["matrix_height"] * 2**zoom
+        with self.db_connection as db_connection:
+            cursor = db_connection.cursor()
+            try:
+                cursor.execute("""
+                    INSERT OR REPLACE INTO gpkg_tile_matrix (
+                        table_name,
+                        zoom_level,
+                        matrix_width,
+                        matrix_height,
+                        tile_width,
+                        tile_height,
+                        pixel_x_size,
+                        pixel_y_size)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+                    """,
+                    (
+                    "tiles",
+                    zoom,
+                    matrix_width,
+                    matrix_height,
+                    tile_width,
+                    tile_height,
+                    (max_x - min_x) / (matrix_width * tile_width),
+                    (max_y - min_y) / (matrix_height * tile_height)
+                    )
+                )
+            except:
+                raise
+
+
+    def update_pyramid(
+        self,
+        base_zoom,
+        min_zoom=0,
+        since=0,
+        resampling="mean",
+        batch_size=1000
+        ):
+        """
+        Recomputes the lower zoom levels from base_zoom down to min_zoom
+        only where tiles of base_zoom were written after the change since
+        (see get_changes()). Existing parent tiles are replaced.
+        Returns the id of the latest change of base_zoom, to be passed as
+        since to the next update.
+        """
+        try:
+            assert resampling in resampling_methods
+        except:
+            raise AttributeError("unknown resampling %s" % resampling)
+        changes = self.get_changes(since, zoom=base_zoom)
+        parents = set((row // 2, col // 2) for change, zoom, row, col in changes)
+        for zoom in range(base_zoom - 1, min_zoom - 1, -1):
+            self.insert_tiles(
+                self.__downsampled_tiles(zoom, resampling, sorted(parents)),
+                batch_size=batch_size,
+                on_conflict="replace"
+                )
+            self.set_tile_matrix(zoom)
+            parents = set((row // 2, col // 2) for row, col in parents)
+        return max([since] + [change for change, zoom, row, col in changes])
+
+
+    def get_changes(self, since=0, zoom=None):
+        """
+        Returns the tiles written after the change since as (change_id, zoom,
+        row, col) tuples ordered by change_id. Every tile is listed once with
+        its latest change.
+        - zoom: only return tiles of this zoom level
+        Only available for files created with change_log.
+        """
+        try:
+            assert self.change_log
+        except:
+            raise AttributeError("file has no change log")
+        query = """
+            SELECT change_id, zoom_level, tile_row, tile_column FROM
+            tile_changes WHERE change_id > ?
+            """
+        args = (since, )
+        if zoom is not None:
+            query += "AND zoom_level = ? "
+            args += (zoom, )
+        cursor = self.__read_connection().cursor()
+        cursor.execute(query + "ORDER BY change_id;", args)
+        return cursor.fetchall()
+
+
+    def clear_changes(self, until=None):
+        """
+        Removes the changes up to and including the change until, by default
+        all changes, from the change log.
+        """
+        try:
+            assert self.change_log
+        except:
+            raise AttributeError("file has no change log")
+        with self.db_connection as db_connection:
+            cursor = db_connection.cursor()
+            if until is None:
+                cursor.execute("DELETE FROM tile_changes;")
+            else:
+                cursor.execute(
+                    "DELETE FROM tile_changes WHERE change_id <= ?;",
+                    (until, )
+                    )
+
+
+    def __downsampled_tiles(self, zoom, resampling, parents=None):
+        """
+        Yields (zoom, row, col, data) tuples of all parent tiles of the next
+        higher zoom level or of the given (row, col) parents.
+        """
+        if parents is None:
+            cursor = self.db_connection.cursor()
+            cursor.execute("""
+                SELECT DISTINCT tile_row / 2, tile_column / 2 FROM tiles
+                WHERE zoom_level=? ORDER BY 1, 2;
+                """, (zoom + 1, ))
+            parents = cursor.fetchall()
+        for row, col in parents:
+            children = self.get_tiles(
+                zoom + 1,
+                (2 * row, 2 * row + 1),
+                (2 * col, 2 * col + 1)
+                )
+            if not children:
+                continue
+            yield zoom, row, col, downsample_tiles(
+                dict(
+                    ((child_row - 2 * row, child_col - 2 * col), data)
+                    for (child_row, child_col), data in children.items()
+                    ),
+                resampling
+                )
+
+
+    def close(self):
+        """
+        Closes the connection and all reader connections. Coverage bitmaps
+        changed by writing tiles are stored first.
+        """
+        if self.mode != "r":
+            self.__store_coverage()
+        with self.__readers_lock:
+            for db_connection in self.__reader_connections:
+                db_connection.close()
+            self.__reader_connections = []
+        self.__thread_local = threading.local()
+        self.db_connection.close()
+
+
+    def __exit__(self, *args):
+        """Resource cleanup on destruction."""
+        self.close()
+
+
+def connect_read_only(file_path, immutable=False):
+    """
+    Opens a read only connection which may be closed from other threads.
+    Uses an URI with mode=ro (and immutable=1) where sqlite3 supports URIs,
+    otherwise PRAGMA query_only; immutable has no effect then.
+    """
+    uri = "file:%s?mode=ro" % pathname2url(os.path.abspath(file_path))
+    if immutable:
+        uri += "&immutable=1"
+    try:
+        db_connection = connect(
+            uri,
+            uri=True,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False
+            )
+    except TypeError:
+        # Python 2 sqlite3 does not support URIs.
+        db_connection = connect(
+            file_path,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False
+            )
+        db_connection.execute("PRAGMA query_only=1;")
+    db_connection.text_factory = str
+    return db_connection
+
+
+class TileCodec():
+    """
+    Encoder and decoder of one tile format, registered in tile_codecs.
+    - data_type, compression: data_type and compression of the files using
+      the codec
+    - encoder: function(data, options) returning the tile_data value;
+      function(data, options, predictor) if predictor_tag is set
+    - decoder: function(data, dtype, shape, options) returning the array
+    - dtypes: {dtype: bands} of the supported arrays, bands being a tuple of
+      band counts with None for 2D arrays or None for any; None supports all
+      arrays
+    - options: default settings (compression_options) or None
+    - option_values: {option: allowed values or function(value) returning
+      whether the value is allowed}
+    - extra_options: get_options() also accepts options missing in the
+      defaults, which the encoder passes on (adaptive)
+    - column_type: SQL type of the tile_data column
+    - array: tiles are stored without dtype and shape, so all tiles need the
+      dtype and shape of the first tile written
+    - predictor_tag: the encoder applies the predictor and the decoder reverses
+      it on its own (e.g. TIFF Predictor tag)
+    - available: False if a package needed by the codec is missing
+    """
+
+    def __init__(
+        self,
+        data_type,
+        compression,
+        encoder,
+        decoder,
+        dtypes=None,
+        options=None,
+        option_values=None,
+        extra_options=False,
+        column_type="BLOB",
+        array=False,
+        predictor_tag=False,
+        available=True
+        ):
+        self.data_type = data_type
+        self.compression = compression
+        self.encoder = encoder
+        self.decoder = decoder
+        self.dtypes = dtypes
+        self.options = options
+        self.option_values = option_values or {}
+        self.extra_options = extra_options
+        self.column_type = column_type
+        self.array = array
+        self.predictor_tag = predictor_tag
+        self.available = available
+
+
+    def get_options(self, options=None):
+        """
+        Returns the complete settings, taking the ones missing in options from
+        the defaults. Codecs without settings return None.
+        """
+        if self.options is None:
+            try:
+                assert not options
+            except:
+                raise AttributeError(
+                    "compression %s does not take options" % self.compression
+                    )
+            return None
+        options = options or {}
+        unknown = set(options) - set(self.options)
+        try:
+            assert self.extra_options or not unknown
+        except:
+            raise AttributeError(
+                "unknown compression options %s" % ", ".join(sorted(unknown))
+                )
+        codec_options = dict(self.options)
+        codec_options.update(options)
+        for option, values in self.option_values.items():
+            try:
+                if callable(values):
+                    assert values(codec_options[option])
+                else:
+                    assert codec_options[option] in values
+            except:
+                raise AttributeError(
+                    "%s %s not supported by %s" % (
+                        option,
+                        codec_options[option],
+                        self.compression
+                        )
+                    )
+        return codec_options
+
+
+    def bind(self, **kwargs):
+        """
+        Returns a copy of the codec whose encoder gets the keyword arguments
+        on every call, e.g. settings prepared once per file.
+        """
+        codec = copy.copy(self)
+        codec.encoder = partial(self.encoder, **kwargs)
+        return codec
+
+
+    def check(self, data):
+        """
+        Raises a TypeError if the codec does not support the array.
+        """
+        if self.dtypes is None:
+            return
+        try:
+            bands = self.dtypes[str(data.dtype)]
+            if bands is None:
+                assert data.ndim in (2, 3)
+            else:
+                assert (data.shape[2] if data.ndim == 3 else None) in bands
+                assert data.ndim in (2, 3)
+        except:
+            raise TypeError(
+                "%s does not support %s arrays of dtype %s" % (
+                    self.compression or self.data_type,
+                    data.shape,
+                    data.dtype
+                    )
+                )
+
+
+    def encode(self, data, options=None, predictor=None):
+        """
+        Encodes an array into the tile_data value.
+        """
+        self.check(data)
+        if options is None:
+            options = self.get_options()
+        if self.predictor_tag:
+            return self.encoder(data, options, predictor)
+        return self.encoder(apply_predictor(data, predictor), options)
+
+
+    def decode(self, data, dtype=None, shape=None, options=None, predictor=None):
+        """
+        Decodes a tile_data value into an array. Codecs storing arrays need
+        dtype and shape.
+        """
+        if options is None:
+            options = self.get_options()
+        data = self.decoder(data, dtype, shape, options)
+        if self.predictor_tag:
+            return data
+        return reverse_predictor(data, predictor)
+
+
+def register_codec(codec):
+    """
+    Adds a TileCodec to tile_codecs, replacing a codec of the same data_type
+    and compression.
+    """
+    tile_codecs[(codec.data_type, codec.compression)] = codec
+
+
+def get_codec(data_type, compression=None):
+    """
+    Returns the TileCodec registered for data_type and compression.
+    """
+    try:
+        codec = tile_codecs[(data_type, compression)]
+    except KeyError:
+        raise AttributeError("Unknown compression %s" % compression)
+    if not codec.available:
+        raise ImportError("compression %s is not available" % compression)
+    return codec
+
+
+def encode_tile(
+    data,
+    data_type,
+    compression=None,
+    options=None,
+    predictor=None
+    ):
+    """
+    Encodes a numpy array into the value stored in the tile_data column.
+    - options: codec settings (see TileCodec.get_options())
+    - predictor: filter applied before compression (see apply_predictor())
+    """
+    return get_codec(data_type, compression).encode(data, options, predictor)
+
+
+def decode_tile(
+    data,
+    data_type,
+    compression=None,
+    dtype=None,
+    shape=None,
+    options=None,
+    predictor=None
+    ):
+    """
+    Decodes a tile_data value into a numpy array. Raw, blosc: and zstandard
+    tiles need dtype and shape; raw tiles are returned as read-only arrays
+    using the blob memory.
+    - options: codec settings (see TileCodec.get_options())
+    - predictor: filter reversed after decompression
+    """
+    return get_codec(data_type, compression).decode(
+        data,
+        dtype,
+        shape,
+        options,
+        predictor
+        )
+
+
+def adaptive_codecs(data_type, options):
+    """
+    Returns the (codec, settings) tuples of an adaptive file by tile_codec
+    tag: the constant codec followed by the candidates. Every candidate gets
+    the options of the adaptive settings it takes.
+    """
+    adaptive_options = get_codec(data_type, "adaptive").options
+    extra_options = dict(
+        (option, value) for option, value in options.items()
+        if option not in adaptive_options
+        )
+    codecs = [(get_codec(data_type, "constant"), None)]
+    used = set()
+    for compression in options["candidates"]:
+        codec = get_codec(data_type, compression)
+        try:
+            assert codec.column_type != "ARRAY"
+            assert compression not in ("adaptive", "constant")
+        except:
+            raise AttributeError(
+                "compression %s cannot be used by adaptive" % compression
+                )
+        codec_options = dict(
+            (option, value) for option, value in extra_options.items()
+            if codec.options is not None and option in codec.options
+            )
+        used.update(codec_options)
+        codecs.append((codec, codec.get_options(codec_options)))
+    unknown = set(extra_options) - used
+    try:
+        assert not unknown
+    except:
+        raise AttributeError(
+            "unknown compression options %s" % ", ".join(sorted(unknown))
+            )
+    return codecs
+
+
+def _adaptive_dtypes(codecs):
+    """
+    Returns the dtypes (see TileCodec) supported by at least one candidate of
+    adaptive_codecs(), None if a candidate supports all arrays.
+    """
+    dtypes = {}
+    for codec, codec_options in codecs[1:]:
+        if codec.dtypes is None:
+            return None
+        for dtype, bands in codec.dtypes.items():
+            if bands is None or dtypes.get(dtype, ()) is None:
+                dtypes[dtype] = None
+            else:
+                dtypes[dtype] = tuple(set(dtypes.get(dtype, ())) | set(bands))
+    return dtypes
+
+
+def _valid_sample(sample):
+    # Share of the tile rows compared by adaptive, see _encode_adaptive().
+    return (
+        not isinstance(sample, bool) and
+        isinstance(sample, (int, float)) and
+        0 < sample <= 1
+        )
+
+
+def _stored_codec_options(options):
+    """
+    Returns codec settings as stored in the codec_options metadata: without
+    the dictionary and the runtime_codec_options and as read back from JSON.
+    """
+    if not options:
+        return None
+    return json.loads(json.dumps(dict(
+        (key, value)
+        for key, value in options.items()
+        if key != "dictionary" and key not in runtime_codec_options
+        )))
+
+
+def _encode_adaptive(data, options, predictor, data_type, codecs=None):
+    """
+    Encodes a tile with the candidate codec writing the smallest tiles and
+    returns a (tag, value) tuple. Constant tiles are stored as one value.
+    The candidates are compared on every n-th row of the tile, n being
+    1 / options["sample"].
+    - codecs: adaptive_codecs() of the options, looked up if not given
+    """
+    data = np.asarray(data)
+    if codecs is None:
+        codecs = adaptive_codecs(data_type, options)
+    if options["constant"] and (data == data.flat[0]).all():
+        return 0, codecs[0][0].encode(data)
+    sample = data
+    if options["sample"] < 1 and len(codecs) > 2:
+        sample = data[::int(round(1. / options["sample"]))]
+    sizes = []
+    for tag, (codec, codec_options) in enumerate(codecs[1:], 1):
+        try:
+            value = codec.encode(sample, codec_options, predictor)
+        except TypeError:
+            # Candidate does not support the dtype.
+            continue
+        sizes.append((_value_size(value), tag, value))
+    try:
+        assert sizes
+    except:
+        raise TypeError("no adaptive candidate supports dtype %s" % data.dtype)
+    size, tag, value = min(sizes, key=lambda size: size[:2])
+    if sample is not data:
+        codec, codec_options = codecs[tag]
+        value = codec.encode(data, codec_options, predictor)
+    if not isinstance(value, Binary):
+        value = Binary(value)
+    return tag, value
+
+
+def _decode_adaptive(data, dtype, shape, options):
+    # Adaptive tiles are decoded by the codecs of their tags.
+    raise IOError("adaptive tiles need their tile_codec tag")
+
+
+def _encode_constant(data, options, predictor):
+    data = np.asarray(data)
+    try:
+        assert (data == data.flat[0]).all()
+    except:
+        raise TypeError("tile is not constant")
+    return Binary(np.ascontiguousarray(data.flat[:1]))
+
+
+def _decode_constant(data, dtype, shape, options):
+    return np.full(shape, np.frombuffer(data, dtype=dtype)[0], dtype=dtype)
+
+
+def tile_chunks(data):
+    """
+    Splits a tile of shape (height, width[, bands[, time]]) into 2D chunks,
+    one per band and time slice, and returns them as ((time, band), chunk)
+    tuples.
+    """
+    data = np.asarray(data)
+    data = data.reshape(data.shape[:2] + (-1, ) + data.shape[3:4])
+    if data.ndim == 3:
+        data = data[:, :, :, np.newaxis]
+    return [
+        ((time, band), np.ascontiguousarray(data[:, :, band, time]))
+        for time in range(data.shape[3])
+        for band in range(data.shape[2])
+        ]
+
+
+def _chunk_indexes(index, size):
+    """
+    Returns the list of indices selected by an index, slice or list of
+    indices from an axis of the given size.
+    """
+    indexes = range(size)
+    if index is None:
+        return indexes
+    if isinstance(index, slice):
+        return indexes[index]
+    if isinstance(index, numbers.Integral):
+        return [indexes[index]]
+    return [indexes[position] for position in index]
+
+
+def _select_chunks(data, time=None, bands=None):
+    """
+    Returns data[:, :, bands, time] applying both indices independently.
+    """
+    if time is not None:
+        try:
+            assert data.ndim == 4
+        except:
+            raise IndexError("too many indices for %sD tiles" % data.ndim)
+        data = data[:, :, :, time]
+    if bands is not None:
+        try:
+            assert data.ndim >= 3
+        except:
+            raise IndexError("too many indices for %sD tiles" % data.ndim)
+        data = data[:, :, bands]
+    return data
+
+
+def _tile_hash(data):
+    """
+    Returns the content hash of a tile: the SHA-1 hex digest of its dtype,
+    shape and values.
+    """
+    data = np.ascontiguousarray(data)
+    content = hashlib.sha1(("%s %s " % (data.dtype.str, data.shape)).encode())
+    content.update(data)
+    return content.hexdigest()
+
+
+def _value_size(value):
+    """
+    Returns the number of bytes of an encoded tile_data value.
+    """
+    try:
+        return memoryview(value).nbytes
+    except (TypeError, AttributeError):
+        # Python 2 buffer and memoryview objects
+        return len(value)
+
+
+def _encode_array(data, options):
+    # Stored as .npy by adapt_array().
+    return data
+
+
+def _decode_array(data, dtype, shape, options):
+    return data
+
+
+def _encode_blosc(data, options, cname):
+    _set_blosc_threads(options)
+    value = blosc.pack_array(
+        data,
+        clevel=options["clevel"],
+        shuffle=blosc_shuffles[options["shuffle"]],
+        cname=cname
+        )
+    if cname in blosc_verified and (
+        blosc.unpack_array(value).tobytes() != np.asarray(data).tobytes()
+        ):
+        return _encode_blosc(data, options, blosc_verified[cname])
+    return value
+
+
+def _decode_blosc(data, dtype, shape, options):
+    _set_blosc_threads(options)
+    # Adaptive files store blosc tiles as BLOB.
+    return blosc.unpack_array(bytes(data))
+
+
+def _encode_blosc_buffer(data, options, cname):
+    _set_blosc_threads(options)
+    data = np.ascontiguousarray(data)
+    typesize = _typesize(data, options)
+    value = blosc.compress_ptr(
+        data.__array_interface__["data"][0],
+        data.nbytes // typesize,
+        typesize=typesize,
+        clevel=options["clevel"],
+        shuffle=blosc_shuffles[options["shuffle"]],
+        cname=cname
+        )
+    if cname in blosc_verified and (
+        blosc.decompress(value) != data.tobytes()
+        ):
+        return _encode_blosc_buffer(data, options, blosc_verified[cname])
+    return Binary(value)
+
+
+def _decode_blosc_buffer(data, dtype, shape, options):
+    _set_blosc_threads(options)
+    array = np.empty(shape, dtype=dtype)
+    blosc.decompress_ptr(bytes(data), array.__array_interface__["data"][0])
+    return array
+
+
+def _encode_zstandard(data, options):
+    return Binary(_zstd_codec(options).compress(
+        _shuffle_bytes(np.ascontiguousarray(data), options)
+        ))
+
+
+def _decode_zstandard(data, dtype, shape, options):
+    return _unshuffle_bytes(
+        _zstd_codec(options, decompress=True).decompress(
+            data,
+            max_output_size=int(np.prod(shape)) * np.dtype(dtype).itemsize
+            ),
+        dtype,
+        shape,
+        options
+        )
+
+
+def _encode_raw(data, options):
+    # The buffer shares the array memory.
+    return Binary(np.ascontiguousarray(data))
+
+
+def _decode_raw(data, dtype, shape, options):
+    return np.frombuffer(data, dtype=dtype).reshape(shape)
+
+
+def _encode_tiff_tile(data, options, predictor, compression):
+    return Binary(encode_tiff(data, compression, predictor))
+
+
+def _decode_tiff_tile(data, dtype, shape, options):
+    return decode_tiff(data)
+
+
+def _encode_pillow(data, options, image_format, **save_options):
+    """
+    Encodes a tile with Pillow. Codec settings are passed on to
+    Image.save().
+    """
+    save_options.update(options or {})
+    buf = ioBuffer()
+    Image.fromarray(np.ascontiguousarray(data)).save(
+        buf,
+        image_format,
+        **save_options
+        )
+    return Binary(buf.getvalue())
+
+
+def _decode_pillow(data, dtype, shape, options):
+    """
+    Decodes a tile with Pillow. Returns arrays of the dtype and number of
+    bands written, e.g. 16 bit PNGs may be read as 32 bit integers and
+    greyscale WebPs as RGB.
+    """
+    data = np.array(Image.open(ioBuffer(bytes(data))))
+    if shape is not None and len(shape) == 2 and data.ndim == 3:
+        data = data[:, :, 0]
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+    return data
+
+
+def encode_tiff(data, compression=None, predictor=None):
+    """
+    Encodes a tile as TIFF with one strip, keeping the original pixel values.
+    - data: array of height x width (x bands) of a dtype in
+      tiff_sample_formats
+    - compression: None or a compression of tiff_compressions
+    - predictor: None, "horizontal" or "floating_point" (see
+      apply_predictor())
+    Compression only uses zlib, zstandard or imagecodecs without any global
+    state, so tiles can be encoded in parallel threads.
+    """
+    data = np.asarray(data)
+    try:
+        assert data.dtype.kind + str(data.itemsize) in tiff_sample_formats
+        assert data.ndim in (2, 3)
+    except:
+        raise TypeError(
+            "%s arrays of dtype %s not supported" % (data.shape, data.dtype)
+            )
+    if compression == "tiff_lzw" and imagecodecs is None:
+        return _encode_tiff_pillow(data, compression, predictor)
+    if compression == "tiff_zstd" and zstandard is None:
+        raise ImportError("zstandard is not available")
+    if compression is None:
+        # Predictors are only defined for compressed TIFFs.
+        predictor = None
+    height, width = data.shape[:2]
+    bands = data.shape[2] if data.ndim == 3 else 1
+    data = apply_predictor(
+        np.ascontiguousarray(data, dtype=data.dtype.newbyteorder("<")),
+        predictor
+        )
+    strip = _compress_tiff_strip(data.tobytes(), compression)
+    photometric = 1
+    if data.dtype == "uint8" and bands in (3, 4):
+        photometric = 2
+    # (tag, type, values); type 3 is SHORT, type 4 is LONG
+    tags = [
+        (256, 4, [width]),
+        (257, 4, [height]),
+        (258, 3, [data.itemsize * 8] * bands),
+        (259, 3, [tiff_compressions[compression]]),
+        (262, 3, [photometric]),
+        (273, 4, [0]),
+        (277, 3, [bands]),
+        (278, 4, [height]),
+        (279, 4, [len(strip)]),
+        (284, 3, [1])
+        ]
+    if predictor:
+        tags.append((317, 3, [tiff_predictors[predictor]]))
+    extra_samples = bands - (3 if photometric == 2 else 1)
+    if extra_samples:
+        tags.append((338, 3, [0] * extra_samples))
+    tags.append((339, 3, [tiff_sample_formats[
+        data.dtype.kind + str(data.itemsize)
+        ]] * bands))
+    tags = [
+        (
+            tag,
+            tag_type,
+            len(tag_values),
+            struct.pack(
+                "<%s%s" % (len(tag_values), "H" if tag_type == 3 else "I"),
+                *tag_values
+                )
+            )
+        for tag, tag_type, tag_values in tags
+        ]
+    # Header, IFD, values not fitting into the IFD entries, strip.
+    values_offset = 8 + 2 + 12 * len(tags) + 4
+    strip_offset = values_offset + sum(
+        len(packed) for tag, tag_type, count, packed in tags
+        if len(packed) > 4
+        )
+    entries = []
+    values = []
+    for tag, tag_type, count, packed in tags:
+        if tag == 273:
+            packed = struct.pack("<I", strip_offset)
+        if len(packed) > 4:
+            values.append(packed)
+            packed = struct.pack(
+                "<I",
+                values_offset + sum(len(value) for value in values[:-1])
+                )
+        entries.append(
+            struct.pack("<HHI", tag, tag_type, count) + packed.ljust(4, b"\0")
+            )
+    return b"".join(
+        [b"II", struct.pack("<HIH", 42, 8, len(tags))] + entries +
+        [struct.pack("<I", 0)] + values + [strip]
+        )
+
+
+def decode_tiff(data):
+    """
+    Decodes a TIFF tile into an array. Reads uncompressed, deflate, zstd and
+    LZW compressed TIFFs with interleaved bands, including tiles written with
+    Pillow by former versions.
+    """
+    data = bytes(data)
+    byteorder = {b"II": "<", b"MM": ">"}[data[:2]]
+    ifd_offset = struct.unpack(byteorder + "I", data[4:8])[0]
+    tags = {}
+    for entry in range(
+        struct.unpack(byteorder + "H", data[ifd_offset:ifd_offset+2])[0]
+        ):
+        offset = ifd_offset + 2 + 12 * entry
+        tag, tag_type, count = struct.unpack(
+            byteorder + "HHI",
+            data[offset:offset+8]
+            )
+        # Only SHORT and LONG values are needed.
+        if tag_type not in (3, 4):
+            continue
+        size = count * (2 if tag_type == 3 else 4)
+        value_offset = offset + 8
+        if size > 4:
+            value_offset = struct.unpack(
+                byteorder + "I",
+                data[offset+8:offset+12]
+                )[0]
+        tags[tag] = struct.unpack(
+            "%s%s%s" % (byteorder, count, "H" if tag_type == 3 else "I"),
+            data[value_offset:value_offset+size]
+            )
+    compression = tags.get(259, (1, ))[0]
+    if compression == 5 and imagecodecs is None:
+        return np.array(Image.open(ioBuffer(data)))
+    width = tags[256][0]
+    height = tags[257][0]
+    bands = tags.get(277, (1, ))[0]
+    dtype = np.dtype("%s%s%s" % (
+        byteorder,
+        {1: "u", 2: "i", 3: "f"}[tags.get(339, (1, ))[0]],
+        tags[258][0] // 8
+        ))
+    strips = b"".join(
+        _decompress_tiff_strip(data[offset:offset+count], compression)
+        for offset, count in zip(tags[273], tags[279])
+        )
+    array = reverse_predictor(
+        np.frombuffer(
+            strips,
+            dtype=dtype,
+            count=height*width*bands
+            ).reshape(height, width, bands),
+        {2: "horizontal", 3: "floating_point"}.get(tags.get(317, (1, ))[0])
+        )
+    if bands == 1:
+        array = array[:, :, 0]
+    return array.astype(dtype.newbyteorder("="))
+
+
+def _compress_tiff_strip(data, compression):
+    """
+    Compresses the bytes of a TIFF strip.
+    """
+    if compression in ("tiff_deflate", "tiff_adobe_deflate"):
+        return zlib.compress(data, 6)
+    if compression == "tiff_zstd":
+        return zstandard.ZstdCompressor(level=9).compress(data)
+    if compression == "tiff_lzw":
+        return imagecodecs.lzw_encode(data)
+    return data
+
+
+def _decompress_tiff_strip(data, compression):
+    """
+    Decompresses the bytes of a TIFF strip using the Compression tag value.
+    """
+    if compression == 1:
+        return data
+    if compression in (8, 32946):
+        return zlib.decompress(data)
+    if compression == 50000:
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    if compression == 5:
+        return imagecodecs.lzw_decode(data)
+    raise IOError("TIFF compression %s not supported" % compression)
+
+
+def _encode_tiff_pillow(data, compression, predictor):
+    """
+    Encodes uint8 tiles with 1, 3 or 4 bands as TIFF using Pillow, which uses
+    libtiff for compressed TIFFs.
+    """
+    try:
+        assert data.dtype == "uint8"
+        assert data.ndim == 2 or data.shape[2] in (3, 4)
+        assert predictor in (None, "horizontal")
+    except:
+        raise TypeError(
+            "%s needs imagecodecs for %s arrays of dtype %s" % (
+                compression,
+                data.shape,
+                data.dtype
+                )
+            )
+    tiffinfo = {}
+    if predictor:
+        tiffinfo[317] = tiff_predictors[predictor]
+    buf = ioBuffer()
+    Image.fromarray(data).save(
+        buf,
+        "TIFF",
+        compression=compression,
+        tiffinfo=tiffinfo
+        )
+    return buf.getvalue()
+
+
+def apply_predictor(data, predictor=None):
+    """
+    Filters an array so it compresses better, like the TIFF predictors:
+    - horizontal: every value is replaced by its difference to the value left
+      of it (integer dtypes)
+    - floating_point: the bytes of every row are ordered from the most to the
+      least significant byte of all values and replaced by their difference
+      to the byte one pixel before (float dtypes)
+    Differences wrap around, dtype and shape stay the same, so the filtered
+    array can be stored like the original one. reverse_predictor() restores
+    the exact values.
+    """
+    if not predictor:
+        return data
+    data = np.asarray(data)
+    _check_predictor_dtype(data.dtype, predictor)
+    if predictor == "horizontal":
+        filtered = np.empty_like(data)
+        filtered[:, :1] = data[:, :1]
+        np.subtract(data[:, 1:], data[:, :-1], out=filtered[:, 1:])
+        return filtered
+    height = data.shape[0]
+    samples = int(np.prod(data.shape[2:]))
+    rows = np.ascontiguousarray(
+        data,
+        dtype=data.dtype.newbyteorder(">")
+        ).reshape(height, -1).view(np.uint8).reshape(
+            height,
+            -1,
+            data.itemsize
+            ).transpose(0, 2, 1).reshape(height, -1)
+    filtered = np.empty_like(rows)
+    filtered[:, :samples] = rows[:, :samples]
+    np.subtract(
+        rows[:, samples:],
+        rows[:, :-samples],
+        out=filtered[:, samples:]
+        )
+    return filtered.view(data.dtype).reshape(data.shape)
+
+
+def reverse_predictor(data, predictor=None):
+    """
+    Restores the values of an array filtered by apply_predictor().
+    """
+    if not predictor:
+        return data
+    _check_predictor_dtype(data.dtype, predictor)
+    if predictor == "horizontal":
+        return np.cumsum(data, axis=1, dtype=data.dtype)
+    height = data.shape[0]
+    rows = np.cumsum(
+        np.ascontiguousarray(data).reshape(height, -1).view(np.uint8).reshape(
+            height,
+            -1,
+            int(np.prod(data.shape[2:]))
+            ),
+        axis=1,
+        dtype=np.uint8
+        )
+    values = rows.reshape(height, data.itemsize, -1).transpose(0, 2, 1)
+    return np.ascontiguousarray(values).view(
+        data.dtype.newbyteorder(">")
+        ).reshape(data.shape).astype(data.dtype)
+
+
+def _check_predictor_dtype(dtype, predictor):
+    """
+    Raises a TypeError if the predictor does not support the dtype.
+    """
+    try:
+        if predictor == "horizontal":
+            assert np.issubdtype(dtype, np.integer)
+        else:
+            assert np.issubdtype(dtype, np.floating)
+    except:
+        raise TypeError(
+            "predictor %s does not support dtype %s" % (predictor, dtype)
+            )
+
+
+def _set_blosc_threads(options):
+    """
+    Sets the number of blosc threads if given in the codec settings. blosc
+    uses one thread pool per process, so the setting stays in effect.
+    """
+    if options["nthreads"]:
+        blosc.set_nthreads(options["nthreads"])
+
+
+def _typesize(data, options):
+    """
+    Returns the typesize used for shuffling an array.
+    """
+    typesize = options["typesize"] or data.itemsize
+    try:
+        assert data.nbytes % typesize == 0
+    except:
+        raise TypeError(
+            "array of %s bytes cannot be split into elements of %s bytes" % (
+                data.nbytes,
+                typesize
+                )
+            )
+    return typesize
+
+
+def _shuffle_bytes(data, options):
+    """
+    Returns the bytes of a contiguous array as uint8 array. With byte shuffle,
+    the first bytes of all elements come first, then the second bytes etc.
+    """
+    typesize = _typesize(data, options)
+    data = data.reshape(-1).view(np.uint8)
+    if options["shuffle"] == "byte" and typesize > 1:
+        data = np.ascontiguousarray(data.reshape(-1, typesize).T)
+    return data
+
+
+def _unshuffle_bytes(data, dtype, shape, options):
+    """
+    Reverses _shuffle_bytes().
+    """
+    data = np.frombuffer(data, dtype=np.uint8)
+    typesize = options["typesize"] or np.dtype(dtype).itemsize
+    if options["shuffle"] == "byte" and typesize > 1:
+        data = np.ascontiguousarray(data.reshape(typesize, -1).T)
+    return data.view(dtype).reshape(shape)
+
+
+def _zstd_codec(options, decompress=False):
+    """
+    Returns a zstd compressor (or decompressor) for the codec settings.
+    Compressors keep their context and dictionary, so they are reused within
+    the calling thread.
+    """
+    codecs = _zstd_codecs.__dict__.setdefault("codecs", {})
+    key = (
+        decompress,
+        options["clevel"],
+        options["nthreads"],
+        options["dictionary"]
+        )
+    codec = codecs.get(key)
+    if codec is None:
+        kwargs = {}
+        if options["dictionary"]:
+            kwargs.update(
+                dict_data=zstandard.ZstdCompressionDict(options["dictionary"])
+                )
+        if decompress:
+            codec = zstandard.ZstdDecompressor(**kwargs)
+        else:
+            codec = zstandard.ZstdCompressor(
+                level=options["clevel"],
+                threads=(options["nthreads"] or 0),
+                **kwargs
+                )
+        codecs[key] = codec
+    return codec
+
+
+def downsample_tiles(children, resampling="mean", fill_value=0):
+    """
+    Computes a parent tile from up to four child tiles by reducing each
+    2x2 pixel block of the children mosaic to one pixel.
+    - children: {(row_offset, col_offset): array} with offsets 0 or 1
+    - resampling:
+      - mean: average of the block, rounded for integer dtypes
+      - nearest: upper left pixel of the block
+      - mode: most frequent value of the block
+    - fill_value: value used where all pixels of a block are missing
+    Pixels of missing children are ignored. Additional dimensions (bands,
+    time) are resampled independently.
+    """
+    sample = next(iter(children.values()))
+    height, width = sample.shape[:2]
+    extra = sample.shape[2:]
+    mosaic = np.zeros((2 * height, 2 * width) + extra, dtype=sample.dtype)
+    valid = np.zeros((2 * height, 2 * width), dtype=bool)
+    for (row, col), data in children.items():
+        mosaic[
+            row*height:(row+1)*height,
+            col*width:(col+1)*width
+            ] = data
+        valid[
+            row*height:(row+1)*height,
+            col*width:(col+1)*width
+            ] = True
+    # Move the four pixels of every block into axis 2.
+    blocks = mosaic.reshape(
+        (height, 2, width, 2) + extra
+        ).swapaxes(1, 2).reshape((height, width, 4) + extra)
+    mask = valid.reshape(
+        (height, 2, width, 2)
+        ).swapaxes(1, 2).reshape((height, width, 4) + (1, ) * len(extra))
+    count = mask.sum(axis=2)
+    if resampling == "mean":
+        data = (blocks * mask).sum(axis=2, dtype="float64") / np.maximum(
+            count,
+            1
+            )
+        if np.issubdtype(sample.dtype, np.integer):
+            data = np.round(data)
+    else:
+        if resampling == "nearest":
+            ranks = mask
+        elif resampling == "mode":
+            # Count how often every pixel value occurs within its block.
+            ranks = (
+                (blocks[:, :, :, np.newaxis] == blocks[:, :, np.newaxis]) &
+                mask[:, :, np.newaxis]
+                ).sum(axis=3)
+            ranks = np.where(mask, ranks, -1)
+        index = np.argmax(ranks, axis=2)[:, :, np.newaxis]
+        data = np.take_along_axis(
+            blocks,
+            np.broadcast_to(index, (height, width, 1) + extra),
+            axis=2
+            )[:, :, 0]
+    return np.where(count, data, fill_value).astype(sample.dtype)
+
+
+def _encode_tile_bytes(
+    zoom,
+    row,
+    col,
+    data,
+    codec,
+    options,
+    predictor,
+    dedup=False,
+    chunked=False
+    ):
+    """
+    Encodes a tile in a worker process with the TileCodec of the file and
+    returns it as picklable bytes.
+    Tiles of deduplicated files are (tile_hash, fill, data) tuples, only new
+    blobs carry data to be encoded. Tiles of chunked files are encoded chunk
+    by chunk.
+    """
+    if chunked:
+        return zoom, row, col, [
+            (key, _picklable_value(codec.encode(chunk, options, predictor)))
+            for key, chunk in tile_chunks(data)
+            ]
+    if dedup:
+        tile_hash, fill, data = data
+        if data is not None:
+            data = _picklable_value(codec.encode(data, options, predictor))
+        return zoom, row, col, (tile_hash, fill, data)
+    return zoom, row, col, _picklable_value(
+        codec.encode(data, options, predictor)
+        )
+
+
+def _picklable_value(data):
+    """
+    Converts an encoded tile_data value into bytes.
+    """
+    if isinstance(data, tuple):
+        # (tag, value) of adaptive files
+        return data[0], bytes(data[1])
+    if isinstance(data, np.ndarray):
+        data = adapt_array(data)
+    return bytes(data)
+
+
+def _sqlite_value(data, as_text=False):
+    """
+    Converts bytes from _picklable_value() back into a tile_data value.
+    """
+    if isinstance(data, tuple):
+        return data[0], Binary(data[1])
+    if as_text:
+        return data
+    return Binary(data)
+
+
+def encoding_pool(workers, initializer=None, initargs=()):
+    """
+    Starts a process pool for encoding tiles, calling initializer(*initargs)
+    in every worker. The blosc thread pool does not survive fork(), so the
+    workers are started while blosc is set to a single thread and start their
+    own threads when needed.
+    """
+    nthreads = blosc.set_nthreads(1)
+    try:
+        return Pool(workers, initializer, initargs)
+    finally:
+        blosc.set_nthreads(nthreads)
+
+
+def _encode_tiles_parallel(
+    pool,
+    tiles,
+    codec,
+    options,
+    predictor,
+    queue_size,
+    dedup=False,
+    chunked=False
+    ):
+    """
+    Encodes tiles with a TileCodec in a process pool and yields them in input
+    order. At most queue_size tiles are submitted to the pool at once.
+    """
+    as_text = codec.column_type == "TEXT"
+    for zoom, row, col, data in imap_bounded(
+        pool,
+        _encode_tile_bytes,
+        (
+            (
+                zoom,
+                row,
+                col,
+                data,
+                codec,
+                options,
+                predictor,
+                dedup,
+                chunked
+                )
+            for zoom, row, col, data in tiles
+            ),
+        queue_size
+        ):
+        if chunked:
+            data = [(key, _sqlite_value(value, as_text)) for key, value in data]
+        elif dedup:
+            tile_hash, fill, value = data
+            if value is not None:
+                value = _sqlite_value(value, as_text)
+            data = (tile_hash, fill, value)
+        else:
+            data = _sqlite_value(data, as_text)
+        yield zoom, row, col, data
+
+
+def hilbert_index(order, row, col):
+    """
+    Returns the position of a tile on the Hilbert curve filling a matrix of
+    2**order x 2**order tiles. Tiles close on the curve are close in the
+    matrix, so reading tiles in this order keeps neighbours together.
+    """
+    side = 1 << order
+    index = 0
+    step = side >> 1
+    x, y = col, row
+    while step > 0:
+        rx = 1 if x & step else 0
+        ry = 1 if y & step else 0
+        index += step * step * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = side - 1 - x
+                y = side - 1 - y
+            x, y = y, x
+        step >>= 1
+    return index
+
+
+def morton_index(order, row, col):
+    """
+    Returns the position of a tile on the Z-order (Morton) curve filling a
+    matrix of 2**order x 2**order tiles, interleaving the bits of row and
+    column.
+    """
+    index = 0
+    for bit in range(order):
+        index |= ((col >> bit) & 1) << (2 * bit)
+        index |= ((row >> bit) & 1) << (2 * bit + 1)
+    return index
+
+
+def tile_key(layout, zoom, row, col):
+    """
+    Returns the id of a tile in a clustered layout: the zoom level in the
+    upper bits followed by the position of the tile on the curve of the
+    layout covering the 2**(zoom + 1) tiles wide matrix. Sorting tiles by id
+    sorts them by zoom level and along the curve.
+    Raises an AttributeError above max_layout_zoom, where the curve position
+    would overflow into the zoom level bits.
+    """
+    try:
+        assert zoom <= max_layout_zoom
+    except:
+        raise AttributeError(
+            "zoom %s exceeds %s of clustered layouts" % (zoom, max_layout_zoom)
+            )
+    return (zoom << 56) | tile_layouts[layout](zoom + 1, row, col)
+
+
+def _fetch_rows(cursor):
+    """
+    Yields the rows of an executed query fetched cursor.arraysize at a time.
+    """
+    while True:
+        rows = cursor.fetchmany()
+        if not rows:
+            return
+        for row in rows:
+            yield row
+
+
+def imap_bounded(pool, function, iterable, queue_size):
+    """
+    Yields function(*args) for every args tuple of iterable in input order,
+    calculated in a multiprocessing pool. Unlike Pool.imap(), at most
+    queue_size tasks are submitted at once, so the iterable is only consumed
+    as fast as the results are.
+    """
+    pending = deque()
+    for args in iterable:
+        pending.append(pool.apply_async(function, args))
+        if len(pending) >= queue_size:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+class TileFetcher():
+    """
+    Non-blocking tile access to an EO Geopackage opened for reading, e.g. for
+    services answering many requests from one event loop. Tiles are fetched
+    and decoded in a bounded thread pool reading through per-thread
+    connections; concurrent requests for the same tile share one fetch.
+    Parameters:
+    - file_path: path to .gpkgx file
+    - workers: number of threads fetching and decoding tiles
+    - further keyword arguments (e.g. cache_size, profile) are passed on to
+      EOGeopackage; readers has to be pool (default) or immutable, as the
+      threads cannot share one connection
+    """
+
+    def __enter__(self):
+        return self
+
+
+    def __init__(self, file_path, workers=4, **kwargs):
+        try:
+            assert workers > 0
+        except:
+            raise AttributeError("invalid number of workers %s" % workers)
+        readers = kwargs.setdefault("readers", "pool")
+        try:
+            assert readers in ("pool", "immutable")
+        except:
+            raise AttributeError(
+                "TileFetcher needs pool or immutable readers, not %s" % readers
+                )
+        self.geopackage = EOGeopackage(file_path, "r", **kwargs)
+        self.workers = workers
+        self.pool = ThreadPool(workers)
+        # Fetches in progress by (zoom, row, col).
+        self.__pending = {}
+        self.__lock = threading.Lock()
+
+
+    def fetch_tile(self, zoom, row, col):
+        """
+        Starts fetching a tile and returns an AsyncResult whose get() returns
+        the decoded tile or None if it does not exist. Requests for a tile
+        already being fetched return the AsyncResult of that fetch.
+        """
+        key = (zoom, row, col)
+        with self.__lock:
+            result = self.__pending.get(key)
+            if result is None:
+                result = self.pool.apply_async(self.__fetch_tile, key)
+                self.__pending[key] = result
+        return result
+
+
+    def fetch_tiles(self, zoom, row_range, col_range):
+        """
+        Starts fetching a tile range and returns an AsyncResult whose get()
+        returns get_tiles() of EOGeopackage.
+        """
+        return self.pool.apply_async(
+            self.geopackage.get_tiles,
+            (zoom, row_range, col_range)
+            )
+
+
+    def stream_tiles(self, zoom, row_range, col_range):
+        """
+        Yields (row, col, data) of the existing tiles of a tile range row by
+        row. Rows are fetched ahead in the thread pool, at most workers rows
+        at a time.
+        """
+        min_col, max_col = min(col_range), max(col_range)
+        for tiles in imap_bounded(
+            self.pool,
+            self.__fetch_row,
+            (
+                (zoom, row, min_col, max_col)
+                for row in range(min(row_range), max(row_range) + 1)
+                ),
+            self.workers
+            ):
+            for tile in tiles:
+                yield tile
+
+
+    def __fetch_tile(self, zoom, row, col):
+        try:
+            return self.geopackage.get_tiledata(zoom, row, col)
+        finally:
+            with self.__lock:
+                self.__pending.pop((zoom, row, col), None)
+
+
+    def __fetch_row(self, zoom, row, min_col, max_col):
+        return [
+            (row, col, data)
+            for (row, col), data in sorted(self.geopackage.get_tiles(
+                zoom,
+                (row, ),
+                (min_col, max_col)
+                ).items())
+            ]
+
+
+    def close(self):
+        """
+        Waits for the running fetches, stops the threads and closes the file.
+        """
+        self.pool.close()
+        self.pool.join()
+        self.geopackage.close()
+
+
+    def __exit__(self, *args):
+        """Resource cleanup on destruction."""
+        self.close()
+
+
+class TileCoverage():
+    """
+    Bitmap of the existing tiles of a zoom level, split into blocks of
+    coverage_block_size x coverage_block_size tiles. Only blocks holding
+    tiles are allocated, each as uint8 array of its rows packed eight tiles
+    per byte (numpy.packbits() order).
+    - blocks: packed bitmaps by (block_row, block_col)
+    """
+
+    def __init__(self, blocks=None):
+        self.blocks = blocks or {}
+
+
+    @classmethod
+    def from_keys(cls, rows, cols):
+        """
+        Creates the bitmap of tiles given by arrays of rows and columns.
+        """
+        coverage = cls()
+        coverage.add_keys(rows, cols)
+        return coverage
+
+
+    @classmethod
+    def from_bitmaps(cls, bitmaps):
+        """
+        Creates the bitmap from (min_row, min_col, rows, cols, packed) tuples
+        as stored by bitmaps().
+        """
+        coverage = cls()
+        block_bytes = coverage_block_size * coverage_block_size // 8
+        for min_row, min_col, rows, cols, packed in bitmaps:
+            packed = np.frombuffer(packed, dtype="uint8")
+            if (
+                min_row % coverage_block_size == 0 and
+                min_col % coverage_block_size == 0 and
+                rows == cols == coverage_block_size and
+                len(packed) == block_bytes
+                ):
+                coverage.blocks[(
+                    min_row // coverage_block_size,
+                    min_col // coverage_block_size
+                    )] = packed.reshape((coverage_block_size, -1)).copy()
+                continue
+            # Any other rectangle of tiles.
+            tile_rows, tile_cols = np.nonzero(
+                np.unpackbits(packed)[:rows * cols].reshape((rows, cols))
+                )
+            coverage.add_keys(tile_rows + min_row, tile_cols + min_col)
+        return coverage
+
+
+    def bitmaps(self):
+        """
+        Returns the blocks as (min_row, min_col, rows, cols, packed) tuples,
+        packed being the bytes of the block bitmap.
+        """
+        return [
+            (
+                block_row * coverage_block_size,
+                block_col * coverage_block_size,
+                coverage_block_size,
+                coverage_block_size,
+                block.tobytes()
+                )
+            for (block_row, block_col), block in sorted(self.blocks.items())
+            ]
+
+
+    def __contains__(self, key):
+        row, col = key
+        block = self.blocks.get((
+            row // coverage_block_size,
+            col // coverage_block_size
+            ))
+        if block is None:
+            return False
+        col %= coverage_block_size
+        return bool(
+            block[row % coverage_block_size, col >> 3] & (128 >> (col & 7))
+            )
+
+
+    def __len__(self):
+        return sum(
+            int(np.unpackbits(block).sum()) for block in self.blocks.values()
+            )
+
+
+    def add(self, row, col):
+        """
+        Marks a tile as existing.
+        """
+        self.__set_bits(
+            self.__block(
+                row // coverage_block_size,
+                col // coverage_block_size
+                ),
+            row % coverage_block_size,
+            col % coverage_block_size
+            )
+
+
+    def add_keys(self, rows, cols):
+        """
+        Marks the tiles given by arrays of rows and columns as existing.
+        """
+        rows = np.asarray(rows, dtype="int64")
+        cols = np.asarray(cols, dtype="int64")
+        if not rows.size:
+            return
+        block_rows = rows // coverage_block_size
+        block_cols = cols // coverage_block_size
+        # Tiles sorted by block, so every block is updated once.
+        order = np.lexsort((block_cols, block_rows))
+        changes = np.flatnonzero(
+            (np.diff(block_rows[order]) != 0) |
+            (np.diff(block_cols[order]) != 0)
+            ) + 1
+        for selected in np.split(order, changes):
+            self.__set_bits(
+                self.__block(
+                    int(block_rows[selected[0]]),
+                    int(block_cols[selected[0]])
+                    ),
+                rows[selected] % coverage_block_size,
+                cols[selected] % coverage_block_size
+                )
+
+
+    def keys(self, bbox=None):
+        """
+        Yields (row, col) of all tiles within a bounding box (min_col,
+        min_row, max_col, max_row) row by row. Only the blocks of one row of
+        blocks within the bounding box are unpacked at a time.
+        """
+        row_blocks = {}
+        for block_row, block_col in self.blocks:
+            row_blocks.setdefault(block_row, []).append(block_col)
+        for block_row in sorted(row_blocks):
+            top = block_row * coverage_block_size
+            if bbox is not None and not (
+                bbox[1] - coverage_block_size < top <= bbox[3]
+                ):
+                continue
+            rows, cols = [], []
+            for block_col in sorted(row_blocks[block_row]):
+                left = block_col * coverage_block_size
+                if bbox is not None and not (
+                    bbox[0] - coverage_block_size < left <= bbox[2]
+                    ):
+                    continue
+                tile_rows, tile_cols = np.nonzero(np.unpackbits(
+                    self.blocks[(block_row, block_col)],
+                    axis=1
+                    ))
+                rows.append(tile_rows + top)
+                cols.append(tile_cols + left)
+            if not rows:
+                continue
+            rows = np.concatenate(rows)
+            cols = np.concatenate(cols)
+            if bbox is not None:
+                inside = (
+                    (cols >= bbox[0]) & (rows >= bbox[1]) &
+                    (cols <= bbox[2]) & (rows <= bbox[3])
+                    )
+                rows, cols = rows[inside], cols[inside]
+            for position in np.lexsort((cols, rows)):
+                yield int(rows[position]), int(cols[position])
+
+
+    def __block(self, block_row, block_col):
+        """
+        Returns the bitmap of a block, allocating it if needed.
+        """
+        block = self.blocks.get((block_row, block_col))
+        if block is None:
+            block = np.zeros(
+                (coverage_block_size, coverage_block_size // 8),
+                dtype="uint8"
+                )
+            self.blocks[(block_row, block_col)] = block
+        return block
+
+
+    def __set_bits(self, block, rows, cols):
+        """
+        Sets the bits of tiles given by rows and columns within a block.
+        """
+        np.bitwise_or.at(
+            block,
+            (rows, np.right_shift(cols, 3)),
+            np.right_shift(128, np.bitwise_and(cols, 7)).astype("uint8")
+            )
+
+
+class TileCache():
+    """
+    LRU cache of decoded tiles bounded by the total size of the cached arrays.
+    - max_bytes: maximum sum of nbytes of all cached arrays
+    Cached arrays are set read-only as they are shared between all callers.
+    Counters for hits, misses and evictions are available from stats().
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__tiles = OrderedDict()
+        self.__lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self.__tiles)
+
+
+    def get(self, key):
+        """
+        Returns the cached array or None.
+        """
+        with self.__lock:
+            try:
+                data = self.__tiles.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.__tiles[key] = data
+            self.hits += 1
+            return data
+
+
+    def put(self, key, data):
+        """
+        Caches an array and evicts the least recently used ones if necessary.
+        Arrays larger than max_bytes are not cached.
+        """
+        if data.nbytes > self.max_bytes:
+            return
+        data.flags.writeable = False
+        with self.__lock:
+            self.__remove(key)
+            self.__tiles[key] = data
+            self.size += data.nbytes
+            while self.size > self.max_bytes:
+                key, evicted = self.__tiles.popitem(last=False)
+                self.size -= evicted.nbytes
+                self.evictions += 1
+
+
+    def invalidate(self, key):
+        """
+        Removes an array from the cache.
+        """
+        with self.__lock:
+            self.__remove(key)
+
+
+    def clear(self):
+        """
+        Removes all arrays from the cache.
+        """
+        with self.__lock:
+            self.__tiles.clear()
+            self.size = 0
+
+
+    def stats(self):
+        """
+        Returns cache counters as a dictionary.
+        """
+        with self.__lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                tiles=len(self.__tiles),
+                bytes=self.size
+                )
+
+
+    def __remove(self, key):
+        data = self.__tiles.pop(key, None)
+        if data is not None:
+            self.size -= data.nbytes
+
+
+# From http://stackoverflow.com/questions/18621513/python-insert-numpy-array-into-sqlite3-database
+def adapt_array(arr):
+    """
+    http://stackoverflow.com/a/31312102/190597 (SoulNibbler)
+    """
+    out = io.BytesIO()
+    np.save(out, arr)
+    out.seek(0)
+    return sqlite3.Binary(out.read())
+def convert_array(text):
+    out = io.BytesIO(text)
+    out.seek(0)
+    return np.load(out)
+# Converts np.array to TEXT when inserting
+sqlite3.register_adapter(np.ndarray, adapt_array)
+# Converts TEXT to np.array when selecting
+sqlite3.register_converter("array", convert_array)
+
+content_description = """
+Experimental EO GPKG raster tiles by EOX IT Services (ju@eox.at)
+"""
+
+ref_sys_wkt = {
+    4326: """
+    GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,
+    298.257223563,AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG",
+    "6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],UNIT
+    ["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],
+    AUTHORITY["EPSG","4326"]]
+    """
+    }
+
+
+# Tile grids as used by tilematrix: bounds and number of tiles at zoom 0.
+tile_matrix_sets = {
+    4326: {
+        "bounds": (-180.0, -90.0, 180.0, 90.0),
+        "matrix_width": 2,
+        "matrix_height": 1
+        }
+    }
+
+resampling_methods = ("mean", "nearest", "mode")
+
+# SQL insert statements of the on_conflict policies.
+conflict_clauses = {
+    "error": "INSERT",
+    "skip": "INSERT OR IGNORE",
+    "replace": "INSERT OR REPLACE"
+    }
+
+# ORDER BY terms of the iter_tiles() orders within a zoom level. The Hilbert
+# curve covers the 2**(zoom + 1) tiles wide matrix of the zoom level.
+tile_orders = {
+    "hilbert": "hilbert_index(zoom_level + 1, tile_row, tile_column)",
+    "rowmajor": "tile_row, tile_column"
+    }
+
+# Curves ordering the tiles of the layouts (see tile_key()).
+tile_layouts = {
+    "insert": None,
+    "hilbert": hilbert_index,
+    "morton": morton_index
+    }
+
+# Highest zoom level of the clustered layouts, whose curve positions of
+# 2 * (zoom + 1) bits fit below the zoom level in the upper 8 bits of the id.
+max_layout_zoom = 27
+
+# Tiles per side of the blocks of the coverage bitmaps (see TileCoverage).
+coverage_block_size = 256
+
+# Tiles fetched at once when building a coverage bitmap from the tiles table.
+coverage_scan_size = 65536
+
+# Default size in bytes of the cache of decoded blobs of deduplicated files.
+dedup_cache_size = 64 * 1024**2
+
+blosc_compressions = ("blosclz", "lz4", "lz4hc", "snappy", "zlib")
+
+# blosc compressors whose tiles are decoded again after encoding and, if
+# they differ, stored with the other compressor instead; blosc decompresses
+# every buffer with the compressor recorded in its header. The snappy codec
+# of c-blosc 1.11 (python-blosc 1.5) returns corrupted buffers for some
+# arrays, more often when shuffled.
+blosc_verified = {"snappy": "lz4"}
+
+blosc_shuffles = {
+    "none": blosc.NOSHUFFLE,
+    "byte": blosc.SHUFFLE,
+    "bit": blosc.BITSHUFFLE
+    }
+
+predictors = (None, "horizontal", "floating_point")
+
+# TIFF Compression, Predictor and SampleFormat (by numpy dtype kind and
+# itemsize) tag values.
+tiff_compressions = {
+    None: 1,
+    "tiff_lzw": 5,
+    "tiff_adobe_deflate": 8,
+    "tiff_deflate": 32946,
+    "tiff_zstd": 50000
+    }
+
+tiff_predictors = {"horizontal": 2, "floating_point": 3}
+
+tiff_sample_formats = {
+    "u1": 1,
+    "u2": 1,
+    "u4": 1,
+    "i1": 2,
+    "i2": 2,
+    "i4": 2,
+    "f4": 3,
+    "f8": 3
+    }
+
+# Settings of blosc codecs, see EOGeopackage.
+codec_option_defaults = {
+    "clevel": 9,
+    "shuffle": "byte",
+    "typesize": None,
+    "nthreads": None
+    }
+
+# Codec settings only controlling encoding and decoding in the current
+# process, which are neither stored in the file nor compared when it is
+# reopened (see EOGeopackage).
+runtime_codec_options = ("nthreads", )
+
+# zstd compressors and decompressors of the current thread.
+_zstd_codecs = threading.local()
+
+# Codecs by (data_type, compression), see TileCodec.
+tile_codecs = OrderedDict()
+register_codec(TileCodec(
+    "xray",
+    None,
+    _encode_array,
+    _decode_array,
+    column_type="ARRAY"
+    ))
+for cname in blosc_compressions:
+    register_codec(TileCodec(
+        "xray",
+        cname,
+        partial(_encode_blosc, cname=cname),
+        _decode_blosc,
+        options=codec_option_defaults,
+        option_values={"shuffle": ("none", "byte", "bit")},
+        column_type="TEXT"
+        ))
+for cname in blosc.cnames:
+    register_codec(TileCodec(
+        "xray",
+        "blosc:%s" % cname,
+        partial(_encode_blosc_buffer, cname=cname),
+        _decode_blosc_buffer,
+        options=codec_option_defaults,
+        option_values={"shuffle": ("none", "byte", "bit")},
+        array=True
+        ))
+register_codec(TileCodec(
+    "xray",
+    "zstandard",
+    _encode_zstandard,
+    _decode_zstandard,
+    options=dict(
+        codec_option_defaults,
+        clevel=3,
+        shuffle="none",
+        dictionary=None
+        ),
+    option_values={"shuffle": ("none", "byte")},
+    array=True,
+    available=(zstandard is not None)
+    ))
+register_codec(TileCodec("xray", "raw", _encode_raw, _decode_raw, array=True))
+for compression in tiff_compressions:
+    register_codec(TileCodec(
+        "image/TIFF",
+        compression,
+        partial(_encode_tiff_tile, compression=compression),
+        _decode_tiff_tile,
+        dtypes=dict(
+            (np.dtype(dtype).name, None) for dtype in tiff_sample_formats
+            ),
+        predictor_tag=True,
+        available=(compression != "tiff_zstd" or zstandard is not None)
+        ))
+for data_type, candidates in (
+    ("xray", ["lz4", "blosc:zstd", "raw"]),
+    ("image/TIFF", ["tiff_deflate", None])
+    ):
+    register_codec(TileCodec(
+        data_type,
+        "adaptive",
+        partial(_encode_adaptive, data_type=data_type),
+        _decode_adaptive,
+        options={"candidates": candidates, "constant": True, "sample": 0.25},
+        option_values={"constant": (True, False), "sample": _valid_sample},
+        extra_options=True,
+        array=True,
+        predictor_tag=True
+        ))
+    register_codec(TileCodec(
+        data_type,
+        "constant",
+        _encode_constant,
+        _decode_constant,
+        array=True,
+        predictor_tag=True
+        ))
+register_codec(TileCodec(
+    "image/JPEG2000",
+    None,
+    partial(_encode_pillow, image_format="JPEG2000", irreversible=False),
+    _decode_pillow,
+    dtypes={"uint8": (None, 3, 4), "uint16": (None, )}
+    ))
+register_codec(TileCodec(
+    "image/PNG",
+    None,
+    partial(_encode_pillow, image_format="PNG"),
+    _decode_pillow,
+    dtypes={"uint8": (None, 3, 4), "uint16": (None, )},
+    options={"compress_level": 6},
+    option_values={"compress_level": range(10)}
+    ))
+register_codec(TileCodec(
+    "image/WebP",
+    None,
+    partial(_encode_pillow, image_format="WEBP", lossless=True),
+    _decode_pillow,
+    dtypes={"uint8": (None, 3)},
+    options={"method": 4},
+    option_values={"method": range(7)}
+    ))
+
+# PRAGMAs set on connections, see EOGeopackage.
+sqlite_profiles = {
+    None: OrderedDict(),
+    "ingest": OrderedDict([
+        ("page_size", 65536),
+        ("journal_mode", "WAL"),
+        ("synchronous", "NORMAL"),
+        ("cache_size", -524288),
+        ("temp_store", "MEMORY")
+        ]),
+    "serve": OrderedDict([
+        ("query_only", 1),
+        ("mmap_size", 2147483648),
+        ("cache_size", -262144)
+        ])
+    }
+
+
+sql_create_tables = OrderedDict([
+    ("gpkg_spatial_ref_sys",
+    """
+    CREATE TABLE IF NOT EXISTS gpkg_spatial_ref_sys (
+      srs_name TEXT NOT NULL,
       srs_id INTEGER NOT NULL PRIMARY KEY,
       organization TEXT NOT NULL,
       organization_coordsys_id INTEGER NOT NULL,
@@ -464,19 +4170,120 @@ sql_create_tables = OrderedDict([
     ])
 
 
+tile_metadata_definition = """
+Key/value table gpkgx_tile_metadata storing the encoding of the tile_data
+column: data_type, srs, codec, codec_level, codec_options (clevel, shuffle,
+typesize), codec_dictionary (base64 encoded zstd dictionary),
+predictor, dedup (tile data stored in tile_blobs), chunked (one tile_data
+value per band and time slice), dtype, bands, tile_shape and order.
+Values are JSON encoded.
+"""
+
+
+tile_coverage_definition = """
+Table gpkgx_tile_coverage storing bitmaps of the existing tiles per zoom
+level, one row per block of tiles holding tiles: the tile at (min_row + i,
+min_col + j) exists if bit i * matrix_cols + j of bitmap (numpy.packbits
+order) is set. tiles_sequence is the sequence number of the tiles table the
+bitmaps were stored at; bitmaps with another sequence number are outdated.
+"""
+
+
+sql_create_extension_tables = OrderedDict([
+    ("gpkg_extensions",
+    """
+    CREATE TABLE IF NOT EXISTS gpkg_extensions (
+      table_name TEXT,
+      column_name TEXT,
+      extension_name TEXT NOT NULL,
+      definition TEXT NOT NULL,
+      scope TEXT NOT NULL,
+      CONSTRAINT ge_tce UNIQUE (table_name, column_name, extension_name)
+    );
+    """),
+    ("gpkgx_tile_metadata",
+    """
+    CREATE TABLE IF NOT EXISTS gpkgx_tile_metadata (
+      table_name TEXT NOT NULL,
+      key TEXT NOT NULL,
+      value TEXT,
+      CONSTRAINT pk_gtmd PRIMARY KEY (table_name, key),
+      CONSTRAINT fk_gtmd_table_name FOREIGN KEY (table_name) REFERENCES
+        gpkg_contents(table_name)
+    );
+    """),
+    ("gpkgx_tile_coverage",
+    """
+    CREATE TABLE IF NOT EXISTS gpkgx_tile_coverage (
+      table_name TEXT NOT NULL,
+      zoom_level INTEGER NOT NULL,
+      min_row INTEGER NOT NULL,
+      min_col INTEGER NOT NULL,
+      matrix_rows INTEGER NOT NULL,
+      matrix_cols INTEGER NOT NULL,
+      bitmap BLOB NOT NULL,
+      tiles_sequence INTEGER NOT NULL,
+      CONSTRAINT pk_gtc PRIMARY KEY (table_name, zoom_level, min_row, min_col),
+      CONSTRAINT fk_gtc_table_name FOREIGN KEY (table_name) REFERENCES
+        gpkg_contents(table_name)
+    );
+    """)
+    ])
+
+
+# Tiles written are recorded by a trigger, every tile once with its latest
+# change.
+sql_create_change_log = OrderedDict([
+    ("tile_changes",
+    """
+    CREATE TABLE IF NOT EXISTS tile_changes (
+      change_id INTEGER PRIMARY KEY AUTOINCREMENT,
+      zoom_level INTEGER NOT NULL,
+      tile_column INTEGER NOT NULL,
+      tile_row INTEGER NOT NULL,
+      last_change DATETIME NOT NULL DEFAULT
+        (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+      UNIQUE (zoom_level, tile_column, tile_row)
+    );
+    """),
+    ("tile_changes_insert",
+    """
+    CREATE TRIGGER IF NOT EXISTS tile_changes_insert
+    AFTER INSERT ON tiles
+    BEGIN
+      DELETE FROM tile_changes WHERE
+        zoom_level = NEW.zoom_level AND
+        tile_column = NEW.tile_column AND
+        tile_row = NEW.tile_row;
+      INSERT INTO tile_changes (zoom_level, tile_column, tile_row)
+        VALUES (NEW.zoom_level, NEW.tile_column, NEW.tile_row);
+    END;
+    """)
+    ])
+
+
 def schema_is_ok(geopackage_path):
     """
-    Checks if all necessary tables exist.
+    Checks if all necessary tables exist. Returns True or the name of the
+    first missing table.
     """
-    with connect(geopackage_path) as db_connection:
-        cursor = db_connection.cursor()
-        for table in sql_create_tables:
-            cursor.execute("""
-                SELECT name FROM sqlite_master WHERE type='table' AND name='%s'
-                """ %(table)
-            )
-            if cursor.fetchone():
-                pass
-            else:
-                return table
+    db_connection = connect(geopackage_path)
+    try:
+        tables = table_names(db_connection)
+    finally:
+        db_connection.close()
+    for table in sql_create_tables:
+        if table not in tables:
+            return table
     return True
+
+
+def table_names(db_connection):
+    """
+    Returns the names of all tables of a database with one query.
+    """
+    cursor = db_connection.cursor()
+    cursor.execute("""
+        SELECT name FROM sqlite_master WHERE type='table';
+        """)
+    return set(name for name, in cursor.fetchall())